@@ -25,6 +25,14 @@ namespace CodeProject.AI.SDK
         /// </summary>
         [JsonInclude]
         public string? reqtype { get; protected set; }
+
+        /// <summary>
+        /// Gets or sets the time, in milliseconds since the Unix epoch (UTC), after which the
+        /// caller will no longer be waiting for the response. Modules can use this to skip work
+        /// that would be wasted. Null if there is no deadline.
+        /// </summary>
+        [JsonInclude]
+        public long? deadline { get; set; }
     }
 
     /// <summary>
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+import time
+
+from PIL import Image, ImageChops
+
+from common import JSON
+from request_data import RequestData
+from result_cache import ResultCache
+
+
+class FrameGate:
+    """
+    Spots frames from a camera that are all but identical to the last frame
+    from that camera that we processed (eg a static camera overnight, with
+    nothing moving) so the earlier result can be reused rather than running
+    inference again. The client says which camera a frame is from by sending a
+    camera_id value with the request.
+
+    Each frame is reduced to a small greyscale thumbnail. A frame is a near
+    duplicate if fewer than changed_fraction of the thumbnail's pixels differ
+    from the last processed frame by more than pixel_threshold. Working with a
+    grid of small cells rather than a single hash of the frame means a small
+    object moving in a large frame is still noticed. A result is never reused
+    for more than max_reuse_secs, in case something has changed too slowly for
+    us to see.
+    """
+
+    # The name of the request value that identifies the camera (or other source)
+    SOURCE_KEY = "camera_id"
+
+    def __init__(self, changed_fraction: float, pixel_threshold: int = 12,
+                 thumbnail_size: "tuple[int, int]" = (64, 48),
+                 max_reuse_secs: float = 60, max_sources: int = 256) -> None:
+
+        self.changed_fraction = changed_fraction
+        self.pixel_threshold  = pixel_threshold
+        self.thumbnail_size   = thumbnail_size
+        self.max_reuse_secs   = max_reuse_secs
+        self.max_sources      = max_sources
+
+        self.reused           = 0
+
+        self._sources         = OrderedDict()   # key => (thumbnail, time processed, result)
+
+    @staticmethod
+    def make_key(data: RequestData) -> str:
+        """
+        Returns the key for the source of the frame in a request, or None if
+        the client didn't say what the source was. The key covers everything
+        but the image itself, so a result is only reused for the same command,
+        model, and settings.
+        """
+        if not data.get_value(FrameGate.SOURCE_KEY):
+            return None
+
+        return ResultCache.make_key(data, include_files=False)
+
+    def make_thumbnail(self, data: RequestData) -> Image:
+        """
+        Returns the small greyscale thumbnail of the request's image that frames
+        are compared by, or None if there's no image. For JPEGs this is cheap,
+        as the image is scaled as it's decoded.
+        """
+        img = data.get_image(0, max_size=max(self.thumbnail_size))
+        if img is None:
+            return None
+
+        return img.convert("L").resize(self.thumbnail_size, Image.BILINEAR)
+
+    def get_reusable_result(self, key: str, thumbnail: Image) -> JSON:
+        """
+        Returns a copy of the result of the last frame processed from the same
+        source, marked as reused, if this frame is a near duplicate of it.
+        Returns None otherwise.
+        """
+        entry = self._sources.get(key)
+        if entry is None or thumbnail is None:
+            return None
+
+        last_thumbnail, processed_time, result = entry
+        if time.monotonic() - processed_time > self.max_reuse_secs:
+            return None
+
+        difference = ImageChops.difference(thumbnail, last_thumbnail)
+        changed    = sum(difference.histogram()[self.pixel_threshold + 1:])
+        if changed >= self.changed_fraction * thumbnail.width * thumbnail.height:
+            return None
+
+        self.reused += 1
+        self._sources.move_to_end(key)
+
+        result = dict(result)
+        result["reused"] = True
+        return result
+
+    def update(self, key: str, thumbnail: Image, result: JSON) -> None:
+        """ Records the (successful) result of a frame that was processed """
+        if thumbnail is None or not isinstance(result, dict) or result.get("success") != True:
+            return
+
+        self._sources[key] = (thumbnail, time.monotonic(), dict(result))
+        self._sources.move_to_end(key)
+
+        while len(self._sources) > self.max_sources:
+            self._sources.popitem(last=False)
@@ -0,0 +1,372 @@
+"""
+Benchmarks a module in-process, without the server or the network. Run the
+module with --benchmark, eg
+
+    python detect_adapter.py --benchmark --command detect --concurrency 2 --iterations 200
+
+The module is initialised as normal, and then process (or process_batch, if
+--batch-size > 1 and the module supports it) is called with requests built
+from the files in the module's test folder (or the folder given by --input),
+from --concurrency tasks at once, for --iterations requests or --duration
+seconds. A report of the throughput, latency percentiles, peak memory use and
+the time spent in each stage is printed as JSON, and written to --output if
+given (which is the easier place to read it from in scripts, since the module's
+own startup output also goes to stdout).
+
+With --replay FILE, the requests recorded in a capture file (see
+request_capture.py) are sent instead, once each by default. They're sent as
+fast as possible, or, with --speed, at their original times (--speed 1) or
+faster or slower (eg --speed 2 for twice as fast). When replaying at speed,
+latency is measured from when each request was due to arrive, so requests that
+had to wait for one of the --concurrency slots show that wait.
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import mimetypes
+import os
+import platform
+import sys
+import time
+
+from common import JSON
+from request_capture import RequestCapture
+from request_data import RequestData
+from timing_stats import TimingStats
+
+
+class _ConsoleLogger:
+    """
+    Stands in for the ModuleLogger while benchmarking. There's no server to
+    send logs to, so entries are simply written to stderr, keeping stdout clear
+    for the report.
+    """
+    def log(self, log_method, data: JSON) -> None:
+        print(f"{data.get('loglevel', 'information')}: {data.get('message', '')}", file=sys.stderr)
+
+    async def log_async(self, log_method, data: JSON) -> None:
+        self.log(log_method, data)
+
+    def cancel_logging(self) -> None:
+        pass
+
+
+def _parse_args(args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="--benchmark", description="Benchmarks this module in-process")
+    parser.add_argument("--input",       help="The folder containing the files to send (default: the module's test folder)")
+    parser.add_argument("--command",     default="detect", help="The command to send with each request")
+    parser.add_argument("--value",       action="append", default=[],
+                        help="A value to send with each request, as key=value. May be repeated")
+    parser.add_argument("--concurrency", type=int,   default=1,   help="The number of requests in progress at once")
+    parser.add_argument("--batch-size",  type=int,   default=1,   help="The number of requests sent to process_batch at once")
+    parser.add_argument("--replay",      help="A capture file whose requests are sent instead of the input files")
+    parser.add_argument("--speed",       type=float, default=0,
+                        help="Replay at the original times, scaled by this (eg 2 = twice as fast). 0 = as fast as possible")
+    parser.add_argument("--iterations",  type=int,
+                        help="The number of requests to time (default: 100, or each request in the replay once)")
+    parser.add_argument("--duration",    type=float, default=0,   help="Run for this many seconds instead of --iterations")
+    parser.add_argument("--warmup",      type=int,   default=2,   help="The number of requests to run, untimed, first")
+    parser.add_argument("--output",      help="A file to write the JSON report to")
+    return parser.parse_args(args)
+
+
+def _load_inputs(folder: str) -> "list[tuple[str, bytes]]":
+    """ Returns (content type, contents) for each file in the folder """
+    inputs = []
+    for file_name in sorted(os.listdir(folder)):
+        file_path = os.path.join(folder, file_name)
+        if os.path.isfile(file_path):
+            content_type, _ = mimetypes.guess_type(file_path)
+            with open(file_path, "rb") as file:
+                inputs.append((content_type or "application/octet-stream", file.read()))
+    return inputs
+
+
+def _load_capture(path: str) -> "tuple[list, list]":
+    """
+    Returns the requests in a capture file, and the time (in seconds since the
+    capture started) each arrived. quit, status and selftest requests are left
+    out as they aren't something we'd replay.
+    """
+    requests, offsets = [], []
+    for offset, request in RequestCapture.read(path):
+        command = (RequestData(request).command or "").lower()
+        if command not in ("quit", "status", "selftest"):
+            requests.append(request)
+            offsets.append(offset)
+
+    if offsets:
+        offsets = [ offset - offsets[0] for offset in offsets ]
+
+    return requests, offsets
+
+
+def _peak_rss_mb() -> float:
+    """ Returns the peak resident memory of this process in MB, if we can tell """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, macOS bytes
+        return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        memory_info = psutil.Process().memory_info()
+        return round(getattr(memory_info, "peak_wset", memory_info.rss) / (1024 * 1024), 1)
+    except Exception:
+        return None
+
+
+class ModuleBenchmark:
+
+    def __init__(self, module_runner, options: argparse.Namespace, inputs: list,
+                 requests: list = None, offsets: list = None) -> None:
+        """
+        inputs are (content type, contents) of the files to send, unless
+        requests (raw requests, as they came from the queue) are given, in which
+        case offsets are the times, in seconds, that each request arrived.
+        """
+        self.module_runner = module_runner
+        self.options       = options
+
+        self._frames       = list(requests or [])
+        self._offsets      = offsets
+        for index, (content_type, content) in enumerate(inputs if not requests else []):
+            request = {
+                "reqid":   f"benchmark-{index}",
+                "payload": {
+                    "queue":       module_runner.queue_name,
+                    "urlSegments": [],
+                    "command":     options.command,
+                    "values":      [ { "key": key, "value": [ value ] } for (key, value) in
+                                     [ entry.split("=", 1) for entry in options.value if "=" in entry ] ],
+                    "files":       [ { "name": "image", "contentType": content_type } ]
+                }
+            }
+            self._frames.append(RequestData.encode_frame(request, [ content ]))
+
+        module_runner.batch_size = options.batch_size
+        self._use_batches  = module_runner.batching_enabled
+        self._sent         = 0
+        self._deadline     = None
+        self._stats        = TimingStats(window_size = 1000000)
+        self._latencies    = []
+        self._errors       = 0
+
+    def _next_requests(self, count: int) -> "list[RequestData]":
+        """ Returns the next requests to send, or an empty list if we're done """
+        if self._deadline is not None:
+            if time.perf_counter() >= self._deadline:
+                return []
+        else:
+            count = min(count, self.options.iterations - self._sent)
+
+        requests = []
+        for _ in range(count):
+            requests.append(RequestData(self._frames[self._sent % len(self._frames)]))
+            self._sent += 1
+        return requests
+
+    async def _call(self, data_list: "list[RequestData]") -> list:
+        runner = self.module_runner
+        loop   = asyncio.get_running_loop()
+
+        if self._use_batches:
+            method, arg = runner.process_batch, data_list
+        else:
+            method, arg = runner.process, data_list[0]
+
+        if asyncio.iscoroutinefunction(method):
+            output = await method(arg)
+        else:
+            output = await loop.run_in_executor(runner._executor, method, arg)
+
+        return output if self._use_batches else [ output ]
+
+    async def _worker(self, record: bool) -> None:
+        batch_size = self.options.batch_size if self._use_batches else 1
+
+        while True:
+            data_list = self._next_requests(batch_size)
+            if not data_list:
+                break
+
+            start_time = time.perf_counter()
+            try:
+                outputs = await self._call(data_list)
+            except Exception as ex:
+                print(f"error: {ex.__class__.__name__}: {str(ex)}", file=sys.stderr)
+                outputs = [ None ] * len(data_list)
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+
+            if record:
+                self._record(data_list, outputs, elapsed_ms, elapsed_ms)
+
+    async def _timed_request(self, data: RequestData, due_time: float, slots: asyncio.Semaphore) -> None:
+        """ Sends a request that was due at due_time, once a slot is free """
+        async with slots:
+            start_time = time.perf_counter()
+            try:
+                outputs = await self._call([ data ])
+            except Exception as ex:
+                print(f"error: {ex.__class__.__name__}: {str(ex)}", file=sys.stderr)
+                outputs = [ None ]
+            end_time = time.perf_counter()
+
+        self._record([ data ], outputs, (end_time - start_time) * 1000, (end_time - due_time) * 1000)
+
+    async def _replay_timed(self) -> None:
+        """
+        Sends the requests at the times they were captured (scaled by speed)
+        rather than as fast as possible. Requests are sent whether or not
+        earlier requests have finished, up to concurrency at once.
+        """
+        slots      = asyncio.Semaphore(self.options.concurrency)
+        tasks      = []
+        start_time = time.perf_counter()
+        count      = len(self._frames)
+
+        while True:
+            if self._deadline is None and self._sent >= self.options.iterations:
+                break
+
+            # Go round again (offset by the length of the capture) if asked
+            # for more requests than were captured
+            index     = self._sent % count
+            repeat    = self._sent // count
+            offset    = self._offsets[index] + repeat * (self._offsets[-1] + 1)
+            due_time  = start_time + offset / self.options.speed
+            if self._deadline is not None and due_time >= self._deadline:
+                break
+
+            delay = due_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            data = RequestData(self._frames[index])
+            self._sent += 1
+            tasks.append(asyncio.create_task(self._timed_request(data, due_time, slots)))
+
+        await asyncio.gather(*tasks)
+
+    def _record(self, data_list: "list[RequestData]", outputs: list, process_ms: float,
+                latency_ms: float) -> None:
+        for data, output in zip(data_list, outputs or []):
+            if not isinstance(output, dict) or not output.get("success"):
+                self._errors += 1
+
+            data.timings.add("process", process_ms)
+            if "inference" not in data.timings.stages and isinstance(output, dict) \
+               and isinstance(output.get("inferenceMs"), (int, float)):
+                data.timings.add("inference", output["inferenceMs"])
+
+            self._stats.record_timings(data.command or self.options.command, data.timings)
+            self._latencies.append(latency_ms)
+
+    async def run(self) -> JSON:
+        options = self.options
+
+        # Warm up (eg let models load and caches fill) without timing
+        self._sent = 0
+        self._deadline = None
+        saved_iterations, options.iterations = options.iterations, options.warmup
+        await asyncio.gather(*[ self._worker(False) for _ in range(options.concurrency) ])
+        options.iterations = saved_iterations
+
+        self._sent = 0
+        if options.duration > 0:
+            self._deadline = time.perf_counter() + options.duration
+
+        start_time = time.perf_counter()
+        if self._offsets and options.speed > 0:
+            await self._replay_timed()
+        else:
+            await asyncio.gather(*[ self._worker(True) for _ in range(options.concurrency) ])
+        elapsed = time.perf_counter() - start_time
+
+        latencies = sorted(self._latencies)
+        runner    = self.module_runner
+
+        return {
+            "moduleId":          runner.module_id,
+            "command":           options.command if not options.replay else None,
+            "replay":            options.replay,
+            "speed":             options.speed if options.replay else None,
+            "executionProvider": runner.execution_provider or "CPU",
+            "system":            runner.system,
+            "cpuBrand":          runner.cpu_brand,
+            "inputs":            len(self._frames),
+            "concurrency":       options.concurrency,
+            "batchSize":         options.batch_size if self._use_batches else 1,
+            "requests":          len(latencies),
+            "errors":            self._errors,
+            "durationSecs":      round(elapsed, 2),
+            "throughput":        round(len(latencies) / elapsed, 2) if elapsed > 0 else 0,
+            "latencyMs": {
+                "mean": round(sum(latencies) / len(latencies), 1) if latencies else 0,
+                "p50":  round(TimingStats.percentile(latencies, 50), 1),
+                "p95":  round(TimingStats.percentile(latencies, 95), 1),
+                "p99":  round(TimingStats.percentile(latencies, 99), 1),
+                "max":  round(latencies[-1], 1) if latencies else 0
+            },
+            "peakRssMB":         _peak_rss_mb(),
+            "stages":            self._stats.summary() if options.replay else \
+                                 self._stats.summary().get(options.command, {})
+        }
+
+
+def run_benchmark(module_runner, args: list) -> JSON:
+    """
+    Initialises the module and benchmarks it as described by args (the command
+    line arguments after --benchmark). Prints, and returns, the report.
+    """
+    options = _parse_args(args)
+    options.concurrency = max(options.concurrency, 1)
+    options.batch_size  = max(options.batch_size, 1)
+
+    inputs, requests, offsets = [], None, None
+    if options.replay:
+        requests, offsets = _load_capture(options.replay)
+        if not requests:
+            print(f"error: No requests to replay in {options.replay}", file=sys.stderr)
+            return None
+    else:
+        input_dir = options.input or os.path.join(module_runner.module_path, "test")
+        inputs    = _load_inputs(input_dir) if os.path.isdir(input_dir) else []
+        if not inputs:
+            print(f"error: No input files found in {input_dir}", file=sys.stderr)
+            return None
+
+    if options.iterations is None:
+        options.iterations = len(requests) if requests else 100
+
+    async def benchmark() -> JSON:
+        module_runner._logger      = _ConsoleLogger()
+        module_runner.parallelism  = options.concurrency
+        module_runner._executor    = ThreadPoolExecutor(max_workers=options.concurrency,
+                                                        initializer=module_runner.apply_thread_budget)
+        try:
+            if asyncio.iscoroutinefunction(module_runner.initialise):
+                await module_runner.initialise()
+            else:
+                await asyncio.get_running_loop().run_in_executor(module_runner._executor,
+                                                                 module_runner.initialise)
+            module_runner.apply_thread_budget()
+
+            return await ModuleBenchmark(module_runner, options, inputs, requests, offsets).run()
+        finally:
+            module_runner._executor.shutdown(wait=False)
+
+    report = asyncio.run(benchmark())
+
+    report_json = json.dumps(report, indent=2)
+    print(report_json)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(report_json)
+
+    return report
@@ -36,7 +36,16 @@ class LogItem:
 
 class ModuleLogger():
 
-    def __init__(self, server_port: str, log_dir: str):
+    # The log levels of the entries that are dropped, before they're even
+    # queued, at each verbosity
+    _dropped_log_levels = {
+        LogVerbosity.Quiet: { "debug", "trace" },
+        LogVerbosity.Info:  { "debug" },
+        LogVerbosity.Loud:  set()
+    }
+
+    def __init__(self, server_port: str, log_dir: str,
+                 log_verbosity: LogVerbosity = LogVerbosity.Info):
 
         """
         Constructor
@@ -53,26 +62,41 @@ class ModuleLogger():
         self._cancelled          = False
         self._server_healthy     = True # We'll be optimistic to start
 
+        self.log_verbosity       = log_verbosity
+        self.max_batch_size      = 64   # The most entries handled (and sent to the server) in one go
+        self._batch_supported    = None # Whether the server takes batches. Found out on first try
+        self._log_file           = None # Kept open, and replaced each day
+        self._log_file_date      = None
+
 
     async def logging_loop(self):
 
         """ 
         Runs the main logging loop which queries the logging queue and then
-        forwards each logging request to the logging methods themselves.
+        forwards the logging requests to the logging methods themselves. Each
+        time around we take everything that's waiting in the queue (up to
+        max_batch_size entries) and handle it as a single batch.
         """
         async with aiohttp.ClientSession() as session:
             self._request_session = session
 
             while not self._cancelled:
                 try:
-                    log_item: LogItem = await self._logging_queue.get()
-                    await self.do_log(log_item.method, log_item.data)
+                    log_items = [ await self._logging_queue.get() ]
+                    while len(log_items) < self.max_batch_size and not self._logging_queue.empty():
+                        log_items.append(self._logging_queue.get_nowait())
+
+                    # A None item is just there to wake us up when cancelled
+                    log_items = [ log_item for log_item in log_items if log_item is not None ]
+                    if log_items:
+                        await self.do_log_batch(log_items)
                 except asyncio.CancelledError:
                     # task was canceled
                     pass
                 except Exception as ex:
                     print(f"Exception while logging: {ex}")
 
+            await self._close_log_file()
             self._request_session = None
 
     async def log_async (self, logMethod: LogMethod, data: JSON) -> None:
@@ -96,6 +120,9 @@ class ModuleLogger():
         # if not data or not data.get("message", ""):
         #    return
 
+        if not self._should_log(data):
+            return
+
         try:
             await self._logging_queue.put(LogItem(logMethod, data))
         except:
@@ -116,6 +143,9 @@ class ModuleLogger():
         # if not data or not data.get("message", ""):
         #     return
 
+        if not self._should_log(data):
+            return
+
         # Being really paranoid. The documentation suggests the Queue is not
         # thread safe but it appears to be ok without. Just to be safe ...
         with self._sync_log_lock:
@@ -129,6 +159,25 @@ class ModuleLogger():
         """ Cancels the main logging loop"""
         self._cancelled = True;
 
+        # Wake the logging loop in case it's waiting on an empty queue
+        try:
+            self._logging_queue.put_nowait(None)
+        except:
+            pass
+
+
+    def _should_log(self, data: JSON) -> bool:
+        """
+        Returns False if the entry is below the current verbosity (eg debug
+        entries when we're not being Loud) and so should be dropped
+        """
+        loglevel = data.get("loglevel", "information") if data else "information"
+        if not isinstance(loglevel, str):
+            return True
+
+        dropped_levels = self._dropped_log_levels.get(self.log_verbosity, { "debug" })
+        return loglevel.lower() not in dropped_levels
+
 
     async def do_log(self, logMethod: LogMethod, data: JSON) -> None:
 
@@ -149,6 +198,40 @@ class ModuleLogger():
 
         Only "message" is required.
         """
+        await self.do_log_batch([ LogItem(logMethod, data) ])
+
+
+    async def do_log_batch(self, log_items: "list[LogItem]") -> None:
+
+        """
+        Outputs a batch of log entries to the logging providers (see do_log).
+        The entries to be sent to the server are sent in a single request, and
+        the entries to be written to file are written in one go.
+        """
+
+        server_entries = []
+        file_lines     = []
+
+        for log_item in log_items:
+            self._prepare_log(log_item.method, log_item.data, server_entries, file_lines)
+
+        loggingTasks = []
+        if server_entries:
+            loggingTasks.append(asyncio.create_task(self._server_log_batch(server_entries)))
+        if file_lines:
+            loggingTasks.append(asyncio.create_task(self._file_log_lines(file_lines)))
+
+        # Wait for all the tasks that have now on the list of logging tasks
+        [await task for task in loggingTasks]
+
+
+    def _prepare_log(self, logMethod: LogMethod, data: JSON, server_entries: list,
+                     file_lines: list) -> None:
+
+        """
+        Writes a log entry to the console if need be, and adds it to the list
+        of entries to send to the server and / or the lines to write to file
+        """
 
         entry     = ""
 
@@ -193,12 +276,9 @@ class ModuleLogger():
         unimportant = message.startswith("Cannot connect to host")
 
         logged_to_server = False
-        loggingTasks = []
 
         if logMethod & LogMethod.Server or self.defaultLogging & LogMethod.Server:
-            log_task = asyncio.create_task(self._server_log(entry, process, 
-                                                            label, loglevel))
-            loggingTasks.append(log_task)
+            server_entries.append((entry, process, label, loglevel))
 
             # Note that the error may not actually be logged to server. Check 
             # self._server_healthy as well as logged_to_server to be sure.
@@ -234,12 +314,52 @@ class ModuleLogger():
         if not unimportant:
             if no_server_log and (logMethod & LogMethod.File or \
                self.defaultLogging & LogMethod.File):
-                loggingTasks.append( asyncio.create_task(self._file_log(process, method, 
-                                                                        filename, message,
-                                                                        exception)) )
-   
-        # Wait for all the tasks that have now on the list of logging tasks
-        [await task for task in loggingTasks]
+                file_lines.append(self._format_file_line(process, method, filename,
+                                                         message, exception))
+
+
+    async def _server_log_batch(self, server_entries: list) -> bool:
+
+        """
+        Sends a batch of log entries, each a tuple of (entry, category, label,
+        loglevel), to the API server in a single post. If the server doesn't
+        accept batches they're sent one at a time.
+        Returns True on success; False otherwise
+        """
+
+        if len(server_entries) > 1 and self._batch_supported != False:
+            payload = [ {
+                           "entry" : entry, 
+                           "category": category, 
+                           "label": label, 
+                           "log_level" : loglevel
+                        } for (entry, category, label, loglevel) in server_entries ]
+
+            try:
+                async with self._request_session.post(self.base_log_url + "batch",
+                                                      json = payload,
+                                                      timeout = 2) as resp:
+                    if resp.status == 200:
+                        self._batch_supported = True
+                        self._server_healthy  = True
+                        return True
+
+                    # An older server won't know this endpoint. We'll only
+                    # decide that the first time we try.
+                    if self._batch_supported is None and resp.status < 500:
+                        self._batch_supported = False
+                    else:
+                        self._server_healthy = False
+                        return False
+
+            except Exception as ex:
+                self._server_healthy = False
+                print(f"Error posting logs [{ex.__class__.__name__}]: {str(ex)}\n")
+                return False
+
+        results = await asyncio.gather(*[ self._server_log(*server_entry)
+                                          for server_entry in server_entries ])
+        return all(results)
 
 
     async def _server_log(self, entry : str, category: str, label: str, loglevel: str) -> bool:
@@ -312,6 +432,14 @@ class ModuleLogger():
                                 of an exception
         """
 
+        return await self._file_log_lines([ self._format_file_line(process, method, filename,
+                                                                   message, exception_type) ])
+
+
+    def _format_file_line(self, process: str, method: str, filename: str, message: str,
+                          exception_type: str) -> str:
+        """ Formats a log entry as a line in the log file """
+
         line = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         if len(exception_type) > 0:
             line += ' [' + exception_type + ']'      
@@ -324,22 +452,50 @@ class ModuleLogger():
             line += ')'
 
         line += '\n'
+        return line
+
+
+    async def _file_log_lines(self, lines: list) -> bool:
+        """
+        Writes lines to today's log file. The file is kept open between writes,
+        and when the date changes it's closed and the next day's file opened.
+        Returns True on success; False otherwise
+        """
 
         try:
-            directory = self.log_dir + os.sep + 'logs'
-            if not os.path.isdir(directory):
-                os.mkdir(directory)
+            today = datetime.now().strftime("%Y-%m-%d")
+            if self._log_file is None or self._log_file_date != today:
+                await self._close_log_file()
+
+                directory = self.log_dir + os.sep + 'logs'
+                if not os.path.isdir(directory):
+                    os.mkdir(directory)
 
-            filepath = directory + os.sep + 'log-' + datetime.now().strftime("%Y-%m-%d") + '.txt'
-            async with aiofiles.open(filepath, 'a') as file_object:
-                await file_object.write(line)
+                filepath = directory + os.sep + 'log-' + today + '.txt'
+                self._log_file      = await aiofiles.open(filepath, 'a')
+                self._log_file_date = today
+
+            await self._log_file.write("".join(lines))
+            await self._log_file.flush()
 
             return True
 
         except OSError as os_error:
             print(f"Unable to store log entry: {os_error.strerror}")
+            await self._close_log_file()
             return False
 
         except Exception as ex:
             print(f"Unable to write to the file log: {str(ex)}")
-            return False
\ No newline at end of file
+            await self._close_log_file()
+            return False
+
+
+    async def _close_log_file(self) -> None:
+        if self._log_file is not None:
+            try:
+                await self._log_file.close()
+            except Exception:
+                pass
+            self._log_file      = None
+            self._log_file_date = None
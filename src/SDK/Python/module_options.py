@@ -61,6 +61,71 @@ class ModuleOptions:
     # How much RAM is needed to perform tasks in this module?
     required_MB         = _get_env_var("CPAI_MODULE_REQUIRED_MB", "0");
 
+    # Whether to run the module's process method on threads ("thread") or in a
+    # pool of parallelism worker processes ("process"), each with its own copy
+    # of the module. Generally not specified, so don't use _get_env_var
+    execution_mode      = os.getenv("CPAI_MODULE_EXECUTION_MODE", "thread")
+
+    # How to talk to the server's queue: "http" (long-polling for commands and a
+    # post per response) or "websocket" (a single persistent connection for
+    # both, falling back to http if it can't be opened). Generally not specified,
+    # so don't use _get_env_var
+    transport           = os.getenv("CPAI_MODULE_TRANSPORT", "http")
+
+    # Dynamic batching. If batch_size > 1, and the module implements process_batch,
+    # then requests that arrive within batch_wait_ms of each other will be grouped
+    # and processed together. Generally not specified, so don't use _get_env_var
+    batch_size          = os.getenv("CPAI_MODULE_BATCH_SIZE",    "1")
+    batch_wait_ms       = os.getenv("CPAI_MODULE_BATCH_WAIT_MS", "10")
+
+    # The total number of CPU threads the module's inference libraries (torch,
+    # ONNX Runtime, Paddle) may use, split evenly between the parallel workers.
+    # 0 means use all cores. Generally not specified, so don't use _get_env_var
+    cpu_threads         = os.getenv("CPAI_MODULE_CPU_THREADS",   "0")
+
+    # The size (in MB) of the cache holding the results of recently processed
+    # requests, and how long (in seconds) a result stays in the cache. Only the
+    # commands a module says can be cached are cached. This is opt-in: the
+    # cache is off (0 MB) unless a size, eg 32, is set. Generally not
+    # specified, so don't use _get_env_var
+    result_cache_mb     = os.getenv("CPAI_MODULE_RESULT_CACHE_MB",  "0")
+    result_cache_secs   = os.getenv("CPAI_MODULE_RESULT_CACHE_SECS", "10")
+
+    # Frames sent with a camera_id value are compared to the last frame processed
+    # from the same camera, and if less than this percentage of the (downscaled)
+    # frame has changed, the last frame's result is reused. This is opt-in: a
+    # reused result can miss small or slow moving objects, so it's off (0)
+    # unless set, eg to 0.5. Generally not specified, so don't use _get_env_var
+    frame_gate_change   = os.getenv("CPAI_MODULE_FRAME_GATE_CHANGE", "0")
+
+    # How often (in seconds) to log a summary of the time taken to process each
+    # command. Per request timings are only logged if log_verbosity is Loud.
+    # 0 turns the summary off. Generally not specified, so don't use _get_env_var
+    timing_summary_secs = os.getenv("CPAI_MODULE_TIMING_SUMMARY_SECS", "60")
+
+    # If set, the raw requests taken from the queue are recorded to this (gzip
+    # compressed) file so they can be replayed with --benchmark --replay. The
+    # time the module started is added to the file's name, so a restart doesn't
+    # overwrite an earlier capture (see RequestCapture). Only capture_sample
+    # percent of requests are recorded, and recording stops when the file
+    # reaches capture_max_mb. Generally not specified, so don't use _get_env_var
+    capture_file        = os.getenv("CPAI_MODULE_CAPTURE_FILE",   "")
+    capture_sample      = os.getenv("CPAI_MODULE_CAPTURE_SAMPLE", "100")
+    capture_max_mb      = os.getenv("CPAI_MODULE_CAPTURE_MAX_MB", "500")
+
+    # The most requests taken from the server's queue that may be waiting for or
+    # being processed at once. We stop taking requests at this point and leave
+    # them on the server's queue. 0 means one per worker. Requests that have
+    # waited here for more than max_queue_ms get a quick "overloaded" response
+    # rather than being processed late. 0 turns this off.
+    # Generally not specified, so don't use _get_env_var
+    max_in_flight       = os.getenv("CPAI_MODULE_MAX_IN_FLIGHT", "0")
+    max_queue_ms        = os.getenv("CPAI_MODULE_MAX_QUEUE_MS",  "0")
+
+    # How many tasks poll the server's queue on behalf of the worker tasks. 
+    # Generally not specified, so don't use _get_env_var
+    poller_count        = os.getenv("CPAI_MODULE_POLLERS",       "1")
+
     # Whether to *allow* support for GPU. Doesn't mean it's possibly it can or will
     # support GPU. More often used to disable GPU when a GPU causes problems
     support_GPU         = _get_env_var("CPAI_MODULE_SUPPORT_GPU", "True")
@@ -102,7 +167,58 @@ class ModuleOptions:
     elif not isinstance(log_verbosity, LogVerbosity):
         log_verbosity = LogVerbosity.Info
 
-    parallelism = int(parallelism) if isinstance(parallelism, int) else 0
+    # Parallelism arrives as a string. Before it was parsed here, the setting
+    # was silently ignored and every module ran with the default below, so a
+    # module whose modulesettings.json sets Parallelism now really gets that
+    # many workers (and threads)
+    parallelism = int(parallelism) if str(parallelism).isnumeric() else 0
     if parallelism <= 0:
         # parallelism = os.cpu_count() - 1
-        parallelism = os.cpu_count() // 2
+        parallelism = max(os.cpu_count() // 2, 1)
+
+    execution_mode = str(execution_mode).lower()
+    if execution_mode not in [ "thread", "process" ]:
+        execution_mode = "thread"
+
+    transport = str(transport).lower()
+    if transport not in [ "http", "websocket" ]:
+        transport = "http"
+
+    cpu_threads = int(cpu_threads) if str(cpu_threads).isnumeric() else 0
+    if cpu_threads <= 0:
+        cpu_threads = os.cpu_count()
+
+    batch_size    = int(batch_size)    if str(batch_size).isnumeric()    else 1
+    batch_wait_ms = int(batch_wait_ms) if str(batch_wait_ms).isnumeric() else 10
+    batch_size    = max(batch_size, 1)
+    poller_count  = max(int(poller_count), 1) if str(poller_count).isnumeric() else 1
+
+    result_cache_mb   = int(result_cache_mb)   if str(result_cache_mb).isnumeric()   else 0
+    result_cache_secs = int(result_cache_secs) if str(result_cache_secs).isnumeric() else 10
+
+    timing_summary_secs = int(timing_summary_secs) if str(timing_summary_secs).isnumeric() else 60
+
+    max_in_flight = int(max_in_flight) if str(max_in_flight).isnumeric() else 0
+    max_queue_ms  = int(max_queue_ms)  if str(max_queue_ms).isnumeric()  else 0
+
+    try:
+        frame_gate_change = max(float(frame_gate_change), 0.0)
+    except ValueError:
+        frame_gate_change = 0.0
+
+    try:
+        capture_sample = min(max(float(capture_sample), 0.0), 100.0)
+    except ValueError:
+        capture_sample = 100.0
+    capture_max_mb = int(capture_max_mb) if str(capture_max_mb).isnumeric() else 500
+
+
+# Limit the size of the thread pools the inference libraries (OpenMP, MKL,
+# OpenBLAS) create for themselves, so that parallelism workers x threads each
+# doesn't exceed our CPU thread budget (see ModuleRunner.threads_per_worker).
+# The libraries only read these when they're loaded, so they're set here:
+# modules import the SDK before they import their inference library. Anything
+# that's been set explicitly is left alone.
+for _env_var in [ "OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS" ]:
+    if not os.getenv(_env_var):
+        os.environ[_env_var] = str(max(ModuleOptions.cpu_threads // ModuleOptions.parallelism, 1))
@@ -0,0 +1,254 @@
+"""
+Runs a module's process (or process_batch) method in a pool of worker
+processes rather than on threads in the module's own process. This gets around
+the GIL for modules that do a lot of CPU-bound work in Python (image crops,
+per-detection loops, OCR glue code) at the cost of each worker process holding
+its own copy of the module's models.
+
+The async loop that talks to the server stays in the parent process. The
+parent decodes the files (images) in each request and places the raw bytes in a
+shared memory block, so the worker process can read the bytes directly rather
+than having a base64 string pickled over and then decoded all over again.
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import multiprocessing.util
+from multiprocessing import shared_memory
+
+from common import JSON
+from request_data import RequestData
+
+
+# The module instance (and its event loop) owned by a worker process
+_worker_module = None
+_worker_loop   = None
+
+
+class _WorkerLogger:
+    """
+    Stands in for the ModuleLogger in a worker process. There is no logging
+    loop in a worker, so log entries are collected and handed back to the
+    parent process along with the result of each call, and the parent logs them.
+    """
+    def __init__(self):
+        self.entries = []
+
+    def log(self, log_method, data: JSON) -> None:
+        self.entries.append((log_method, data))
+
+    async def log_async(self, log_method, data: JSON) -> None:
+        self.log(log_method, data)
+
+    def cancel_logging(self) -> None:
+        pass
+
+    def take_entries(self) -> list:
+        entries, self.entries = self.entries, []
+        return entries
+
+
+class SharedFiles:
+    """
+    The decoded contents of the files in a set of requests, held in a single
+    shared memory block. Only the name of the block and the offset and length
+    of each file are sent to the worker process.
+    """
+
+    def __init__(self, data_list: "list[RequestData]"):
+
+        self.shared_mem = None
+        self.requests   = []
+
+        contents = []
+        offset   = 0
+        for data in data_list:
+            payload = dict(data.payload)
+            extents = []
+            for index in range(len(data.files or [])):
+                content = data.get_file_bytes(index) or b""
+                contents.append(content)
+                extents.append((offset, len(content)))
+                offset += len(content)
+
+            # The worker gets the request minus the (base64) file data. The
+            # rest of each file's details (eg filename, contentType) go as is
+            payload["files"] = [ { key: value for key, value in file.items() if key not in ("data", "bytes") }
+                                 for file in (data.files or []) ]
+            self.requests.append((json.dumps({ "reqid": data.request_id, "payload": payload }),
+                                  extents))
+
+        if offset > 0:
+            self.shared_mem = shared_memory.SharedMemory(create=True, size=offset)
+            offset = 0
+            for content in contents:
+                self.shared_mem.buf[offset:offset + len(content)] = content
+                offset += len(content)
+
+    @property
+    def name(self) -> str:
+        return self.shared_mem.name if self.shared_mem else None
+
+    def close(self) -> None:
+        if self.shared_mem:
+            self.shared_mem.close()
+            self.shared_mem.unlink()
+            self.shared_mem = None
+
+
+def _read_shared_files(shared_mem_name: str, requests: list) -> "list[RequestData]":
+    """ Rebuilds the requests inside a worker process """
+
+    shared_mem = shared_memory.SharedMemory(name=shared_mem_name) if shared_mem_name else None
+    try:
+        data_list = []
+        for (request_json, extents) in requests:
+            data = RequestData(request_json)
+            for index, (offset, length) in enumerate(extents):
+                # Copy out so nothing refers to the block once we've closed it
+                data.files[index]["bytes"] = bytes(shared_mem.buf[offset:offset + length])
+            data_list.append(data)
+        return data_list
+    finally:
+        if shared_mem:
+            shared_mem.close()
+
+
+def _run_sync(method, *args) -> any:
+    """ Calls a module method in a worker process, whether it's async or not """
+    if asyncio.iscoroutinefunction(method):
+        return _worker_loop.run_until_complete(method(*args))
+    return method(*args)
+
+
+def _init_worker(module_class: type) -> None:
+    """ Creates and initialises the module in a newly started worker process """
+
+    global _worker_module, _worker_loop
+
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+
+    module = module_class()
+    module._logger = _WorkerLogger()
+
+    _run_sync(module.initialise)
+    module.apply_thread_budget()
+
+    _worker_module = module
+
+    # Workers exit (normally) when the pool is shut down, and the module gets
+    # to clean up on the way out
+    multiprocessing.util.Finalize(None, _shutdown_worker, exitpriority=10)
+
+
+def _shutdown_worker() -> None:
+    """ Shuts down the module in a worker process as the process exits """
+    if _worker_module is not None:
+        _run_sync(_worker_module.shutdown)
+
+
+def _get_worker_properties() -> "tuple[JSON, list]":
+    """
+    Returns the values of the module's worker_properties, as set by
+    initialise, plus the log entries the worker has made so far
+    """
+    properties = { name: getattr(_worker_module, name, None)
+                   for name in getattr(_worker_module, "worker_properties", []) }
+    return properties, _worker_module._logger.take_entries()
+
+
+def _call_worker(method_name: str, shared_mem_name: str, requests: list) -> "tuple[any, list, list]":
+    """
+    Calls the given module method (process, process_batch, or a command such
+    as selftest) in a worker process. Returns the output, the log
+    entries made, and the stage timings recorded for each request.
+    """
+
+    data_list = _read_shared_files(shared_mem_name, requests)
+    method    = getattr(_worker_module, method_name)
+
+    if method_name == "process_batch":
+        output = _run_sync(method, data_list)
+    else:
+        output = _run_sync(method, data_list[0])
+
+    timings = [ data.timings.stages for data in data_list ]
+    return output, _worker_module._logger.take_entries(), timings
+
+
+class ModuleProcessPool:
+    """
+    A pool of worker processes, each with its own instance of the module class
+    that has been initialised via initialise().
+    """
+
+    def __init__(self, module_class: type, worker_count: int):
+        self.module_class = module_class
+        self.worker_count = worker_count
+        self.properties   = {}   # As reported by the workers once started
+
+        # Spawn rather than fork: forking a process that already has threads
+        # running (ours, and torch's / ONNX's) is asking for trouble.
+        self._executor = ProcessPoolExecutor(max_workers=worker_count,
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_worker,
+                                             initargs=(module_class,))
+
+    async def start(self) -> "tuple[JSON, list]":
+        """
+        Starts each worker process and waits for the module in each to be
+        initialised. Returns the module properties (eg execution provider) as
+        reported by the workers, plus the log entries they made along the way.
+        """
+        loop    = asyncio.get_running_loop()
+        results = await asyncio.gather(*[ loop.run_in_executor(self._executor, _get_worker_properties)
+                                          for _ in range(self.worker_count) ])
+
+        self.properties = results[0][0]
+        log_entries     = [ entry for (_, entries) in results for entry in entries ]
+        return self.properties, log_entries
+
+    def status(self) -> JSON:
+        """
+        The status of the module, from what the workers reported when they
+        started. This is answered here rather than by a worker, where a status
+        request would have to wait behind whatever work is queued.
+        """
+        return {
+            "success":       True,
+            "executionMode": "process",
+            "workers":       self.worker_count,
+            "processorType": self.properties.get("processor_type"),
+            "canUseGPU":     self.properties.get("can_use_GPU")
+        }
+
+    async def call(self, method_name: str, data_list: "list[RequestData]") -> "tuple[any, list]":
+        """
+        Calls the given module method (eg process or process_batch) in one of
+        the worker processes. Returns the method's output and the log entries made
+        by the worker while processing. The stage timings recorded in the
+        worker are added to each request's timings.
+        """
+        loop         = asyncio.get_running_loop()
+        shared_files = SharedFiles(data_list)
+        try:
+            output, log_entries, timings = await loop.run_in_executor(self._executor, _call_worker,
+                                                                      method_name, shared_files.name,
+                                                                      shared_files.requests)
+        finally:
+            shared_files.close()
+
+        for data, stages in zip(data_list, timings):
+            data.timings.merge(stages)
+
+        return output, log_entries
+
+    def shutdown(self) -> None:
+        """
+        Stops the worker processes once they've finished what they're doing.
+        Each calls its module's shutdown() as it exits (see _init_worker).
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -1,5 +1,6 @@
 
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 import platform
@@ -32,6 +33,14 @@ from common import JSON, check_installed_packages
 from module_logging import LogMethod, ModuleLogger, LogVerbosity
 from request_data   import RequestData
 from module_options import ModuleOptions
+from module_process_pool import ModuleProcessPool
+from response_sender import ResponseSender
+from result_cache import ResultCache
+from frame_gate import FrameGate
+from timing_stats import TimingStats
+from module_benchmark import run_benchmark
+from request_capture import RequestCapture
+from websocket_transport import WebSocketTransport
 
 class ModuleRunner:
     """
@@ -57,6 +66,42 @@ class ModuleRunner:
         """
         pass
 
+    def process_batch(self, data_list: "list[RequestData]") -> "list[JSON]":
+        """
+        Called with a batch of requests retrieved from this module's queue when
+        batching is enabled (batch_size > 1). Override this in child classes
+        that can process several requests in one pass (eg a single batched
+        forward pass through a model). Batching is only used if a child class
+        overrides this method.
+
+        self      - This ModuleRunner
+        data_list - The list of RequestData objects to be processed
+        returns: A list of JSON packages, one per request, in the same order as
+                 the requests in data_list.
+        """
+        return [ self.process(data) for data in data_list ]
+
+    def is_control_command(self, data: RequestData) -> bool:
+        """
+        Is this request for a cheap control command (eg status, or listing the
+        models available) rather than for inference? Control commands are
+        handled on a lane of their own so they stay fast when the module is
+        busy. By default these are the commands in control_commands.
+        """
+        return (data.command or "").lower() in self.control_commands
+
+    def can_cache_result(self, data: RequestData) -> bool:
+        """
+        Called to decide whether the result of processing a request may be
+        cached and reused for identical requests (see ResultCache). By default
+        only the commands listed in self.cached_commands are cached. Override
+        this in child classes that need finer control. Anything whose result
+        depends on more than the request itself (eg recognising a face against
+        the faces registered so far), or that changes state (eg registering a
+        face), must not be cached.
+        """
+        return data.command in self.cached_commands
+
     def status(self, data: RequestData = None) -> JSON:
         """
         Called when this module has been asked to provide its current status.
@@ -144,12 +189,35 @@ class ModuleRunner:
         self.accel_device_name   = ModuleOptions.accel_device_name
         self.half_precision      = ModuleOptions.half_precision
         self.parallelism         = ModuleOptions.parallelism
+        self.batch_size          = ModuleOptions.batch_size
+        self.batch_wait_ms       = ModuleOptions.batch_wait_ms
+        self.poller_count        = ModuleOptions.poller_count
+        self.cpu_threads         = ModuleOptions.cpu_threads
+        self.execution_mode      = ModuleOptions.execution_mode
+        self.transport           = ModuleOptions.transport
+        self.result_cache_mb     = ModuleOptions.result_cache_mb
+        self.result_cache_secs   = ModuleOptions.result_cache_secs
+        self.frame_gate_change   = ModuleOptions.frame_gate_change
+        self.timing_summary_secs = ModuleOptions.timing_summary_secs
+        self.capture_file        = ModuleOptions.capture_file
+        self.capture_sample      = ModuleOptions.capture_sample
+        self.capture_max_mb      = ModuleOptions.capture_max_mb
+        self.max_in_flight       = ModuleOptions.max_in_flight
+        self.max_queue_ms        = ModuleOptions.max_queue_ms
+        self.cached_commands     = [] # Commands whose results may be cached. Set by the module
+        self.control_commands    = ["status", "list-custom", "list"] # Cheap commands. See control_loop
         self.processor_type      = "CPU" # may be overridden by the module
         self.cpu_brand           = ""
         self.cpu_vendor          = ""
         self.cpu_arch            = ""
         self.can_use_GPU         = False # Whether or not this module provides GPU support for the current hardware
 
+        # What initialise may set that the runner itself needs. In process mode
+        # initialise only runs in the worker processes, so these are copied
+        # back from them. A module whose initialise sets anything else the
+        # runner uses should add it to this list in its __init__
+        self.worker_properties   = [ "_execution_provider", "processor_type", "can_use_GPU", "queue_name" ]
+
         # General purpose flags. These aren't currently supported as common flags
         # self.use_CUDA          = ModuleOptions.use_CUDA
         # self.use_ROCm          = ModuleOptions.use_ROCm
@@ -210,6 +278,28 @@ class ModuleRunner:
 
         # Private fields
         self._base_queue_url = self.base_api_url + "queue/"
+        self._request_queue  = None   # Local queue of requests fetched from the server
+        self._prefetch_slots = None   # Limits prefetching to what the workers can absorb
+        self._worker_count   = 0
+        self._poller_tasks   = []
+        self._batch_queue    = None
+        self._batch_tasks    = []
+        self._executor       = None   # Runs the synchronous module methods
+        self._process_pool   = None   # Runs process in worker processes if execution_mode = process
+        self._response_sender = None  # Sends responses back to the server
+        self._websocket       = None  # Used instead of HTTP if transport = websocket
+        self._result_cache    = None  # Results of recent requests, if result_cache_mb > 0
+        self._frame_gate      = None  # Spots near duplicate frames, if frame_gate_change > 0
+        self._timing_stats    = TimingStats()  # Rolling stats on the time spent in each stage
+        self._interval_stats  = TimingStats(window_size = 10000)  # Command times since the last summary
+        self._summary_task    = None
+        self._capture         = None  # Records the requests we take, if capture_file is set
+        self._expired_count   = 0     # Requests whose client had gone before we got to them
+        self._overloaded_count = 0    # Requests turned away as we couldn't get to them in time
+        self._control_executor = None # Runs control commands so they don't wait for inference
+        self._control_task    = None  # Takes requests from the control lane
+        self._control_lane_supported = True  # Until the server shows otherwise
+        self._fetch_ms        = {}    # poller ID => time spent reading the last request fetched
 
     @property
     def hasTorchCuda(self) -> bool:
@@ -449,6 +539,56 @@ class ModuleRunner:
         if self._execution_provider != "CPU":
             self.processor_type = "GPU"
 
+    @property
+    def batching_enabled(self) -> bool:
+        """
+        Is dynamic batching enabled? This requires a batch size > 1 and that
+        the module has provided its own process_batch method.
+        """
+        return self.batch_size > 1 and \
+               type(self).process_batch is not ModuleRunner.process_batch
+
+
+    @property
+    def threads_per_worker(self) -> int:
+        """
+        The number of CPU threads each parallel worker can give to its 
+        inference library, so that all workers together stay within our CPU
+        thread budget.
+        """
+        return max(self.cpu_threads // max(self.parallelism, 1), 1)
+
+    def onnx_session_options(self) -> any:
+        """
+        Returns an onnxruntime SessionOptions object whose thread pools are 
+        sized to this worker's share of the CPU thread budget. Pass this to 
+        InferenceSession instead of relying on ONNX Runtime's defaults, which
+        assume the whole machine is theirs.
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads_per_worker
+        options.inter_op_num_threads = 1
+        return options
+
+    def apply_thread_budget(self) -> None:
+        """
+        Sets the number of threads torch will use for intra-op work. This is
+        called on each of our executor's threads as they start, and once after
+        initialise. Paddle and ONNX Runtime take their thread count when a
+        predictor / session is created: see threads_per_worker and
+        onnx_session_options. The OpenMP, MKL and OpenBLAS pools are limited
+        when the SDK is first imported (see module_options).
+        """
+        # Only if the module has actually loaded torch. No point loading it here.
+        if "torch" in sys.modules:
+            try:
+                import torch
+                torch.set_num_threads(self.threads_per_worker)
+            except Exception:
+                pass
+
 
     def start_loop(self) -> None:
         """
@@ -468,12 +608,20 @@ class ModuleRunner:
         # just fragile.
 
         if len(sys.argv) > 1 and sys.argv[1] == "--selftest":
-            self._logger = ModuleLogger(self.port, self.server_root_path)
+            self._logger = ModuleLogger(self.port, self.server_root_path, self.log_verbosity)
             self.initialise()
             self.check_packages()
             self.selftest()
             quit()
 
+        # BENCHMARK:
+        # Times the module's process method, in-process, against the files in
+        # its test folder and reports throughput and latency. See
+        # module_benchmark.py for the options.
+        if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+            run_benchmark(self, sys.argv[2:])
+            quit()
+
         # No smoke test, so on to the main show
 
         try:
@@ -517,11 +665,40 @@ class ModuleRunner:
         """
         async with aiohttp.ClientSession() as session:
             self._request_session = session
-            self._logger          = ModuleLogger(self.port, self.server_root_path)
+            self._logger          = ModuleLogger(self.port, self.server_root_path, self.log_verbosity)
+
+            # Our own executor for synchronous module methods, sized to the
+            # number of workers we'll run, rather than asyncio's default
+            # executor which knows nothing about our parallelism setting
+            self._executor = ThreadPoolExecutor(max_workers=self.parallelism,
+                                                thread_name_prefix=self.module_id,
+                                                initializer=self.apply_thread_budget)
 
             # Start with just running one logging loop
             logging_task = asyncio.create_task(self._logger.logging_loop())
 
+            if self.result_cache_mb > 0:
+                self._result_cache = ResultCache(self.result_cache_mb * 1024 * 1024,
+                                                 self.result_cache_secs)
+            if self.frame_gate_change > 0:
+                self._frame_gate = FrameGate(self.frame_gate_change / 100.0)
+            if self.capture_file and self.capture_sample > 0:
+                self._capture = RequestCapture(self.capture_file, self.capture_sample / 100.0,
+                                               self.capture_max_mb * 1024 * 1024)
+                self._logger.log(LogMethod.Info | LogMethod.Server,
+                {
+                    "filename": __file__,
+                    "loglevel": "information",
+                    "method":   "main_init",
+                    "message":  f"Recording requests to {self._capture.path}"
+                })
+
+            # and the loop that sends the responses back to the server
+            self._response_sender = ResponseSender(session, self._base_queue_url,
+                                                   max_in_flight = max(self.parallelism, 2))
+            self._response_sender.timing_stats = self._timing_stats
+            sending_task = asyncio.create_task(self._response_sender.sending_loop())
+
             # Call the init callback if available
             if True : # self.init_callback:
                 self._logger.log(LogMethod.Info | LogMethod.Server,
@@ -535,166 +712,606 @@ class ModuleRunner:
                 # Overriding issue here: We need to await self.initialise in the
                 # asyncio loop. This means we can't just 'await self.initialise'
 
-                if asyncio.iscoroutinefunction(self.initialise):
-                    # if initialise is async, then it's a coroutine. In this
-                    # case we create an awaitable asyncio task to execute this
-                    # method.
-                    init_task = asyncio.create_task(self.initialise())
+                if self.execution_mode == "process":
+                    # Each worker process creates and initialises its own copy
+                    # of this module. We stay here and hand the work to them.
+                    self._process_pool = ModuleProcessPool(type(self), self.parallelism)
+                    properties, log_entries = await self._process_pool.start()
+                    for name, value in properties.items():
+                        setattr(self, name, value)
+                    for (log_method, log_data) in log_entries:
+                        self.log(log_method, log_data)
                 else:
-                    # If the method is not async, then we wrap it in an awaitable
-                    # method which we await.
-                    loop = asyncio.get_running_loop()
-                    init_task = loop.run_in_executor(None, self.initialise)
+                    if asyncio.iscoroutinefunction(self.initialise):
+                        # if initialise is async, then it's a coroutine. In this
+                        # case we create an awaitable asyncio task to execute this
+                        # method.
+                        init_task = asyncio.create_task(self.initialise())
+                    else:
+                        # If the method is not async, then we wrap it in an awaitable
+                        # method which we await.
+                        loop = asyncio.get_running_loop()
+                        init_task = loop.run_in_executor(self._executor, self.initialise)
+
+                    await init_task
 
-                await init_task
+                    # initialise will typically have loaded the inference library
+                    self.apply_thread_budget()
 
             sys.stdout.flush()
 
-            # Add main processing loop tasks
-            tasks = [ asyncio.create_task(self.main_loop(task_id)) for task_id in range(self.parallelism) ]
+            # Add the task(s) that poll the server's queue and feed our local
+            # queue, and the worker tasks that process what's in that queue.
+            # If batching, each worker simply hands its request to a batch loop
+            # and waits, so we need enough workers to fill parallelism batches.
+            self._worker_count = self.parallelism
+            if self.batching_enabled:
+                self._worker_count = self.parallelism * self.batch_size
+
+            self._request_queue  = asyncio.Queue()
+            self._prefetch_slots = asyncio.Semaphore(self.max_in_flight or self._worker_count)
+
+            self._poller_tasks = [ asyncio.create_task(self.queue_loop(poller_id))
+                                   for poller_id in range(self.poller_count) ]
+            tasks = [ asyncio.create_task(self.main_loop(task_id)) for task_id in range(self._worker_count) ]
+            tasks.extend(self._poller_tasks)
+
+            # and the task that takes control commands from their own lane
+            self._control_executor = ThreadPoolExecutor(max_workers=1, initializer=self.apply_thread_budget)
+            self._control_task     = asyncio.create_task(self.control_loop())
+            tasks.append(self._control_task)
+
+            # If batching, add the tasks that gather requests into batches
+            if self.batching_enabled:
+                self._batch_queue = asyncio.Queue()
+                self._batch_tasks = [ asyncio.create_task(self.batch_loop()) 
+                                      for _ in range(self.parallelism) ]
+                tasks.extend(self._batch_tasks)
 
             sys.stdout.flush()
 
-            # combine
-            tasks.append(logging_task)
+            # If requested, open the WebSocket to the queue. We do this after
+            # initialise so the socket's URL includes our execution provider.
+            websocket_task = None
+            if self.transport == "websocket":
+                ws_url = self._base_queue_url.replace("http://", "ws://") + self.queue_name + \
+                         "/ws" + self._response_url_params() + "&binary=true"
+                self._websocket = WebSocketTransport(session, ws_url)
+                if await self._websocket.connect():
+                    self._response_sender.transport = self._websocket
+                    websocket_task = asyncio.create_task(self._websocket.receive_loop())
+                else:
+                    self._websocket = None
+                    await self.log_async(LogMethod.Info | LogMethod.Server, {
+                        "message":  f"Unable to open a WebSocket to the {self.queue_name} queue. Using HTTP",
+                        "loglevel": "warning"
+                    })
 
             await self.log_async(LogMethod.Info | LogMethod.Server, {
                         "message": self.module_name + " started.",
                         "loglevel": "trace"
                     })
 
+            if self.timing_summary_secs > 0:
+                self._summary_task = asyncio.create_task(self.timing_summary_loop())
+
             await asyncio.gather(*tasks)
+
+            if self._summary_task:
+                self._summary_task.cancel()
+
+            # Make sure the last of the responses get out before we go
+            await self._response_sender.close()
+            await sending_task
+            if websocket_task:
+                await self._websocket.close()
+                await websocket_task
+            await logging_task
+
+            if self._capture:
+                self._capture.close()
+
             self._request_session = None
 
+            self._executor.shutdown(wait=False)
+            self._control_executor.shutdown(wait=False)
+            if self._process_pool:
+                self._process_pool.shutdown()
+
+
+    async def queue_loop(self, poller_id) -> None:
+        """
+        Continually polls the server's queue for this module and places each
+        request retrieved onto our local request queue, where it will be picked
+        up by the main loop (worker) tasks. We only poll for a new request when
+        there is a worker slot available to handle it, so we never pull more
+        requests off the server than we can actually process. This leaves
+        requests on the server's queue where other modules servicing the same
+        queue can pick them up.
+        """
+
+        try:
+            while not self._cancelled:
+                # Backpressure: wait until a worker slot is free
+                await self._prefetch_slots.acquire()
+
+                queue_entries: list = await self.get_command(poller_id)
+                if len(queue_entries) == 0 or self._cancelled:
+                    self._prefetch_slots.release()
+                    continue
+
+                # Along with each request goes how long it took to fetch, and
+                # when it was fetched so we know how long it waited for a worker
+                fetched_at = time.perf_counter()
+                fetch_ms   = self._fetch_ms.pop(poller_id, None)
+
+                # In theory we may get back multiple command requests. In 
+                # practice it's always just 1 at a time. At the moment.
+                for index, queue_entry in enumerate(queue_entries):
+                    if index > 0:
+                        await self._prefetch_slots.acquire()
+                    await self._request_queue.put((queue_entry, fetch_ms, fetched_at))
+
+        except asyncio.CancelledError:
+            pass
+
+
+    async def control_loop(self) -> None:
+        """
+        Takes control commands (eg status, list-custom) from the control lane
+        of the server's queue and handles them straight away on a thread of
+        their own. These requests don't wait behind the inference requests in
+        the server's queue or for a free worker, so a dashboard polling for
+        status gets a quick answer even when every worker is busy.
+        """
+        try:
+            while not self._cancelled:
+                queue_entries: list = await self.get_command("control", lane="control")
+                fetched_at = time.perf_counter()
+                fetch_ms   = self._fetch_ms.pop("control", None)
+
+                if not self._control_lane_supported:
+                    # An older server: it sent us the next request in the queue
+                    # whatever it was. Hand that to the workers like any other
+                    # and leave the queue to the pollers from now on.
+                    for queue_entry in queue_entries:
+                        await self._prefetch_slots.acquire()
+                        await self._request_queue.put((queue_entry, fetch_ms, fetched_at))
+                    break
+
+                for queue_entry in queue_entries:
+                    if not await self.handle_request(queue_entry, fetch_ms, fetched_at, control=True):
+                        return
+
+        except asyncio.CancelledError:
+            pass
+
+
+    async def timing_summary_loop(self) -> None:
+        """
+        Every timing_summary_secs, logs the number of requests for each command
+        since the last summary, along with the mean and percentile times taken.
+        This replaces logging the time taken for every single request, which
+        under load means a lot of log traffic.
+        """
+        try:
+            while not self._cancelled:
+                await asyncio.sleep(self.timing_summary_secs)
+
+                interval_stats, self._interval_stats = self._interval_stats, TimingStats(window_size = 10000)
+
+                summary = interval_stats.summary()
+                if not summary:
+                    continue
+
+                command_summaries = []
+                for command, stages in summary.items():
+                    total = stages["total"]
+                    command_summaries.append(f"'{command}' x{total['count']}: mean {total['mean']:.0f}ms, " +
+                                             f"p50 {total['p50']:.0f}ms, p95 {total['p95']:.0f}ms, " +
+                                             f"p99 {total['p99']:.0f}ms")
+
+                await self.log_async(LogMethod.Info | LogMethod.Server, {
+                    "message":  f"Timings over the last {self.timing_summary_secs}s: " + "; ".join(command_summaries),
+                    "loglevel": "information",
+                    "label":    "command timing"
+                })
+
+        except asyncio.CancelledError:
+            pass
+
+
+    def stop_loops(self) -> None:
+        """
+        Stops the queue polling, worker and batching loops so the module can
+        shut down
+        """
+        self._cancelled = True
+
+        for task in self._poller_tasks + self._batch_tasks:
+            task.cancel()
+
+        if self._control_task:
+            self._control_task.cancel()
+
+        if self._summary_task:
+            self._summary_task.cancel()
+
+        # Wake up any workers waiting on the local queue so they can exit
+        for _ in range(self._worker_count):
+            self._request_queue.put_nowait(None)
+
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The number of requests pulled from the server that are waiting in our
+        local queue for a free worker
+        """
+        return self._request_queue.qsize() if self._request_queue else 0
+
 
     # Main loop
     async def main_loop(self, task_id) -> None:
         """
-        This is the main request processing loop. This method continually polls
-        the queue that this module is servicing, and each time it sees a request
-        it will grab the request data, send it to the `process` method, then
-        gather the results and post them back to the queue. The server is 
-        responsible for placing requests from the calling client onto the queue,
-        and then taking responses off the queue and returning them to the client.
+        This is the main request processing loop. This method continually takes
+        requests from the local request queue (which is fed by queue_loop), and
+        each time it sees a request it will grab the request data, send it to
+        the `process` method, then gather the results and post them back to the
+        queue. The server is responsible for placing requests from the calling
+        client onto the queue, and then taking responses off the queue and 
+        returning them to the client.
 
         Special requests, such as quit, status and selftest are handled 
-        carefully.
+        carefully. See handle_request.
         """
 
-        get_command_task = asyncio.create_task(self.get_command(task_id))
-        send_response_task = None
-
         while not self._cancelled:
-            queue_entries: list = await get_command_task
+            queue_item = await self._request_queue.get()
+
+            # A None entry means we're shutting down
+            if queue_item is None:
+                break
+
+            try:
+                if not await self.handle_request(*queue_item):
+                    break
+            finally:
+                # This worker is now free to take on another request
+                self._prefetch_slots.release()
+
+        # Cleanup. In process mode the workers' modules are shut down along
+        # with the pool
+        if self._process_pool is None:
+            self.shutdown()
+
+        # method is ending. Let's clean up. self._cancelled == True at this point.
+        self._logger.cancel_logging()
+
+
+    async def handle_request(self, queue_entry: any, fetch_ms: float, fetched_at: float,
+                             control: bool = False) -> bool:
+        """
+        Handles a single request taken from the queue: calls the module to
+        process it (or the status, selftest or quit handlers) and queues the
+        response to be sent back. If control is True the request came from the
+        control lane, and is handled on a thread of its own (see control_loop).
+        Returns False if the request was to quit.
+        """
+        suppress_timing_log = False
+
+        if self._capture:
+            self._capture.record(queue_entry)
+
+        data: RequestData = RequestData(queue_entry)
+        if fetch_ms is not None:
+            data.timings.add("queue_fetch", fetch_ms)
+        data.timings.add("queue_wait", (time.perf_counter() - fetched_at) * 1000)
 
-            # Schedule the next get_command request
-            get_command_task = asyncio.create_task(self.get_command(task_id))
+        # The method to call to process this request
+        method_to_call = self.process
 
-            if len(queue_entries) == 0:
-                continue
+        # Control commands are handled on their own thread wherever they came
+        # from, so they don't wait for a busy inference thread
+        control = control or self.is_control_command(data)
 
-            # In theory we may get back multiple command requests. In practice
-            # it's always just 1 at a time. At the moment.
-            for queue_entry in queue_entries:
+        # Special requests
+        if data.command:
+            
+            if self.module_id == data.get_value("moduleId") and data.command.lower() == "quit":
+                await self.log_async(LogMethod.Info | LogMethod.File | LogMethod.Server, { 
+                    "process":  self.module_name,
+                    "filename": __file__,
+                    "method":   "main_loop",
+                    "loglevel": "info",
+                    "message":  "Shutting down"
+                })
+                self.stop_loops()
+                return False
+            elif data.command.lower() == "status":
+                method_to_call = self.status
+                suppress_timing_log = True
+            elif data.command.lower() == "selftest":
+                method_to_call = self.selftest
+
+        # Timings are collected for every request, but only logged for each
+        # request if we're being loud. Otherwise see timing_summary_loop
+        start_time = time.perf_counter()
+        timer      = None
+        if not suppress_timing_log and self.log_verbosity == LogVerbosity.Loud:
+            process_name = f"Rec'd request for {self.module_name}"
+            if data.command:
+                process_name += f" command '{data.command}'"
+            process_name += f" (#reqid {data.request_id})"
+            timer: Tuple[str, float] = self.start_timer(process_name)
+
+        output: JSON = {}
+        try:
+            # Don't start work that no one will be waiting for by the time
+            # it's done
+            rejection = self.check_admission(data) if method_to_call == self.process and not control else None
+
+            if rejection is not None:
+                output = rejection
+            # If this request's result can be reused, then an earlier
+            # request may already have done the work for us
+            elif method_to_call == self.process and self.can_cache_result(data):
+                output = await self.process_reusable(data)
+            else:
+                output = await self.call_module_method(method_to_call, data, control)
+
+            # print(f"Process Response is {output['message']}")
+
+        except asyncio.CancelledError:
+            print(f"The future has been cancelled. Ignoring command {data.command} (#reqid {data.request_id})")
+
+        except Exception as ex:
+            output = {
+                "success": False,
+                "error":   f"unable to process the request (#reqid {data.request_id})"
+            }
+
+            message = "".join(traceback.TracebackException.from_exception(ex).format())
+            await self.log_async(LogMethod.Error | LogMethod.Server, { 
+                "process":        self.module_name,
+                "filename":       __file__,
+                "method":         sys._getframe().f_code.co_name,
+                "loglevel":       "error",
+                "message":        message,
+                "exception_type": ex.__class__.__name__
+            })
+
+        finally:
+            if not suppress_timing_log:
+                total_ms = (time.perf_counter() - start_time) * 1000
+                data.timings.add("total", total_ms)
+                self._interval_stats.record(data.command, "total", total_ms)
+                if timer:
+                    self.end_timer(timer, "command timing", data.command)
+
+            try:
+                # status may not have anything to say, but we do
+                if method_to_call == self.status:
+                    output = output or { "success": True }
+                    output["timingStats"] = self._timing_stats.summary()
+                    output["loadShedding"] = {
+                        "expired":    self._expired_count,
+                        "overloaded": self._overloaded_count
+                    }
+                else:
+                    self._timing_stats.record_timings(data.command, data.timings)
+                    output["timings"] = data.timings.as_dict()
+
+                output["code"]              = 200 if output["success"] == True else \
+                                              503 if output.get("overloaded") else 500   # Deprecated
+                output["command"]           = data.command or ''
+                output["moduleId"]          = self.module_id
+                output["executionProvider"] = self.execution_provider or 'CPU'
                 
-                suppress_timing_log = False
-
-                data: RequestData = RequestData(queue_entry)
-
-                # The method to call to process this request
-                method_to_call = self.process
-
-                # Special requests
-                if data.command:
-                    
-                    if self.module_id == data.get_value("moduleId") and data.command.lower() == "quit":
-                        await self.log_async(LogMethod.Info | LogMethod.File | LogMethod.Server, { 
-                            "process":  self.module_name,
-                            "filename": __file__,
-                            "method":   "main_loop",
-                            "loglevel": "info",
-                            "message":  "Shutting down"
-                        })
-                        self._cancelled = True
+                # Hand the response to the response sender, and get on with
+                # the next request rather than waiting for it to be sent
+                self.queue_response(data.request_id, output)
+                
+            except Exception:
+                print(f"An exception occurred sending the inference response (#reqid {data.request_id})")
+
+
+        return True
+
+
+    def check_admission(self, data: RequestData) -> JSON:
+        """
+        Decides whether a request is still worth processing. Returns a quick
+        "overloaded" response for a request that's past its deadline, that we
+        expect to finish after its deadline (going by the recent time taken
+        to process the same command), or that has waited here for more than
+        max_queue_ms. Returns None if the request should be processed. When
+        we fall behind this keeps us working on requests someone is still
+        waiting for, rather than on a backlog of stale ones.
+        """
+        error = None
+
+        deadline = data.deadline
+        if deadline is not None:
+            remaining_ms = (deadline - time.time()) * 1000
+            if remaining_ms <= 0:
+                self._expired_count += 1
+                error = "The request expired before it could be processed"
+            else:
+                expected_ms = self._timing_stats.recent_percentile(data.command, "process")
+                if expected_ms is not None and expected_ms > remaining_ms:
+                    self._overloaded_count += 1
+                    error = "The module is too busy to process the request in time"
+
+        if error is None and self.max_queue_ms > 0 and \
+           data.timings.stages.get("queue_wait", 0) > self.max_queue_ms:
+            self._overloaded_count += 1
+            error = "The module is too busy to process the request in time"
+
+        if error is None:
+            return None
+
+        return {
+            "success":    False,
+            "error":      error + f" (#reqid {data.request_id})",
+            "overloaded": True
+        }
+
+
+    async def process_reusable(self, data: RequestData) -> JSON:
+        """
+        Processes a request whose result may be reused (see can_cache_result).
+        A near duplicate of the last frame from the same camera gets that
+        frame's result (see FrameGate), and a request identical to a recent
+        request gets that request's result (see ResultCache). Anything else is
+        processed as normal.
+        """
+        gate_key  = FrameGate.make_key(data) if self._frame_gate is not None else None
+        thumbnail = None
+        if gate_key is not None:
+            loop      = asyncio.get_running_loop()
+            thumbnail = await loop.run_in_executor(self._executor, self._frame_gate.make_thumbnail, data)
+            output    = self._frame_gate.get_reusable_result(gate_key, thumbnail)
+            if output is not None:
+                return output
+
+        if self._result_cache is not None:
+            cache_key = ResultCache.make_key(data)
+            output    = await self._result_cache.get_or_compute(cache_key,
+                                    lambda: self.call_module_method(self.process, data))
+        else:
+            output = await self.call_module_method(self.process, data)
+
+        if gate_key is not None:
+            self._frame_gate.update(gate_key, thumbnail, output)
+
+        return output
+
+
+    async def call_module_method(self, method_to_call, data: RequestData, control: bool = False) -> JSON:
+        """
+        Calls the given module method (eg process or status) for a request,
+        whether it's async or not, and returns its result. Requests to be
+        processed go via the batch loop if batching, or to a worker process if
+        running in process mode. Control commands (see control_commands) skip
+        the batch loop and use a thread of their own.
+        """
+        # Overriding issue here: We need to await self.process in the
+        # asyncio loop. This means we can't just 'await self.process'
+
+        start_time = time.perf_counter()
+
+        if method_to_call == self.process and self._batch_queue is not None and not control:
+            # Batching: hand the request to the batch loop and
+            # wait for the result of this request to be set
+            callbacktask = asyncio.get_running_loop().create_future()
+            await self._batch_queue.put((data, callbacktask))
+        elif method_to_call == self.status and self._process_pool is not None:
+            # Process mode: status shouldn't wait behind the work queued for
+            # the workers, so the pool answers from what they reported at start
+            callbacktask = asyncio.get_running_loop().create_future()
+            callbacktask.set_result(self._process_pool.status())
+        elif method_to_call in (self.process, self.selftest) and self._process_pool is not None:
+            # Process mode: hand the request to a worker process. The module
+            # instance here was never initialised, so selftest goes there too
+            callbacktask = asyncio.create_task(self.call_process_pool(method_to_call.__name__, [data]))
+        elif asyncio.iscoroutinefunction(method_to_call):
+            # if process is async, then it's a coroutine. In this
+            # case we create an awaitable asyncio task to execute
+            # this method.
+            callbacktask = asyncio.create_task(method_to_call(data))
+        else:
+            # If the method is not async, then we wrap it in an
+            # awaitable method which we await.
+            loop = asyncio.get_running_loop()
+            executor = self._control_executor if control and self._control_executor else self._executor
+            callbacktask = loop.run_in_executor(executor, method_to_call, data)
+
+        # Await 
+        output = await callbacktask
+
+        if method_to_call == self.process:
+            # The total time in the module, including any wait for a batch
+            data.timings.add("process", (time.perf_counter() - start_time) * 1000)
+
+            # Modules that don't record their own inference time all report it
+            if "inference" not in data.timings.stages and isinstance(output, dict) \
+               and isinstance(output.get("inferenceMs"), (int, float)):
+                data.timings.add("inference", output["inferenceMs"])
+
+        return output
+
+
+    async def batch_loop(self) -> None:
+        """
+        Gathers requests that have been handed over by the main loop tasks into
+        batches and passes each batch to process_batch. A batch is sent for
+        processing once it contains batch_size requests, or once batch_wait_ms
+        has passed since the first request in the batch arrived. The results
+        are then split back out to the main loop task waiting on each request.
+
+        There are parallelism batch loops running, so up to parallelism batches
+        can be processed at the same time.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            while not self._cancelled:
+                batch = [ await self._batch_queue.get() ]
+
+                # Keep gathering requests until the batch is full or we've
+                # waited long enough
+                deadline = loop.time() + self.batch_wait_ms / 1000.0
+                while len(batch) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                    except asyncio.TimeoutError:
                         break
-                    elif data.command.lower() == "status":
-                        method_to_call = self.status
-                        suppress_timing_log = True
-                    elif data.command.lower() == "selftest":
-                        method_to_call = self.selftest
-
-                if not suppress_timing_log:
-                    process_name = f"Rec'd request for {self.module_name}"
-                    if data.command:
-                        process_name += f" command '{data.command}'"
-                    process_name += f" (#reqid {data.request_id})"
-                    timer: Tuple[str, float] = self.start_timer(process_name)
-
-                output: JSON = {}
+
+                data_list = [ data for (data, _) in batch ]
+                futures   = [ future for (_, future) in batch ]
+
                 try:
-                    # Overriding issue here: We need to await self.process in the
-                    # asyncio loop. This means we can't just 'await self.process'
-
-                    if asyncio.iscoroutinefunction(method_to_call):
-                        # if process is async, then it's a coroutine. In this
-                        # case we create an awaitable asyncio task to execute
-                        # this method.
-                        callbacktask = asyncio.create_task(method_to_call(data))
+                    if self._process_pool is not None:
+                        outputs = await self.call_process_pool("process_batch", data_list)
+                    elif asyncio.iscoroutinefunction(self.process_batch):
+                        outputs = await self.process_batch(data_list)
                     else:
-                        # If the method is not async, then we wrap it in an
-                        # awaitable method which we await.
-                        loop = asyncio.get_running_loop()
-                        callbacktask = loop.run_in_executor(None, method_to_call, data)
-
-                    # Await 
-                    output = await callbacktask
+                        outputs = await loop.run_in_executor(self._executor, self.process_batch, data_list)
 
-                    # print(f"Process Response is {output['message']}")
+                    if outputs is None or len(outputs) != len(data_list):
+                        raise ValueError(f"process_batch returned {len(outputs or [])} results " +
+                                         f"for a batch of {len(data_list)} requests")
 
-                except asyncio.CancelledError:
-                    print(f"The future has been cancelled. Ignoring command {data.command} (#reqid {data.request_id})")
+                    for future, output in zip(futures, outputs):
+                        if not future.done():
+                            future.set_result(output)
 
                 except Exception as ex:
-                    output = {
-                        "success": False,
-                        "error":   f"unable to process the request (#reqid {data.request_id})"
-                    }
+                    # The main loop tasks will report the error for each request
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(ex)
 
-                    message = "".join(traceback.TracebackException.from_exception(ex).format())
-                    await self.log_async(LogMethod.Error | LogMethod.Server, { 
-                        "process":        self.module_name,
-                        "filename":       __file__,
-                        "method":         sys._getframe().f_code.co_name,
-                        "loglevel":       "error",
-                        "message":        message,
-                        "exception_type": ex.__class__.__name__
-                    })
+        except asyncio.CancelledError:
+            pass
 
-                finally:
-                    if not suppress_timing_log:
-                        self.end_timer(timer, "command timing", data.command)
 
-                    try:
-                        if send_response_task != None:
-                            # print("awaiting old send task")
-                            await send_response_task
-
-                        output["code"]              = 200 if output["success"] == True else 500   # Deprecated
-                        output["command"]           = data.command or ''
-                        output["moduleId"]          = self.module_id
-                        output["executionProvider"] = self.execution_provider or 'CPU'
-                        
-                        # print("creating new send task")
-                        send_response_task = asyncio.create_task(self.send_response(data.request_id, output))
-                        
-                    except Exception:
-                        print(f"An exception occurred sending the inference response (#reqid {data.request_id})")
-        
-        # Cleanup
-        self.shutdown()
+    async def call_process_pool(self, method_name: str, data_list: "list[RequestData]") -> any:
+        """
+        Calls the given method (eg process, process_batch or selftest) of the
+        module in one of the worker processes, and logs what the worker logged
+        while doing so
+        """
+        output, log_entries = await self._process_pool.call(method_name, data_list)
+        for (log_method, log_data) in log_entries:
+            await self.log_async(log_method, log_data)
 
-        # method is ending. Let's clean up. self._cancelled == True at this point.
-        self._logger.cancel_logging()
+        return output
 
 
     # Performance timer =======================================================
@@ -747,7 +1364,7 @@ class ModuleRunner:
         self._logger.log(log_method, data)
 
         
-    async def get_command(self, task_id) -> "list[str]":
+    async def get_command(self, task_id, lane: str = None) -> "list[str]":
 
         """
         Gets a command from the queue associated with this object. 
@@ -766,9 +1383,16 @@ class ModuleRunner:
         old legacy modules we started with, but also to future-proof the code 
         in case we want to allow batch processing. Be aware that batch 
         processing will mean less opportunity to load balance the requests.
+
+        If lane is given (eg "control") then only requests from that lane of
+        the queue are returned, and always via HTTP.
         """
         commands = []
 
+        # Use the WebSocket if we have one, and it's open
+        if self._websocket and self._websocket.connected and not lane:
+            return await self._websocket.get_command()
+
         try:
             url = self._base_queue_url + self.queue_name + "?moduleId=" + self.module_id
             if self.execution_provider:
@@ -776,6 +1400,13 @@ class ModuleRunner:
             if self.can_use_GPU is not None:
                 url += "&canUseGPU=" + str(self.can_use_GPU).lower()
 
+            # Ask for requests with files to be sent as binary frames rather
+            # than JSON with base64 encoded files. Older servers will ignore
+            # this and send JSON, so we check what we actually get back.
+            url += "&binary=true"
+            if lane:
+                url += "&lane=" + lane
+
             # Send a request to query the queue and wait up to 30 seconds for a
             # response. We're basically long-polling here
             async with self._request_session.get(
@@ -785,7 +1416,20 @@ class ModuleRunner:
             ) as session_response:
 
                 if session_response.ok:
-                    content = await session_response.text()
+                    # Servers that don't have lanes ignore the lane and send
+                    # whatever's next, and don't tell us they've used the lane
+                    if lane:
+                        self._control_lane_supported = session_response.headers.get("X-Queue-Lane") == lane
+
+                    # We're long-polling, so only time the reading of the
+                    # request, not the wait for a request to arrive
+                    read_start = time.perf_counter()
+                    if session_response.content_type == RequestData.FRAME_CONTENT_TYPE:
+                        content = await session_response.read()
+                    else:
+                        content = await session_response.text()
+                    self._fetch_ms[task_id] = (time.perf_counter() - read_start) * 1000
+
                     if content:
 
                         # This method allows multiple commands to be returned, but to
@@ -919,6 +1563,18 @@ class ModuleRunner:
             return commands
 
 
+    def queue_response(self, request_id : str, body : JSON) -> None:
+        """
+        Queues the result of a request for sending back to the API server. The
+        response is sent by the response sender's own task, so this returns
+        immediately.
+
+        Param: request_id - the ID of the request that was originally pulled 
+                            from the command queue.
+        Param: body:      - the JSON result from the analysis of the request.
+        """
+        self._response_sender.queue_response(request_id, body, self._response_url_params())
+
     async def send_response(self, request_id : str, body : JSON) -> bool:
         """
         Sends the result of a comment to the analysis services back to the API
@@ -929,6 +1585,8 @@ class ModuleRunner:
         pull requests from the queue that they can service, process each 
         request, and then send the results back to the server.
 
+        Unlike queue_response, this sends the response immediately, and waits.
+
         Param: request_id - the ID of the request that was originally pulled 
                             from the command queue.
         Param: body:      - the JSON result (as a string) from the analysis of 
@@ -937,38 +1595,21 @@ class ModuleRunner:
         Returns:          - True on success; False otherwise
         """
 
-        success = False
-        # responseTimer = self.start_timer(f"Sending response for request from {self.queue_name}")
-
-        try:
-            url = self._base_queue_url + request_id + "?moduleId=" + self.module_id
-            if self.execution_provider is not None:
-                url += "&executionProvider=" + self.execution_provider
-            if self.can_use_GPU is not None:
-                url += "&canUseGPU=" + str(self.can_use_GPU).lower()
-            
-            # print("Sending response to server")
-            async with self._request_session.post(
-                url,
-                data    = json.dumps(body),
-                timeout = 10
-                #, verify  = False
-                ):
-                success = True
-            # print("Response sent")
-
-        except Exception as ex:
+        success = await self._response_sender.post(request_id, body, self._response_url_params())
+        if not success:
             await asyncio.sleep(self._error_pause_secs)
 
-            if self._verbose_exceptions:
-                print(f"Error sending response: {str(ex)}")
-            else:
-                print(f"Error sending response: Is the API Server running? [" + ex.__class__.__name__ + "]")
+        return success
 
-        finally:
-            #if success:
-            #    self.end_timer(responseTimer)
-            return success
+    def _response_url_params(self) -> str:
+        """ The query string identifying this module when sending a response """
+        url_params = "?moduleId=" + self.module_id
+        if self.execution_provider is not None:
+            url_params += "&executionProvider=" + self.execution_provider
+        if self.can_use_GPU is not None:
+            url_params += "&canUseGPU=" + str(self.can_use_GPU).lower()
+
+        return url_params
 
 
     async def call_api(self, method:str, files=None, data=None) -> str:
@@ -0,0 +1,301 @@
+import hashlib
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from common import JSON
+from timing_stats import TimingStats
+
+
+_model_hashes = {}   # model path => hash of the model file
+
+
+def get_model_hash(model_path: str) -> str:
+    """
+    Returns a short hash of the contents of a model file, so that exports of a
+    model that has since been replaced aren't used.
+    """
+    model_hash = _model_hashes.get(model_path, None)
+    if model_hash is None:
+        hasher = hashlib.sha256()
+        with open(model_path, "rb") as model_file:
+            for chunk in iter(lambda: model_file.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        model_hash = hasher.hexdigest()[:12]
+        _model_hashes[model_path] = model_hash
+
+    return model_hash
+
+
+def find_models(opts: any, model_names: list) -> list:
+    """
+    Returns the paths of the named .pt models, or, if no names are given, of
+    the standard model for the current MODEL_SIZE and all the custom models.
+    opts is the module's Options, with its models_dir, custom_models_dir and
+    std_model_name.
+    """
+    if not model_names:
+        model_paths = [ os.path.join(opts.models_dir, opts.std_model_name + ".pt") ]
+        if os.path.isdir(opts.custom_models_dir):
+            model_paths += [ entry.path for entry in sorted(os.scandir(opts.custom_models_dir), key=lambda e: e.name)
+                             if entry.is_file() and entry.name.endswith(".pt") ]
+        return [ path for path in model_paths if os.path.exists(path) ]
+
+    model_paths = []
+    for model_name in model_names:
+        for models_dir in [ opts.custom_models_dir, opts.models_dir ]:
+            model_path = os.path.join(models_dir, model_name + ".pt")
+            if os.path.exists(model_path):
+                model_paths.append(model_path)
+                break
+        else:
+            print(f"error: {model_name}.pt not found in {opts.custom_models_dir} or {opts.models_dir}")
+
+    return model_paths
+
+
+def load_calibration_images(folder: str, samples: int = 100) -> list:
+    """
+    Loads up to samples images from a folder (and its sub folders) as RGB PIL
+    Images, spread evenly over the folder's images if there are more than that.
+    """
+    paths = []
+    for root, _, file_names in os.walk(folder):
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() in [ ".jpg", ".jpeg", ".png", ".bmp", ".webp" ]:
+                paths.append(os.path.join(root, file_name))
+
+    if samples and len(paths) > samples:
+        step  = len(paths) / samples
+        paths = [ paths[int(index * step)] for index in range(samples) ]
+
+    images = []
+    for path in paths:
+        try:
+            images.append(Image.open(path).convert("RGB"))
+        except Exception:
+            pass
+
+    return images
+
+
+def letterbox_tensor(img: Image, size: int, bgr: bool = False) -> np.ndarray:
+    """
+    Returns an image as a (1, 3, size, size) float tensor in [0, 1], scaled to
+    fit in size x size and padded (centred, with grey) the way YOLO's
+    letterbox does. bgr is for models that are fed BGR rather than RGB.
+    """
+    ratio  = size / max(img.width, img.height)
+    width  = max(int(round(img.width * ratio)), 1)
+    height = max(int(round(img.height * ratio)), 1)
+
+    padded = Image.new("RGB", (size, size), (114, 114, 114))
+    padded.paste(img.resize((width, height), Image.BILINEAR), ((size - width) // 2, (size - height) // 2))
+
+    pixels = np.asarray(padded, dtype=np.float32) / 255.0
+    if bgr:
+        pixels = pixels[..., ::-1]
+    return np.ascontiguousarray(pixels.transpose(2, 0, 1)[np.newaxis])
+
+
+class ImageCalibrationReader:
+    """
+    Feeds images to ONNX Runtime's quantizer as the calibration data it uses to
+    find the range of each activation. Implements onnxruntime.quantization's
+    CalibrationDataReader.
+    """
+
+    def __init__(self, images: list, input_name: str, size: int, bgr: bool = False) -> None:
+        self.images     = images
+        self.input_name = input_name
+        self.size       = size
+        self.bgr        = bgr
+        self._index     = 0
+
+    def get_next(self) -> dict:
+        if self._index >= len(self.images):
+            return None
+
+        img = self.images[self._index]
+        self._index += 1
+        return { self.input_name: letterbox_tensor(img, self.size, self.bgr) }
+
+    def rewind(self) -> None:
+        self._index = 0
+
+
+def get_postprocess_nodes(model: any) -> list:
+    """
+    Returns the names of the nodes in an ONNX model that come after its last
+    convolutions: for YOLO, the head that decodes the raw outputs into boxes
+    and scores. Those mix coordinates in pixels with scores in [0, 1], which
+    doesn't quantize well, and they're cheap, so they're left in float.
+    """
+    producers = {}  # output name => node
+    for node in model.graph.node:
+        for output in node.output:
+            producers[output] = node
+
+    # Walk back from each Conv, marking everything it depends on
+    feeds_conv = set()
+    pending    = [ node for node in model.graph.node if node.op_type == "Conv" ]
+    while pending:
+        node = pending.pop()
+        if node.name in feeds_conv:
+            continue
+        feeds_conv.add(node.name)
+        pending.extend(producers[name] for name in node.input if name in producers)
+
+    return [ node.name for node in model.graph.node if node.name not in feeds_conv ]
+
+
+def quantize_model(fp32_path: str, int8_path: str, images: list, size: int, bgr: bool = False) -> None:
+    """
+    Quantizes an ONNX model that takes size x size images to INT8, using the
+    images to calibrate its activations (see ImageCalibrationReader). The
+    model's metadata (eg its class names) is carried over.
+    """
+    import onnx
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+
+    fp32_model = onnx.load(fp32_path)
+
+    # Give every node a name, so the post processing nodes can be excluded
+    for index, node in enumerate(fp32_model.graph.node):
+        if not node.name:
+            node.name = f"{node.op_type}_{index}"
+
+    reader     = ImageCalibrationReader(images, fp32_model.graph.input[0].name, size, bgr)
+    named_path = int8_path + ".fp32.onnx"
+    onnx.save(fp32_model, named_path)
+    try:
+        quantize_static(named_path, int8_path, reader,
+                        quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        nodes_to_exclude=get_postprocess_nodes(fp32_model))
+    except Exception:
+        # Don't leave a half written model for the module to pick up
+        if os.path.exists(int8_path):
+            os.remove(int8_path)
+        raise
+    finally:
+        os.remove(named_path)
+
+    int8_model = onnx.load(int8_path)
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(fp32_model.metadata_props)
+    onnx.save(int8_model, int8_path)
+
+
+def _box_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    areas        = (box[2] - box[0]) * (box[3] - box[1]) + \
+                   (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(areas - intersection, 1e-9)
+
+
+def agreement_map(references: list, candidates: list, iou_threshold: float = 0.5) -> float:
+    """
+    The mean average precision, at the given IoU, of a candidate model's
+    detections scored against a reference model's detections on the same
+    images. With no labelled ground truth, this measures how much quantization
+    changes what's detected: 1.0 means no change. Each list holds an array of
+    (x_min, y_min, x_max, y_max, confidence, class) rows for each image.
+    """
+    classes = set()
+    for detections in references:
+        classes.update(int(cls) for cls in detections[:, 5])
+
+    average_precisions = []
+    for cls in sorted(classes):
+        expected = [ detections[detections[:, 5] == cls, :4] for detections in references ]
+        total    = sum(len(boxes) for boxes in expected)
+
+        # (confidence, image index, box) for each candidate detection of this
+        # class, most confident first
+        found = [ (row[4], image_index, row[:4])
+                  for image_index, detections in enumerate(candidates)
+                  for row in detections if int(row[5]) == cls ]
+        found.sort(key=lambda entry: -entry[0])
+
+        matched = [ np.zeros(len(boxes), dtype=bool) for boxes in expected ]
+        hits    = np.zeros(len(found))
+        for index, (_, image_index, box) in enumerate(found):
+            boxes = expected[image_index]
+            if len(boxes):
+                ious = _box_iou(box, boxes)
+                ious[matched[image_index]] = 0
+                best = int(np.argmax(ious))
+                if ious[best] >= iou_threshold:
+                    matched[image_index][best] = True
+                    hits[index] = 1
+
+        if not found:
+            average_precisions.append(0.0)
+            continue
+
+        # Area under the precision / recall curve, with precision made
+        # monotonic, as in the VOC and COCO evaluations
+        true_positives = np.cumsum(hits)
+        recall         = np.concatenate(([0.0], true_positives / total, [1.0]))
+        precision      = np.concatenate(([1.0], true_positives / np.arange(1, len(found) + 1), [0.0]))
+        precision      = np.flip(np.maximum.accumulate(np.flip(precision)))
+        steps          = np.where(recall[1:] != recall[:-1])[0]
+        average_precisions.append(float(np.sum((recall[steps + 1] - recall[steps]) * precision[steps + 1])))
+
+    return float(np.mean(average_precisions)) if average_precisions else 1.0
+
+
+def _run_detector(detect: callable, images: list) -> "tuple[list, list]":
+    detect(images[0])   # The first run includes one-off setup costs
+
+    detections, latencies = [], []
+    for img in images:
+        start_time = time.perf_counter()
+        detections.append(detect(img))
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+    return detections, latencies
+
+
+def evaluate_quantization(images: list, fp32_detect: callable, int8_detect: callable) -> JSON:
+    """
+    Runs the FP32 and INT8 versions of a model over the calibration images and
+    reports the latency of each and how well the INT8 model's detections agree
+    with the FP32 model's. The detect callables take an image and return an
+    array of (x_min, y_min, x_max, y_max, confidence, class) rows.
+    """
+    fp32_detections, fp32_latencies = _run_detector(fp32_detect, images)
+    int8_detections, int8_latencies = _run_detector(int8_detect, images)
+
+    fp32_ms = TimingStats.percentile(sorted(fp32_latencies), 50)
+    int8_ms = TimingStats.percentile(sorted(int8_latencies), 50)
+
+    return {
+        "images":    len(images),
+        "fp32Ms":    round(fp32_ms, 1),
+        "int8Ms":    round(int8_ms, 1),
+        "speedup":   round(fp32_ms / int8_ms, 2) if int8_ms else 0,
+        "mAP50":     round(agreement_map(fp32_detections, int8_detections, 0.5), 3),
+        "mAP50_95":  round(float(np.mean([ agreement_map(fp32_detections, int8_detections, iou)
+                                           for iou in np.arange(0.5, 0.96, 0.05) ])), 3)
+    }
+
+
+def print_quantization_report(results: list) -> None:
+    """ Prints the evaluate_quantization results for each model as a table """
+    print(f"{'model':30} {'size':>5} {'images':>6} {'fp32 ms':>8} {'int8 ms':>8} {'speedup':>7} {'mAP50':>6} {'mAP50-95':>8}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['model']:30} {result.get('size', ''):>5} {result['error']}")
+        else:
+            print(f"{result['model']:30} {result['size']:5} {result['images']:6} {result['fp32Ms']:8.1f} " + \
+                  f"{result['int8Ms']:8.1f} {result['speedup']:6.2f}x {result['mAP50']:6.3f} {result['mAP50_95']:8.3f}")
+    print("mAP is measured against the FP32 model's detections: 1.0 means quantizing changed nothing")
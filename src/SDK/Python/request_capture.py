@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+import random
+import struct
+import time
+
+
+class RequestCapture:
+    """
+    Records the raw requests a module takes from the queue to a gzip compressed
+    capture file, so real traffic (eg the mix of cameras and image sizes a
+    site actually sends) can be replayed against a module later. See
+    module_benchmark.py (--benchmark --replay FILE).
+
+    Each capture goes to a file of its own, named by adding the time the
+    capture started to the path given (eg captures/site.gz is recorded to
+    captures/site.20240131-120000.gz), so restarting the module doesn't write
+    over an earlier capture. Only sample_rate (0 - 1) of the requests are
+    recorded, and recording stops once the file reaches max_bytes. Writing happens on a thread of its own so
+    compressing the requests doesn't hold up the event loop.
+
+    The file starts with MAGIC, followed by a record for each request: the time
+    in seconds since the capture started (a double), whether the request is a
+    binary frame rather than JSON (a byte), the length of the request (an
+    unsigned int), then the request itself.
+    """
+
+    MAGIC         = b"CPAICAP1"
+    RECORD_HEADER = struct.Struct("<dBI")
+
+    def __init__(self, path: str, sample_rate: float = 1.0, max_bytes: int = 500 * 1024 * 1024) -> None:
+        self.sample_rate = sample_rate
+        self.max_bytes   = max_bytes
+
+        self.recorded    = 0
+        self.full        = False
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path, self._raw_file = RequestCapture._create_file(path)
+        self._file       = gzip.GzipFile(fileobj=self._raw_file, mode="wb", compresslevel=5)
+        self._file.write(RequestCapture.MAGIC)
+        self._start_time = time.perf_counter()
+        self._last_flush = self._start_time
+        self._executor   = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+
+    @staticmethod
+    def _create_file(path: str) -> tuple:
+        """
+        Creates a new file for a capture: path with the current time added
+        before the extension (and a count after that, should that file already
+        exist). Returns the path of the file and the open file.
+        """
+        stem, extension = os.path.splitext(path)
+        timestamp       = time.strftime("%Y%m%d-%H%M%S")
+
+        count = 1
+        while True:
+            suffix    = f".{timestamp}" if count == 1 else f".{timestamp}-{count}"
+            file_path = stem + suffix + extension
+            try:
+                return file_path, open(file_path, "xb")
+            except FileExistsError:
+                count += 1
+
+    def record(self, content: any) -> None:
+        """
+        Records a request, as it came from the queue (JSON text or a binary
+        frame), if it's picked by sampling and there's still room.
+        """
+        if self.full or self._file is None or not content:
+            return
+
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+
+        offset = time.perf_counter() - self._start_time
+        self._executor.submit(self._write, offset, content)
+
+    def _write(self, offset: float, content: any) -> None:
+        if self.full or self._file is None:
+            return
+
+        is_binary = isinstance(content, (bytes, bytearray, memoryview))
+        body      = bytes(content) if is_binary else content.encode("utf-8")
+
+        # The size of the compressed output so far. A little behind, as the
+        # compressor buffers, but close enough for a cap
+        if self._raw_file.tell() + len(body) > self.max_bytes:
+            self.full = True
+            return
+
+        self._file.write(RequestCapture.RECORD_HEADER.pack(offset, 1 if is_binary else 0, len(body)))
+        self._file.write(body)
+        self.recorded += 1
+
+        # Flush now and then so that not much is lost if the module is killed
+        now = time.perf_counter()
+        if now - self._last_flush > 1:
+            self._file.flush()
+            self._last_flush = now
+
+    def close(self) -> None:
+        """ Finishes writing what's been recorded and closes the file """
+        self._executor.shutdown(wait=True)
+        if self._file is not None:
+            self._file.close()
+            self._raw_file.close()
+            self._file = None
+
+    @staticmethod
+    def read(path: str):
+        """
+        Yields (seconds since the capture started, request) for each request in
+        a capture file. Each request is as it came from the queue: a str for
+        JSON, bytes for a binary frame. A capture that was cut short (eg the
+        module was killed) is read up to the last complete request.
+        """
+        with gzip.open(path, "rb") as file:
+            if file.read(len(RequestCapture.MAGIC)) != RequestCapture.MAGIC:
+                raise ValueError(f"{path} is not a request capture file")
+
+            while True:
+                try:
+                    header = file.read(RequestCapture.RECORD_HEADER.size)
+                    if len(header) < RequestCapture.RECORD_HEADER.size:
+                        break
+
+                    offset, is_binary, length = RequestCapture.RECORD_HEADER.unpack(header)
+                    body = file.read(length)
+                except EOFError:
+                    break
+
+                if len(body) < length:
+                    break
+
+                yield offset, body if is_binary else body.decode("utf-8")
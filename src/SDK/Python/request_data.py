@@ -3,10 +3,12 @@ import base64
 import io
 from io import BytesIO
 import json
+import time
 
 from PIL import Image
 
 from common import JSON
+from timing_stats import RequestTimings
 # from logging import LogMethod
 
 class RequestData:
@@ -15,20 +17,71 @@ class RequestData:
     inference operation, and provides helper methods to access this information
     """
 
+    # The content type of a request sent as a binary frame rather than JSON.
+    # A frame is a 4 byte (little endian) header length, then the UTF-8 JSON
+    # header: the request with each file's "data" replaced by its "length".
+    # The raw contents of each file follow the header, one after the other.
+    FRAME_CONTENT_TYPE = "application/octet-stream"
+
+    # The content type of an image sent as raw, already decoded, pixels rather
+    # than as an encoded (eg JPEG) image. The pixel format and size are given as
+    # parameters, eg "image/x-raw; format=nv12; width=1920; height=1080", or
+    # for all files, by the pixel_format, width and height values of the request
+    RAW_IMAGE_CONTENT_TYPE = "image/x-raw"
+
+    # The raw pixel formats we understand. nv12 and i420 are both YUV 4:2:0
+    # (BT.601): nv12 with interleaved U and V, i420 with separate U and V planes
+    RAW_PIXEL_FORMATS = [ "rgb24", "bgr24", "nv12", "i420" ]
+
     # Constructor
     def __init__(self, json_request_data: str = None):
+        """
+        json_request_data - the request as a JSON string, or as a binary frame
+                            (bytes, bytearray or memoryview)
+        """
 
         self._verbose_exceptions = True
 
-        if json_request_data:    
-            request_data    = json.JSONDecoder().decode(json_request_data)
-            self.request_id = request_data.get("reqid", "")
-            self.payload    = request_data["payload"]
-        else:
-            self.request_id = ""
+        # The request isn't parsed until something in it is first needed
+        self._raw_request  = json_request_data
+        self._request_id   = ""
+        self._deadline     = None
+        self._payload      = None
+
+        self._value_index  = None   # key => list of values, built on first use
+        self._typed_values = {}     # (key, type) => converted value
+        self._images       = {}     # (file index, max_size, as_numpy) => decoded image
+        self._image_sizes  = {}     # file index => (width, height) of the original image
+
+        # The time spent in each stage of handling this request. We record the
+        # time spent parsing the request and decoding its images
+        self.timings       = RequestTimings()
+
+    def _parse(self) -> None:
+        """ Parses the request, if it hasn't been already """
+
+        if self._payload is not None:
+            return
+
+        start_time = time.perf_counter()
+
+        payload = None
+        if self._raw_request:
+            if isinstance(self._raw_request, (bytes, bytearray, memoryview)):
+                request_data = RequestData.decode_frame(self._raw_request)
+            else:
+                request_data = json.JSONDecoder().decode(self._raw_request)
+            self._request_id = request_data.get("reqid", "")
+            payload          = request_data["payload"]
+
+            deadline = request_data.get("deadline")
+            if isinstance(deadline, (int, float)):
+                self._deadline = deadline / 1000.0
 
-        if not hasattr(self, 'payload') or not self.payload:
-            self.payload = {
+        self._raw_request = None
+
+        if not payload:
+            payload = {
                 "queue":      "N/A",
                 "urlSegments": None,
                 "command":     None,
@@ -36,12 +89,56 @@ class RequestData:
                 "values" :     [ ]
             }
 
-        self._queue_name = self.payload.get("queue"       "N/A")
-        self._segments   = self.payload.get("urlSegments", None)
-        self._command    = self.payload.get("command",     None)
-        self.value_list  = self.payload.get("values",      None)
-        self.files       = self.payload.get("files",       None)
-       
+        self._payload = payload
+
+        self.timings.add("parse", (time.perf_counter() - start_time) * 1000)
+
+    @property
+    def request_id(self) -> str:
+        """ Gets the ID of the request """
+        self._parse()
+        return self._request_id
+
+    @request_id.setter
+    def request_id(self, request_id: str) -> None:
+        self._parse()
+        self._request_id = request_id
+
+    @property
+    def deadline(self) -> float:
+        """
+        Gets the time (in seconds since the epoch, as per time.time()) after
+        which the client will no longer be waiting for the response, or None if
+        the server didn't say
+        """
+        self._parse()
+        return self._deadline
+
+    @property
+    def payload(self) -> JSON:
+        """ Gets the request's payload: the queue, command, values and files """
+        self._parse()
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload: JSON) -> None:
+        self._parse()
+        self._payload      = payload
+        self._value_index  = None
+        self._typed_values = {}
+        self._images       = {}
+        self._image_sizes  = {}
+
+    @property
+    def value_list(self) -> list:
+        """ Gets the list of values ({ "key": ..., "value": [ ... ] }) in the request """
+        return self.payload.get("values", None)
+
+    @property
+    def files(self) -> list:
+        """ Gets the list of files in the request """
+        return self.payload.get("files", None)
+
     @staticmethod
     def clamp(value, min_value, max_value) -> any:
         """ Clamps a value between min_value and max_value inclusive """
@@ -52,6 +149,43 @@ class RequestData:
         """ Restricts a string to a set of values """
         return value if value in values else default_value
 
+    @staticmethod
+    def decode_frame(frame: any) -> JSON:
+        """
+        Decodes a binary frame (see FRAME_CONTENT_TYPE) into the request it
+        contains. The contents of each file are placed in the file's "bytes"
+        entry as a memoryview over the frame itself, so nothing is copied.
+        """
+        frame         = memoryview(frame)
+        header_length = int.from_bytes(frame[:4], "little")
+        request       = json.loads(bytes(frame[4:4 + header_length]))
+
+        offset = 4 + header_length
+        for file in request.get("payload", {}).get("files") or []:
+            length        = int(file.pop("length", 0))
+            file["bytes"] = frame[offset:offset + length]
+            offset       += length
+
+        return request
+
+    @staticmethod
+    def encode_frame(request: JSON, file_contents: list) -> bytes:
+        """
+        Encodes a request, and the contents of each of its files, as a binary
+        frame (see FRAME_CONTENT_TYPE). Any "data" in the request's files is
+        ignored in favour of file_contents.
+        """
+        header = dict(request)
+        header["payload"] = dict(request.get("payload", {}))
+        header["payload"]["files"] = [
+            { **{ key: value for key, value in file.items() if key not in ("data", "bytes") },
+              "length": len(content) }
+            for file, content in zip(request["payload"].get("files") or [], file_contents)
+        ]
+        header_bytes = json.dumps(header).encode("utf-8")
+
+        return b"".join([ len(header_bytes).to_bytes(4, "little"), header_bytes, *file_contents ])
+
     @staticmethod
     def encode_image(image: Image, image_format: str = "PNG") -> str:
         """
@@ -87,40 +221,45 @@ class RequestData:
     @property
     def queue(self) -> str:
         """ Gets the name of the queue """
-        return self._queue
+        return self.payload.get("queue", "N/A")
       
     @queue.setter
     def queue(self, queue_name) -> None:
         """ Sets the name of the queue """
-        self._queue = queue_name
         self.payload["queue"] = queue_name
 
     @property
     def command(self) -> str:
         """ Gets the command to be sent to the module """
-        return self._command
+        return self.payload.get("command", None)
       
     @command.setter
     def command(self, command_name) -> None:
         """ Sets the command to be sent to the module """
-        self._command = command_name
         self.payload["command"] = command_name
 
     @property
     def segments(self):
         """ Gets the segments of the URL that was used to make the API call """
-        return self._segments
+        return self.payload.get("urlSegments", None)
       
     @segments.setter
     def segments(self, segments) -> None:
         """ Sets the segments of the URL that was used to make the API call """
-        self._segments = segments
         self.payload["urlSegments"] = segments
 
     def json(self) -> JSON:
+        payload = self.payload
+        if any(file.get("bytes") is not None for file in payload.get("files") or []):
+            payload = dict(payload)
+            payload["files"] = [ { **{ key: value for key, value in file.items() if key != "bytes" },
+                                   "data": base64.b64encode(file["bytes"]).decode("ascii") }
+                                 if file.get("bytes") is not None else file
+                                 for file in self.payload["files"] ]
+
         json_request_data = {
             "reqid": "",
-            "payload": self.payload
+            "payload": payload
         }
         request_data_str = json.JSONEncoder().encode(json_request_data) 
         return request_data_str
@@ -130,36 +269,182 @@ class RequestData:
             return None       
         self.payload["values"].append({"key": key, "value" : [value]})
 
+        # Start the index and conversions afresh next time they're needed
+        self._value_index  = None
+        self._typed_values = {}
+
     def add_file(self, file_name: str) -> None:
         if not file_name:
             return
         self.payload["files"].append({ "data": RequestData.encode_file_contents(file_name) })
 
-    def get_image(self, index : int) -> Image:
+    def get_file_bytes(self, index : int) -> bytes:
+        """
+        Gets the (decoded) contents of a file from the requests 'files' array.
+        Param: index - the index of the file to return
+        Returns: The file's contents if successful; None otherwise.
+        Remarks: A file's contents will normally arrive base64 encoded, but may
+        have been decoded already and stored as 'bytes' (eg when the request
+        arrived as a binary frame, in which case this is a memoryview, or was
+        handed to a worker process via shared memory)
+        """
+        if self.files is None or len(self.files) <= index:
+            return None
+
+        file = self.files[index]
+        if file.get("bytes") is not None:
+            return file["bytes"]
+
+        return base64.b64decode(file["data"])
+
+    def get_raw_image_format(self, index : int) -> "tuple[str, int, int]":
+        """
+        Gets the (pixel format, width, height) of a file in the requests 'files'
+        array that was sent as raw pixels. Returns None if the file is an
+        encoded image (or isn't there), or the format isn't one we understand.
+        """
+        if self.files is None or len(self.files) <= index:
+            return None
+
+        content_type = self.files[index].get("contentType") or ""
+        parts        = [ part.strip() for part in content_type.split(";") ]
+        if parts[0].lower() == RequestData.RAW_IMAGE_CONTENT_TYPE:
+            params = dict(part.split("=", 1) for part in parts[1:] if "=" in part)
+            params = { key.strip().lower(): value.strip() for key, value in params.items() }
+            pixel_format, width, height = params.get("format"), params.get("width"), params.get("height")
+        else:
+            pixel_format = self.get_value("pixel_format")
+            if not pixel_format:
+                return None
+            width, height = self.get_value("width"), self.get_value("height")
+
+        pixel_format = str(pixel_format).lower()
+        if pixel_format not in RequestData.RAW_PIXEL_FORMATS or \
+           not str(width).isnumeric() or not str(height).isnumeric():
+            return None
+
+        return pixel_format, int(width), int(height)
+
+    @staticmethod
+    def decode_raw_image(raw_bytes, pixel_format : str, width : int, height : int) -> any:
+        """
+        Turns raw pixels into a (height, width, 3) RGB numpy array. rgb24 and
+        bgr24 pixels aren't copied: the array is a (read only) view over
+        raw_bytes. YUV pixels are converted.
+        """
+        import numpy as np
+
+        pixels = np.frombuffer(raw_bytes, dtype=np.uint8)
+
+        if pixel_format in [ "rgb24", "bgr24" ]:
+            img = pixels[:width * height * 3].reshape(height, width, 3)
+            return img if pixel_format == "rgb24" else img[..., ::-1]
+
+        # YUV 4:2:0. A Y (luma) value for each pixel, then a U and V (chroma)
+        # value for each 2x2 block of pixels
+        if width % 2 or height % 2:
+            raise ValueError(f"{pixel_format} images must have an even width and height")
+
+        yuv = pixels[:width * height * 3 // 2]
+        if len(yuv) < width * height * 3 // 2:
+            raise ValueError(f"Expected {width * height * 3 // 2} bytes of {pixel_format} pixels")
+
+        try:
+            import cv2
+            conversion = cv2.COLOR_YUV2RGB_NV12 if pixel_format == "nv12" else cv2.COLOR_YUV2RGB_I420
+            return cv2.cvtColor(yuv.reshape(height * 3 // 2, width), conversion)
+        except ImportError:
+            pass
+
+        y      = yuv[:width * height].reshape(height, width).astype(np.float32) - 16
+        chroma = yuv[width * height:]
+        if pixel_format == "nv12":
+            chroma = chroma.reshape(height // 2, width // 2, 2)
+            u, v   = chroma[..., 0], chroma[..., 1]
+        else:
+            u, v   = chroma.reshape(2, height // 2, width // 2)
+
+        u = u.astype(np.float32).repeat(2, axis=0).repeat(2, axis=1) - 128
+        v = v.astype(np.float32).repeat(2, axis=0).repeat(2, axis=1) - 128
+
+        y   = y * 1.164
+        rgb = np.stack([ y + 1.596 * v, y - 0.392 * u - 0.813 * v, y + 2.017 * u ], axis=-1)
+        return np.clip(rgb, 0, 255).astype(np.uint8)
+
+    def get_image(self, index : int, max_size : int = None, as_numpy : bool = False) -> Image:
         """
         Gets an image from the requests 'files' array that was passed in as 
         part of a HTTP POST.
-        Param: index - the index of the image to return
+        Param: index    - the index of the image to return
+        Param: max_size - if provided, the image is scaled down (keeping its
+                          aspect ratio) so neither side is larger than this.
+                          For JPEGs the decoder does most of the scaling as it
+                          decodes, which is far quicker than decoding the full
+                          image and resizing. Use get_image_size to get the
+                          size of the original image (eg to scale coordinates
+                          back to the original).
+        Param: as_numpy - if True, returns the image as a (height, width, 3)
+                          RGB numpy array rather than as a PIL Image.
         Returns: An image if successful; None otherwise.
 
+        NOTE: Images sent as raw pixels (see get_raw_image_format) are returned
+        at their full size regardless of max_size, since the caller's own
+        resize will do the job just as well. With as_numpy, rgb24 and bgr24
+        images are returned as read only views over the request's bytes, so
+        nothing is copied.
+
         NOTE: It's probably worth helping out users by sniffing EXIF data and
         rotating images prior to passing them to modules. This could be done
         client side (https://github.com/exif-js/exif-js/blob/master/exif.js) or
         call PIL.ImageOps.exif_transpose here. See
         https://pillow.readthedocs.io/en/latest/reference/ImageOps.html#PIL.ImageOps.exif_transpose
+
+        NOTE: The image is decoded only once. Each call for the same index (and
+        max_size, as_numpy) gets the same object, so copy it before changing it
+        in place.
         """
 
+        cache_key = (index, max_size, as_numpy)
+        if cache_key in self._images:
+            return self._images[cache_key]
+
+        start_time = time.perf_counter()
         try:
-            if self.files is None or len(self.files) <= index:
+            img_bytes = self.get_file_bytes(index)
+            if img_bytes is None:
                 return None
 
-            img_file    = self.files[index]
-            img_dataB64 = img_file["data"]
-            img_bytes   = base64.b64decode(img_dataB64)
+            raw_format = self.get_raw_image_format(index)
+            if raw_format:
+                img = RequestData.decode_raw_image(img_bytes, *raw_format)
+                if not as_numpy:
+                    img = Image.fromarray(img.copy() if img.strides[1] < 0 else img)
+                self._images[cache_key] = img
+                return img
             
             with io.BytesIO(img_bytes) as img_stream:
-                img = Image.open(img_stream).convert("RGB")
-                return img
+                img = Image.open(img_stream)
+                self._image_sizes[index] = img.size
+
+                if max_size and max(img.size) > max_size:
+                    scale       = max_size / max(img.size)
+                    target_size = (max(round(img.width * scale), 1), max(round(img.height * scale), 1))
+
+                    # For JPEGs, have the decoder scale by 1/2, 1/4 or 1/8 as it
+                    # decodes, staying at or above target_size. A no-op otherwise
+                    img.draft("RGB", target_size)
+                    img = img.convert("RGB")
+                    if img.size != target_size:
+                        img = img.resize(target_size, Image.BILINEAR)
+                else:
+                    img = img.convert("RGB")
+
+            if as_numpy:
+                import numpy as np
+                img = np.asarray(img)
+
+            self._images[cache_key] = img
+            return img
 
         except Exception as ex:
 
@@ -181,6 +466,33 @@ class RequestData:
             """
             return None
 
+        finally:
+            self.timings.add("decode", (time.perf_counter() - start_time) * 1000)
+
+    def get_image_size(self, index : int) -> "tuple[int, int]":
+        """
+        Gets the (width, height) of an image in the requests 'files' array, as
+        it was sent, regardless of any max_size passed to get_image. Only the
+        image's header is read, so this is cheap. Returns None on error.
+        """
+
+        raw_format = self.get_raw_image_format(index)
+        if raw_format:
+            return raw_format[1], raw_format[2]
+
+        if index not in self._image_sizes:
+            try:
+                img_bytes = self.get_file_bytes(index)
+                if img_bytes is None:
+                    return None
+
+                with io.BytesIO(img_bytes) as img_stream:
+                    self._image_sizes[index] = Image.open(img_stream).size
+            except Exception:
+                return None
+
+        return self._image_sizes[index]
+
     def get_value(self, key : str, defaultValue : str = None) -> str:
         """
         Gets a value from the HTTP request Form send by the client
@@ -193,49 +505,60 @@ class RequestData:
         ** WE ONLY RETURN THE FIRST VALUE HERE **
         """
 
-        try:
-            # value_list is a list. Note that in a HTML form, each element may
-            # have multiple values 
-            if self.value_list is None:
-                return defaultValue
-
-            for value in self.value_list:
-                if value["key"] == key :
-                    return value["value"][0]
-        
-            return defaultValue
+        values = self.get_values(key)
+        return values[0] if values else defaultValue
 
-        except Exception as ex:
-            if self._verbose_exceptions:
-                print(f"Error getting {key} from request data payload: {str(ex)}")
-            return defaultValue
+    def get_values(self, key : str) -> list:
+        """
+        Gets all the values for a key from the HTTP request Form send by the
+        client. Returns an empty list if there are none.
+        """
+
+        if self._value_index is None:
+            self._value_index = {}
+            try:
+                # value_list is a list. Note that in a HTML form, each element
+                # may have multiple values 
+                for value in self.value_list or []:
+                    if value["key"] not in self._value_index and value["value"]:
+                        self._value_index[value["key"]] = value["value"]
+
+            except Exception as ex:
+                if self._verbose_exceptions:
+                    print(f"Error reading the values from request data payload: {str(ex)}")
+
+        return self._value_index.get(key, [])
+
+    def _get_typed_value(self, key : str, convert: callable) -> any:
+        """
+        Gets the first value for a key, converted using convert. Returns None
+        if there's no value, or it can't be converted. The result is cached.
+        """
+        cache_key = (key, convert)
+        if cache_key not in self._typed_values:
+            value = self.get_value(key)
+            try:
+                self._typed_values[cache_key] = None if value is None else convert(value)
+            except:
+                self._typed_values[cache_key] = None
+
+        return self._typed_values[cache_key]
 
     def get_int(self, key : str, defaultValue : int = None) -> int:
 
-        value = self.get_value(key)
-        if value is None:
-            return defaultValue
-        
-        try:
-            return int(value)
-        except:
-            return defaultValue
+        value = self._get_typed_value(key, int)
+        return defaultValue if value is None else value
         
     def get_float(self, key : str, defaultValue : float = None) -> float:
 
-        value = self.get_value(key)
-        if value is None:
-            return defaultValue
-        
-        try:
-            return float(value)
-        except:
-            return defaultValue 
+        value = self._get_typed_value(key, float)
+        return defaultValue if value is None else value
         
     def get_bool(self, key : str, defaultValue : bool = None) -> bool:
 
-        value = self.get_value(key)
-        if value is None:
-            return defaultValue
-        
+        value = self._get_typed_value(key, RequestData._to_bool)
+        return defaultValue if value is None else value
+
+    @staticmethod
+    def _to_bool(value: str) -> bool:
         return value.lower() in [ 'y', 'yes', 't', 'true', 'on', '1' ]
\ No newline at end of file
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from common import JSON
+
+
+class ResponseSender:
+    """
+    Sends the results of processed requests back to the server. Responses are
+    placed on a queue and sent by a separate task, so the main loop can go
+    straight back to fetching the next command rather than waiting on the post.
+    Up to max_in_flight posts are made at once, failed posts are retried with
+    an increasing pause between tries, and where the server supports it, the
+    responses that have piled up are sent together in a single post.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, base_queue_url: str, max_in_flight: int = 4,
+                 max_batch_size: int = 16, max_retries: int = 3,
+                 retry_pause_secs: float = 0.25) -> None:
+
+        self.base_queue_url   = base_queue_url
+        self.max_in_flight    = max(max_in_flight, 1)
+        self.max_batch_size   = max(max_batch_size, 1)
+        self.max_retries      = max_retries
+        self.retry_pause_secs = retry_pause_secs
+
+        self._verbose_exceptions = True
+        self._request_session    = session
+        self.transport           = None   # If set, and connected, send over this instead
+        self.timing_stats        = None   # If set, the encode and send times are recorded here
+        self._response_queue     = asyncio.Queue()
+        self._in_flight_slots    = asyncio.Semaphore(self.max_in_flight)
+        self._in_flight_tasks    = set()
+
+        # None = not yet known. We find out the first time we try
+        self._batch_supported    = None
+
+    def queue_response(self, request_id: str, body: JSON, url_params: str = "") -> None:
+        """
+        Queues a response for sending. Returns immediately.
+        Param: request_id - the ID of the request that was originally pulled
+                            from the command queue.
+        Param: body       - the JSON result of processing the request.
+        Param: url_params - the query string (moduleId etc) to add to the post
+        """
+        self._response_queue.put_nowait((request_id, body, url_params))
+
+    async def close(self) -> None:
+        """ Sends whatever is still queued, and then stops the sending loop """
+        await self._response_queue.put(None)
+
+    async def sending_loop(self) -> None:
+        """
+        Takes responses off the queue and posts them, until close is called and
+        the queue has been emptied.
+        """
+        closing = False
+
+        while not closing:
+            entry = await self._response_queue.get()
+            if entry is None:
+                break
+
+            # Take whatever else is already waiting, up to the batch size. If
+            # the server can't take batches we'll still post them concurrently
+            batch = [ entry ]
+            while len(batch) < self.max_batch_size and not self._response_queue.empty():
+                entry = self._response_queue.get_nowait()
+                if entry is None:
+                    closing = True
+                    break
+                batch.append(entry)
+
+            if self._batch_supported == False or self._transport_connected:
+                for entry in batch:
+                    await self._start_post([ entry ])
+            else:
+                await self._start_post(batch)
+
+        if self._in_flight_tasks:
+            await asyncio.gather(*self._in_flight_tasks, return_exceptions=True)
+
+    async def _start_post(self, batch: list) -> None:
+        """ Waits for an in-flight slot and starts the post in a separate task """
+        await self._in_flight_slots.acquire()
+        task = asyncio.create_task(self._post(batch))
+        self._in_flight_tasks.add(task)
+        task.add_done_callback(self._in_flight_tasks.discard)
+
+    async def _post(self, batch: list) -> None:
+        try:
+            if len(batch) > 1:
+                if await self._post_batch(batch):
+                    return
+
+                # The server can't take a batch (or didn't this time), so
+                # send them one at a time
+                sent = await asyncio.gather(*[ self._post_with_retry(*entry) for entry in batch ])
+            else:
+                sent = [ await self._post_with_retry(*batch[0]) ]
+
+            for (request_id, _, _), was_sent in zip(batch, sent):
+                if not was_sent:
+                    print(f"Error sending response: Gave up on the response for request {request_id}")
+        finally:
+            self._in_flight_slots.release()
+
+    async def _post_batch(self, batch: list) -> bool:
+        """
+        Posts a batch of responses in one call. Returns False if the batch
+        wasn't taken, because the server doesn't support batches (it doesn't
+        know the endpoint), rejected the batch, or every try failed, in which
+        case the responses should be posted one at a time instead.
+        """
+        encode_start = time.perf_counter()
+        body = json.dumps([ { "reqid": request_id, "response": response }
+                            for (request_id, response, _) in batch ])
+        url  = self.base_queue_url + "responses" + batch[0][2]
+
+        encode_ms = (time.perf_counter() - encode_start) * 1000 / len(batch)
+        for (_, response, _) in batch:
+            self._record_time(response, "result_encode", encode_ms)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                send_start = time.perf_counter()
+                async with self._request_session.post(url, data = body,
+                                                      timeout = 10) as response:
+                    send_ms = (time.perf_counter() - send_start) * 1000
+                    for (_, batch_response, _) in batch:
+                        self._record_time(batch_response, "response_send", send_ms)
+
+                    if response.status < 400:
+                        self._batch_supported = True
+                        return True
+
+                    # An older server won't know this endpoint. Anything else
+                    # (eg a server error) doesn't tell us batches aren't
+                    # supported, so we carry on trying them
+                    if response.status in (404, 405):
+                        self._batch_supported = False
+                        return False
+
+                    # The server rejected something in the batch. Sending it
+                    # again won't help, but sending each response on its own
+                    # means only the bad one is rejected
+                    if response.status < 500:
+                        return False
+
+            except Exception as ex:
+                self._report_error(ex)
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.retry_pause_secs * (2 ** attempt))
+
+        return False
+
+    async def _post_with_retry(self, request_id: str, body: JSON, url_params: str) -> bool:
+        """ Posts a single response. Returns True on success; False otherwise """
+        for attempt in range(self.max_retries + 1):
+            if await self.post(request_id, body, url_params):
+                return True
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.retry_pause_secs * (2 ** attempt))
+
+        return False
+
+    async def post(self, request_id: str, body: JSON, url_params: str = "") -> bool:
+        """
+        Posts a single response to the server right now. Returns True on
+        success, or if the server rejected the response (there's no point
+        trying again); False if it's worth trying again.
+        """
+        if self._transport_connected:
+            send_start = time.perf_counter()
+            if await self.transport.send_response(request_id, body):
+                self._record_time(body, "response_send", (time.perf_counter() - send_start) * 1000)
+                return True
+
+        try:
+            encode_start = time.perf_counter()
+            content      = json.dumps(body)
+            self._record_time(body, "result_encode", (time.perf_counter() - encode_start) * 1000)
+
+            url        = self.base_queue_url + request_id + url_params
+            send_start = time.perf_counter()
+            async with self._request_session.post(url, data = content,
+                                                  timeout = 10) as response:
+                self._record_time(body, "response_send", (time.perf_counter() - send_start) * 1000)
+                return response.status < 500
+
+        except Exception as ex:
+            self._report_error(ex)
+            return False
+
+    def _record_time(self, body: JSON, stage: str, ms: float) -> None:
+        """ Records the time spent on a stage for the command a response is for """
+        if self.timing_stats is not None and isinstance(body, dict):
+            self.timing_stats.record(body.get("command"), stage, ms)
+
+    @property
+    def _transport_connected(self) -> bool:
+        return self.transport is not None and self.transport.connected
+
+    def _report_error(self, ex: Exception) -> None:
+        if self._verbose_exceptions:
+            print(f"Error sending response: {str(ex)}")
+        else:
+            print(f"Error sending response: Is the API Server running? [" + ex.__class__.__name__ + "]")
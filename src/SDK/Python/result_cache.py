@@ -0,0 +1,165 @@
+import asyncio
+from collections import OrderedDict
+import copy
+import hashlib
+import json
+import time
+
+from common import JSON
+from request_data import RequestData
+
+
+class ResultCache:
+    """
+    Holds the results of recently processed requests, keyed by a hash of what
+    was sent (the command, URL segments, values and file contents), so that a
+    request that's identical to one we've just processed (eg a client retrying,
+    or sending the same snapshot once for each of several zones) gets the
+    earlier result rather than paying for inference all over again.
+
+    Results are dropped once they're older than ttl_secs, and the least
+    recently used results are dropped when the (approximate) size of all the
+    results we hold goes over max_bytes. If an identical request arrives while
+    the first is still being processed, it waits for and shares that result
+    rather than being processed a second time (unless the first is cancelled,
+    in which case one of those waiting processes it instead).
+    """
+
+    def __init__(self, max_bytes: int, ttl_secs: float) -> None:
+        self.max_bytes  = max_bytes
+        self.ttl_secs   = ttl_secs
+
+        self.hits       = 0
+        self.misses     = 0
+
+        self._entries   = OrderedDict()   # key => (expiry time, size, result)
+        self._size      = 0
+        self._in_flight = {}              # key => future for the result being computed
+
+    @staticmethod
+    def make_key(data: RequestData, include_files: bool = True) -> str:
+        """
+        Returns a hash of everything in the request that may affect its result.
+        If include_files is False, the contents of the files are left out.
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+
+        header = {
+            "command":  data.command,
+            "segments": data.segments,
+            "values":   sorted([ (entry.get("key"), entry.get("value")) for entry in data.value_list or [] ],
+                               key = lambda entry: str(entry[0]))
+        }
+        hasher.update(json.dumps(header, default=str).encode("utf-8"))
+
+        for file in (data.files or []) if include_files else []:
+            hasher.update(str(file.get("contentType")).encode("utf-8"))
+            if file.get("bytes") is not None:
+                hasher.update(file["bytes"])
+            else:
+                hasher.update(str(file.get("data")).encode("ascii"))
+
+        return hasher.hexdigest()
+
+    @property
+    def size(self) -> int:
+        """ The approximate size, in bytes, of the results held """
+        return self._size
+
+    def get(self, key: str) -> JSON:
+        """
+        Returns a copy of the result held for the given key, or None. The copy
+        is a deep one, as the caller is free to change what's in the result
+        (eg its list of predictions).
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, size, result = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return copy.deepcopy(result)
+
+    def put(self, key: str, result: JSON) -> None:
+        """ Stores a (successful) result, dropping older results to make room """
+        if not isinstance(result, dict) or result.get("success") != True:
+            return
+
+        try:
+            size = len(json.dumps(result, default=str))
+        except Exception:
+            return
+
+        if size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl_secs, size, copy.deepcopy(result))
+        self._size += size
+
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    async def get_or_compute(self, key: str, compute) -> JSON:
+        """
+        Returns the result for the given key, either from the cache, from an
+        identical request that's currently being processed, or by awaiting
+        compute() and caching what it returns. If the identical request we're
+        waiting on is cancelled, we compute the result ourselves instead.
+        """
+        while True:
+            result = self.get(key)
+            if result is not None:
+                self.hits += 1
+                return result
+
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                break
+
+            try:
+                result = await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                # If it's the request we were waiting on that was cancelled,
+                # rather than us, take its place (or wait on whoever has)
+                if in_flight.cancelled():
+                    continue
+                raise
+
+            self.hits += 1
+            return copy.deepcopy(result)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await compute()
+            self.put(key, result)
+            future.set_result(copy.deepcopy(result))
+            return result
+
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+        except Exception as ex:
+            future.set_exception(ex)
+            future.exception()   # Marks it as retrieved even if no one else was waiting
+            raise
+
+        finally:
+            del self._in_flight[key]
+
+    def clear(self) -> None:
+        """ Drops every result held """
+        self._entries.clear()
+        self._size = 0
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
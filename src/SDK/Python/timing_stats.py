@@ -0,0 +1,109 @@
+from collections import deque
+from contextlib import contextmanager
+import time
+
+from common import JSON
+
+
+class RequestTimings:
+    """
+    The time, in milliseconds, spent in each stage of handling a single
+    request. The SDK records the stages it handles (eg "queue_fetch", "parse",
+    "decode") and modules can record their own (eg "preprocess", "inference",
+    "postprocess") via span or add. Time spent in a stage more than once (eg
+    decoding two images) is added together.
+    """
+
+    def __init__(self) -> None:
+        self.stages = {}
+
+    @contextmanager
+    def span(self, stage: str):
+        """
+        Times the code in a with block as the given stage, eg
+            with data.timings.span("inference"):
+                results = model(img)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, (time.perf_counter() - start) * 1000)
+
+    def add(self, stage: str, ms: float) -> None:
+        """ Adds the given time, in ms, to a stage """
+        self.stages[stage] = self.stages.get(stage, 0) + ms
+
+    def merge(self, stages: dict) -> None:
+        """ Adds the times of the stages from another set of timings """
+        for stage, ms in (stages or {}).items():
+            self.add(stage, ms)
+
+    def as_dict(self) -> JSON:
+        return { stage: round(ms, 1) for stage, ms in self.stages.items() }
+
+
+class TimingStats:
+    """
+    Rolling statistics on the time spent in each stage, per command. Only the
+    last window_size times for each stage of each command are kept, so the
+    percentiles reflect recent performance.
+    """
+
+    def __init__(self, window_size: int = 1000) -> None:
+        self.window_size = window_size
+        self._windows    = {}   # command => stage => deque of times in ms
+        self._counts     = {}   # command => stage => number of times recorded
+
+    def record(self, command: str, stage: str, ms: float) -> None:
+        """ Records the time, in ms, spent in a stage for a command """
+        command = command or ""
+        windows = self._windows.setdefault(command, {})
+        if stage not in windows:
+            windows[stage] = deque(maxlen=self.window_size)
+        windows[stage].append(ms)
+
+        counts = self._counts.setdefault(command, {})
+        counts[stage] = counts.get(stage, 0) + 1
+
+    def record_timings(self, command: str, timings: RequestTimings) -> None:
+        """ Records the time spent in each stage of a request """
+        for stage, ms in timings.stages.items():
+            self.record(command, stage, ms)
+
+    def recent_percentile(self, command: str, stage: str, percent: float = 50) -> float:
+        """ Returns a percentile of the recent times for a stage of a command, or None """
+        window = self._windows.get(command or "", {}).get(stage)
+        if not window:
+            return None
+        return TimingStats.percentile(sorted(window), percent)
+
+    def summary(self) -> JSON:
+        """
+        Returns, for each command and stage, the number of times recorded and
+        the mean and 50th, 95th and 99th percentile times (in ms) of the most
+        recent.
+        """
+        summary = {}
+        for command, windows in self._windows.items():
+            summary[command] = {}
+            for stage, window in windows.items():
+                times = sorted(window)
+                summary[command][stage] = {
+                    "count": self._counts[command][stage],
+                    "mean":  round(sum(times) / len(times), 1),
+                    "p50":   round(TimingStats.percentile(times, 50), 1),
+                    "p95":   round(TimingStats.percentile(times, 95), 1),
+                    "p99":   round(TimingStats.percentile(times, 99), 1)
+                }
+
+        return summary
+
+    @staticmethod
+    def percentile(sorted_times: list, percent: float) -> float:
+        """ Returns the given percentile of a sorted list (nearest rank) """
+        if not sorted_times:
+            return 0.0
+
+        index = max(int(round(percent / 100.0 * len(sorted_times))) - 1, 0)
+        return sorted_times[min(index, len(sorted_times) - 1)]
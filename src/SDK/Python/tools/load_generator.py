@@ -0,0 +1,274 @@
+"""
+Generates load against a CodeProject.AI Server (or tools/queue_server.py) to
+measure module throughput and latency. Requests post the images in a folder
+to one or more endpoints, picked at random in proportion to their weights.
+
+Closed loop (the default): --concurrency clients each send a request, wait for
+the response, and send the next. This measures the most the module can do.
+
+Open loop: with --rate, requests are sent at that many per second (with
+exponential, ie Poisson, gaps between them, or evenly spaced with
+--arrival uniform) whether or not earlier requests have finished, the way
+independent cameras would send them. Latency is measured from when each
+request was due to be sent, so queueing shows up in the percentiles.
+
+Requests sent during the first --warmup seconds aren't counted. The report
+(latency percentiles, throughput and errors, overall and per endpoint) is
+printed, and written as JSON to --output if given.
+
+Usage:
+    python queue_server.py --port 32168 --route vision/detection=objectdetection_queue:detect
+    CPAI_PORT=32168 python ../../../modules/ObjectDetectionYolo/detect_adapter.py
+    python load_generator.py --input ../../../modules/ObjectDetectionYolo/test \\
+                             --endpoint vision/detection --rate 20 --duration 60
+"""
+
+import argparse
+import asyncio
+import json
+import mimetypes
+import os
+import random
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from timing_stats import TimingStats
+
+
+class LoadResults:
+    """ The latencies and errors of the requests sent to each endpoint """
+
+    def __init__(self) -> None:
+        self.latencies = {}   # endpoint => list of latencies in ms
+        self.errors    = {}   # endpoint => error => count
+        self.skipped   = 0    # open loop requests not sent as too many were in flight
+
+    def add(self, endpoint: str, latency_ms: float, error: str = None) -> None:
+        if error:
+            errors = self.errors.setdefault(endpoint, {})
+            errors[error] = errors.get(error, 0) + 1
+        else:
+            self.latencies.setdefault(endpoint, []).append(latency_ms)
+
+    @staticmethod
+    def _summarise(latencies: list, errors: dict, elapsed: float) -> dict:
+        times = sorted(latencies)
+        return {
+            "requests":   len(times) + sum(errors.values()),
+            "errors":     sum(errors.values()),
+            "errorTypes": errors,
+            "throughput": round(len(times) / elapsed, 2) if elapsed > 0 else 0,
+            "latencyMs": {
+                "mean": round(sum(times) / len(times), 1) if times else 0,
+                "p50":  round(TimingStats.percentile(times, 50), 1),
+                "p95":  round(TimingStats.percentile(times, 95), 1),
+                "p99":  round(TimingStats.percentile(times, 99), 1),
+                "max":  round(times[-1], 1) if times else 0
+            }
+        }
+
+    def report(self, elapsed: float) -> dict:
+        endpoints   = sorted(set(self.latencies) | set(self.errors))
+        all_times   = [ ms for endpoint in endpoints for ms in self.latencies.get(endpoint, []) ]
+        all_errors  = {}
+        for endpoint in endpoints:
+            for error, count in self.errors.get(endpoint, {}).items():
+                all_errors[error] = all_errors.get(error, 0) + count
+
+        report = LoadResults._summarise(all_times, all_errors, elapsed)
+        report["durationSecs"] = round(elapsed, 2)
+        report["skipped"]      = self.skipped
+        report["endpoints"]    = { endpoint: LoadResults._summarise(self.latencies.get(endpoint, []),
+                                                                    self.errors.get(endpoint, {}), elapsed)
+                                   for endpoint in endpoints }
+        return report
+
+
+class LoadGenerator:
+
+    def __init__(self, options: argparse.Namespace, images: list, endpoints: list, weights: list) -> None:
+        self.options   = options
+        self.images    = images      # (file name, content type, contents)
+        self.endpoints = endpoints
+        self.weights   = weights
+        self.values    = [ entry.split("=", 1) for entry in options.value if "=" in entry ]
+
+        self.results   = LoadResults()
+        self._count    = 0           # requests sent, used to step through the images
+        self._session  = None
+
+    def _form(self) -> aiohttp.FormData:
+        file_name, content_type, content = self.images[self._count % len(self.images)]
+        self._count += 1
+
+        form = aiohttp.FormData()
+        for key, value in self.values:
+            form.add_field(key, value)
+        form.add_field("image", content, filename=file_name, content_type=content_type)
+        return form
+
+    async def _send(self, due_time: float, record: bool) -> None:
+        """ Sends a request, measuring latency from when it was due to be sent """
+        endpoint = random.choices(self.endpoints, self.weights)[0]
+        url      = self.options.url.rstrip("/") + "/v1/" + endpoint.strip("/")
+
+        error = None
+        try:
+            async with self._session.post(url, data=self._form()) as response:
+                if response.status != 200:
+                    error = f"HTTP {response.status}"
+                else:
+                    body = await response.json(content_type=None)
+                    if not isinstance(body, dict) or not body.get("success"):
+                        error = "unsuccessful"
+        except asyncio.TimeoutError:
+            error = "timeout"
+        except aiohttp.ClientError as ex:
+            error = ex.__class__.__name__
+        except ValueError:
+            error = "invalid response"
+
+        if record:
+            self.results.add(endpoint, (time.perf_counter() - due_time) * 1000, error)
+
+    async def _closed_loop(self, start_time: float, end_time: float) -> None:
+        async def client() -> None:
+            while time.perf_counter() < end_time:
+                sent_time = time.perf_counter()
+                await self._send(sent_time, sent_time >= start_time)
+
+        await asyncio.gather(*[ client() for _ in range(self.options.concurrency) ])
+
+    async def _open_loop(self, start_time: float, end_time: float) -> None:
+        in_flight = set()
+        due_time  = time.perf_counter()
+
+        while due_time < end_time:
+            delay = due_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if len(in_flight) < self.options.max_in_flight:
+                task = asyncio.create_task(self._send(due_time, due_time >= start_time))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            elif due_time >= start_time:
+                self.results.skipped += 1
+
+            if self.options.arrival == "uniform":
+                due_time += 1.0 / self.options.rate
+            else:
+                due_time += random.expovariate(self.options.rate)
+
+        if in_flight:
+            await asyncio.gather(*in_flight)
+
+    async def run(self) -> dict:
+        timeout = aiohttp.ClientTimeout(total=self.options.timeout)
+        limit   = self.options.max_in_flight if self.options.rate > 0 else self.options.concurrency
+        async with aiohttp.ClientSession(timeout=timeout,
+                                         connector=aiohttp.TCPConnector(limit=limit)) as session:
+            self._session = session
+
+            start_time = time.perf_counter() + self.options.warmup
+            end_time   = start_time + self.options.duration
+
+            if self.options.rate > 0:
+                await self._open_loop(start_time, end_time)
+            else:
+                await self._closed_loop(start_time, end_time)
+
+            # Closed loop requests, and open loop requests still in flight,
+            # can finish after end_time, so the throughput is over the time
+            # actually taken
+            elapsed = max(time.perf_counter(), end_time) - start_time
+
+        report = self.results.report(elapsed)
+        report["mode"] = "open" if self.options.rate > 0 else "closed"
+        if self.options.rate > 0:
+            report["offeredRate"] = self.options.rate
+        else:
+            report["concurrency"] = self.options.concurrency
+        return report
+
+
+def load_images(folder: str) -> list:
+    """ Returns (file name, content type, contents) for each image in the folder """
+    images = []
+    for file_name in sorted(os.listdir(folder)):
+        content_type, _ = mimetypes.guess_type(file_name)
+        if content_type and content_type.startswith("image/"):
+            with open(os.path.join(folder, file_name), "rb") as file:
+                images.append((file_name, content_type, file.read()))
+    return images
+
+
+def parse_endpoints(endpoint_args: list) -> "tuple[list, list]":
+    """ Turns [ "vision/detection=3", "vision/face" ] into endpoints and weights """
+    endpoints, weights = [], []
+    for endpoint_arg in endpoint_args or [ "vision/detection" ]:
+        endpoint, _, weight = endpoint_arg.partition("=")
+        endpoints.append(endpoint.strip("/"))
+        weights.append(float(weight) if weight else 1.0)
+    return endpoints, weights
+
+
+def print_report(report: dict) -> None:
+    def line(name: str, summary: dict) -> str:
+        latency = summary["latencyMs"]
+        return f"{name:30} {summary['requests']:8} {summary['errors']:7} {summary['throughput']:8.1f}/s " + \
+               f"{latency['mean']:8.1f} {latency['p50']:8.1f} {latency['p95']:8.1f} " + \
+               f"{latency['p99']:8.1f} {latency['max']:8.1f}"
+
+    print(f"{'':30} {'requests':>8} {'errors':>7} {'rate':>10} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for endpoint, summary in report["endpoints"].items():
+        print(line(endpoint, summary))
+    print(line("all", report))
+
+    for error, count in report["errorTypes"].items():
+        print(f"  {count} x {error}")
+    if report["skipped"]:
+        print(f"  {report['skipped']} requests not sent as --max-in-flight requests were already in flight")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generates load against CodeProject.AI Server endpoints")
+    parser.add_argument("--url",           default="http://localhost:32168", help="The server's base URL")
+    parser.add_argument("--input",         required=True, help="The folder of images to send")
+    parser.add_argument("--endpoint",      action="append",
+                        help="A route to send requests to, with an optional weight, eg vision/detection=3. May be repeated")
+    parser.add_argument("--value",         action="append", default=[],
+                        help="A value to send with each request, as key=value. May be repeated")
+    parser.add_argument("--concurrency",   type=int,   default=4,  help="The number of clients, for a closed loop")
+    parser.add_argument("--rate",          type=float, default=0,  help="Requests per second, for an open loop")
+    parser.add_argument("--arrival",       choices=["poisson", "uniform"], default="poisson",
+                        help="How open loop requests are spaced")
+    parser.add_argument("--max-in-flight", type=int,   default=1000, help="The most open loop requests to have in flight")
+    parser.add_argument("--duration",      type=float, default=30, help="How long to measure for, in seconds")
+    parser.add_argument("--warmup",        type=float, default=5,  help="How long to run before measuring, in seconds")
+    parser.add_argument("--timeout",       type=float, default=60, help="How long to wait for each response, in seconds")
+    parser.add_argument("--output",        help="A file to write the JSON report to")
+    options = parser.parse_args()
+
+    images = load_images(options.input)
+    if not images:
+        print(f"No images found in {options.input}", file=sys.stderr)
+        sys.exit(1)
+
+    endpoints, weights = parse_endpoints(options.endpoint)
+    options.concurrency   = max(options.concurrency, 1)
+    options.max_in_flight = max(options.max_in_flight, 1)
+
+    report = asyncio.run(LoadGenerator(options, images, endpoints, weights).run())
+
+    print_report(report)
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
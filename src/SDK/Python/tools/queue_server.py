@@ -0,0 +1,343 @@
+"""
+A stand-in for the CodeProject.AI Server's queue, for testing modules without
+the .NET server. It provides the endpoints a module uses
+
+    GET  /v1/queue/{queue_name}         long-poll for the next request (add
+                                        binary=true to get binary frames, or
+                                        lane=control for control commands only)
+    GET  /v1/queue/{queue_name}/ws      a WebSocket for requests and responses
+    POST /v1/queue/{reqid}              the response to a request
+    POST /v1/queue/responses            the responses to several requests
+    POST /v1/log/                       a log entry
+    POST /v1/log/batch                  several log entries
+
+and the client API endpoint
+
+    POST /v1/{route}                    eg /v1/vision/detection
+
+which takes the usual form values and files, queues a request for the module,
+and returns the module's response. Routes are mapped to queues and commands
+with --route (eg --route vision/detection=objectdetection_queue:detect).
+Anything else goes to the queue named by --queue, with the last segment of the
+route as the command.
+
+Usage:
+    python queue_server.py --port 32168 --queue objectdetection_queue
+
+then start the module with CPAI_PORT set to the same port. load_generator.py
+can then be used to put load on the module through the client API endpoint.
+"""
+
+import argparse
+import asyncio
+import base64
+from collections import deque
+import json
+import os
+import sys
+import time
+import uuid
+
+from aiohttp import web, WSMsgType
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from request_data import RequestData
+
+
+# Commands that are cheap to handle, so are queued in a control lane that's
+# served before the main queue (as per the server's QueueProcessing:ControlCommands)
+CONTROL_COMMANDS = [ "status", "list-custom", "list" ]
+CONTROL_LANE     = "control"
+
+
+class LaneQueue:
+    """ A queue with a control lane whose requests are taken before any others """
+
+    def __init__(self) -> None:
+        self._control = deque()
+        self._main    = deque()
+        self._changed = asyncio.Condition()
+
+    async def put(self, item: any, control: bool = False, front: bool = False) -> None:
+        async with self._changed:
+            lane = self._control if control else self._main
+            if front:
+                lane.appendleft(item)
+            else:
+                lane.append(item)
+            self._changed.notify_all()
+
+    async def get(self, control_only: bool = False) -> any:
+        async with self._changed:
+            while True:
+                if self._control:
+                    return self._control.popleft()
+                if self._main and not control_only:
+                    return self._main.popleft()
+                await self._changed.wait()
+
+
+class QueueServer:
+
+    def __init__(self, default_queue: str, routes: dict, dequeue_timeout: float = 10,
+                 response_timeout: float = 60) -> None:
+
+        self.default_queue    = default_queue
+        self.routes           = routes
+        self.dequeue_timeout  = dequeue_timeout
+        self.response_timeout = response_timeout
+
+        self._queues          = {}
+        self._pending         = {}
+
+    def queue(self, queue_name: str) -> LaneQueue:
+        queue_name = queue_name.lower()
+        if queue_name not in self._queues:
+            self._queues[queue_name] = LaneQueue()
+        return self._queues[queue_name]
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size = 64 * 1024 * 1024)
+        app.router.add_post("/v1/queue/responses",    self.set_responses)
+        app.router.add_get("/v1/queue/{name}/ws",     self.queue_websocket)
+        app.router.add_get("/v1/queue/{name}",        self.get_request)
+        app.router.add_post("/v1/queue/{reqid}",      self.set_response)
+        app.router.add_post("/v1/log/",               self.log)
+        app.router.add_post("/v1/log/batch",          self.log_batch)
+        app.router.add_post("/v1/{route:.+}",         self.client_request)
+        return app
+
+    async def enqueue(self, queue_name: str, command: str, values: list, files: list,
+                      segments: list = None) -> dict:
+        """
+        Queues a request and waits for the module's response. files is a list
+        of (file info, file contents) tuples.
+        """
+
+        request_id = str(uuid.uuid4())
+        request    = {
+            "reqid":   request_id,
+            "reqtype": command,
+            "deadline": int((time.time() + self.response_timeout) * 1000),
+            "payload": {
+                "queue":       queue_name,
+                "urlSegments": segments or [],
+                "command":     command,
+                "values":      values,
+                "files":       [ file_info for (file_info, _) in files ]
+            }
+        }
+
+        response = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = response
+        await self.queue(queue_name).put((request, [ content for (_, content) in files ]),
+                                         command.lower() in CONTROL_COMMANDS)
+
+        try:
+            return await asyncio.wait_for(response, self.response_timeout)
+        except asyncio.TimeoutError:
+            return { "success": False, "error": "The request timed out" }
+        finally:
+            self._pending.pop(request_id, None)
+
+    def save_response(self, request_id: str, response: dict) -> bool:
+        future = self._pending.get(request_id)
+        if future is None or future.done():
+            return False
+
+        future.set_result(response)
+        return True
+
+    async def take(self, queue_name: str, control_only: bool = False) -> "tuple[dict, list]":
+        """
+        Waits for the next request on the given queue (or just its control
+        lane). Returns the request and the contents of its files, or
+        (None, None) if nothing arrived in time.
+        """
+        try:
+            return await asyncio.wait_for(self.queue(queue_name).get(control_only), self.dequeue_timeout)
+        except asyncio.TimeoutError:
+            return None, None
+
+    def format_request(self, request: dict, contents: list, binary: bool = False) -> any:
+        """
+        Returns a request as a binary frame if binary is True and the request
+        has files, or JSON otherwise. Returns an empty string for no request.
+        """
+        if request is None:
+            return ""
+
+        if binary and contents:
+            return RequestData.encode_frame(request, contents)
+
+        request = dict(request)
+        request["payload"] = dict(request["payload"])
+        request["payload"]["files"] = [ { **file_info, "data": base64.b64encode(content).decode("ascii") }
+                                        for file_info, content in zip(request["payload"]["files"], contents) ]
+        return json.dumps(request)
+
+    async def dequeue(self, queue_name: str, binary: bool = False, control_only: bool = False) -> any:
+        """
+        Waits for the next request on the given queue (or just its control
+        lane). Returns the request as a binary frame if binary is True and the
+        request has files, or JSON otherwise. Returns an empty string if nothing
+        arrived in time.
+        """
+        request, contents = await self.take(queue_name, control_only)
+        return self.format_request(request, contents, binary)
+
+    # Module facing endpoints
+
+    async def get_request(self, request: web.Request) -> web.Response:
+        binary       = request.query.get("binary", "").lower() == "true"
+        control_only = request.query.get("lane", "").lower() == CONTROL_LANE
+        headers      = { "X-Queue-Lane": CONTROL_LANE } if control_only else None
+
+        content = await self.dequeue(request.match_info["name"], binary, control_only)
+        if not content:
+            return web.Response(status = 204, headers = headers)
+        if isinstance(content, bytes):
+            return web.Response(body = content, content_type = RequestData.FRAME_CONTENT_TYPE,
+                                headers = headers)
+        return web.Response(text = content, content_type = "application/json", headers = headers)
+
+    async def set_response(self, request: web.Request) -> web.Response:
+        response = json.loads(await request.text())
+        if not self.save_response(request.match_info["reqid"], response):
+            return web.Response(status = 400, text = "failure to set response.")
+        return web.Response(text = "Response saved.")
+
+    async def set_responses(self, request: web.Request) -> web.Response:
+        saved = 0
+        for entry in json.loads(await request.text()):
+            if self.save_response(entry.get("reqid"), entry.get("response")):
+                saved += 1
+        return web.Response(text = f"{saved} responses saved.")
+
+    async def queue_websocket(self, request: web.Request) -> web.WebSocketResponse:
+        socket     = web.WebSocketResponse()
+        await socket.prepare(request)
+
+        queue_name = request.match_info["name"]
+        binary     = request.query.get("binary", "").lower() == "true"
+        print(f"WebSocket opened for {queue_name} by {request.query.get('moduleId', 'unknown')}", flush = True)
+
+        send_lock  = asyncio.Lock()
+        sends      = set()
+
+        async def send_request(get_id: int) -> None:
+            # Don't take a request off the queue for a module that's gone
+            if socket.closed:
+                return
+
+            request, contents = await self.take(queue_name)
+            sent = False
+            try:
+                content = self.format_request(request, contents, binary)
+                async with send_lock:
+                    if not socket.closed:
+                        # Each reply starts with the id of the get it answers
+                        if isinstance(content, bytes):
+                            await socket.send_bytes(get_id.to_bytes(4, "little") + content)
+                        else:
+                            await socket.send_str(f"{get_id}\n{content}")
+                        sent = True
+            finally:
+                # The socket closed between taking the request and sending it,
+                # so put it back (at the front) for the module to take once it's
+                # reconnected
+                if not sent and request is not None:
+                    await self.queue(queue_name).put((request, contents),
+                                                     request["reqtype"].lower() in CONTROL_COMMANDS,
+                                                     front = True)
+
+        async for message in socket:
+            if message.type != WSMsgType.TEXT:
+                continue
+
+            entry = json.loads(message.data)
+            if entry.get("type") == "get":
+                task = asyncio.create_task(send_request(int(entry.get("id") or 0)))
+                sends.add(task)
+                task.add_done_callback(sends.discard)
+            elif entry.get("type") == "response":
+                self.save_response(entry.get("reqid"), entry.get("response"))
+
+        for task in list(sends):
+            task.cancel()
+
+        return socket
+
+    async def log(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        print(f"{form.get('log_level', 'info')}: {form.get('label', '')} {form.get('entry', '')}",
+              flush = True)
+        return web.json_response({ "success": True })
+
+    async def log_batch(self, request: web.Request) -> web.Response:
+        for entry in json.loads(await request.text()):
+            print(f"{entry.get('log_level') or 'info'}: {entry.get('label') or ''} {entry.get('entry') or ''}",
+                  flush = True)
+        return web.json_response({ "success": True })
+
+    # Client facing endpoint
+
+    async def client_request(self, request: web.Request) -> web.Response:
+        route = request.match_info["route"].strip("/")
+
+        queue_name, command, segments = None, None, []
+        for prefix, (route_queue, route_command) in self.routes.items():
+            if route == prefix or route.startswith(prefix + "/"):
+                queue_name, command = route_queue, route_command
+                segments = [ s for s in route[len(prefix):].split("/") if s ]
+                break
+
+        if queue_name is None:
+            queue_name = self.default_queue
+            command    = route.split("/")[-1]
+
+        values = []
+        files  = []
+        form   = await request.post()
+        for key in form.keys():
+            for value in form.getall(key):
+                if isinstance(value, web.FileField):
+                    files.append(({
+                        "name":        key,
+                        "filename":    value.filename,
+                        "contentType": value.content_type
+                    }, value.file.read()))
+                else:
+                    values.append({ "key": key, "value": [ value ] })
+
+        response = await self.enqueue(queue_name, command, values, files, segments)
+        return web.json_response(response)
+
+
+def parse_routes(route_args: list) -> dict:
+    """ Turns [ "vision/detection=objectdetection_queue:detect", ... ] into a dict """
+    routes = {}
+    for route_arg in route_args or []:
+        route, target       = route_arg.split("=", 1)
+        queue_name, command = target.split(":", 1)
+        routes[route.strip("/")] = (queue_name, command)
+    return routes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="A stand-in for the CodeProject.AI Server's queue")
+    parser.add_argument("--port",    type=int,   default=32168, help="The port to listen on")
+    parser.add_argument("--queue",   default="objectdetection_queue",
+                        help="The queue for requests whose route isn't mapped with --route")
+    parser.add_argument("--route",   action="append",
+                        help="Maps a route to a queue and command, eg vision/detection=objectdetection_queue:detect")
+    parser.add_argument("--timeout", type=float, default=60, help="How long to wait for a module to respond")
+    args = parser.parse_args()
+
+    server = QueueServer(args.queue, parse_routes(args.route), response_timeout = args.timeout)
+    print(f"Queue server listening on port {args.port}", flush = True)
+    web.run_app(server.build_app(), port = args.port, print = None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+import aiohttp
+
+from common import JSON
+
+
+class WebSocketTransport:
+    """
+    Keeps a single WebSocket open to the server's queue for this module, over
+    which we ask for and receive commands, and send back responses. This saves
+    the cost of a HTTP request for each command and each response. If the
+    socket can't be opened, or drops, connected will be False and the caller
+    should fall back to HTTP until we manage to reconnect.
+
+    The protocol is simple: we send {"type": "get", "id": 7} for each command
+    we're ready to take, and each "get" is answered with one message containing
+    the request (or nothing if no request arrived in time). The reply starts
+    with the id of the get it answers: "7\n" before a text (JSON) message, or
+    the id as a 4 byte little endian integer before a binary message. If we
+    asked for binary=true when connecting, requests may arrive as binary frames
+    (see RequestData.FRAME_CONTENT_TYPE) rather than JSON. Responses are sent as
+    {"type": "response", "reqid": "...", "response": {...}}.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, url: str,
+                 reconnect_pause_secs: float = 5.0) -> None:
+
+        self.url                  = url
+        self.reconnect_pause_secs = reconnect_pause_secs
+
+        self._request_session     = session
+        self._socket              = None
+        self._send_lock           = asyncio.Lock()
+        self._last_get_id         = 0
+        self._replies             = {}   # get id => future for the reply to that get
+        self._unclaimed           = []   # requests sent in reply to gets we gave up on
+        self._closed              = False
+
+    @property
+    def connected(self) -> bool:
+        """ Whether or not the socket is currently open """
+        return self._socket is not None and not self._socket.closed
+
+    async def connect(self) -> bool:
+        """ Opens the socket. Returns True on success; False otherwise """
+        try:
+            self._socket = await self._request_session.ws_connect(self.url, heartbeat = 30)
+            return True
+        except Exception:
+            self._socket = None
+            return False
+
+    async def receive_loop(self) -> None:
+        """
+        Reads each message as it arrives and hands it to whoever is waiting in
+        get_command. If the socket drops we'll keep trying to reconnect until
+        close is called.
+        """
+        while not self._closed:
+            if not self.connected and not await self.connect():
+                await asyncio.sleep(self.reconnect_pause_secs)
+                continue
+
+            try:
+                async for message in self._socket:
+                    if message.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                        self._set_reply(*self._split_reply(message.data))
+                    elif message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.ERROR):
+                        break
+            except Exception:
+                pass
+
+            self._socket = None
+
+            # The replies to gets sent over the old socket will never come, so
+            # release whoever's waiting on them (with nothing) so they can fall
+            # back to HTTP
+            for reply in self._replies.values():
+                if not reply.done():
+                    reply.set_result("")
+
+    async def get_command(self, timeout: float = 35) -> "list[str]":
+        """
+        Asks the server for the next command for this module, and waits for it.
+        Returns a list containing the command, or an empty list if there was
+        no command.
+        """
+        if self._unclaimed:
+            return [ self._unclaimed.pop(0) ]
+
+        self._last_get_id = self._last_get_id % 0x7FFFFFFF + 1   # Fits the 4 bytes of a binary reply
+        get_id = self._last_get_id
+        reply  = asyncio.get_running_loop().create_future()
+        self._replies[get_id] = reply
+        try:
+            if not await self._send({ "type": "get", "id": get_id }):
+                return []
+
+            content = await asyncio.wait_for(reply, timeout)
+            return [content] if content else []
+
+        except asyncio.TimeoutError:
+            return []
+
+        finally:
+            self._replies.pop(get_id, None)
+
+    async def send_response(self, request_id: str, body: JSON) -> bool:
+        """ Sends the response for a request. Returns True on success """
+        return await self._send({ "type": "response", "reqid": request_id, "response": body })
+
+    async def close(self) -> None:
+        """ Closes the socket and stops the receive loop """
+        self._closed = True
+        if self.connected:
+            await self._socket.close()
+
+    @staticmethod
+    def _split_reply(data: any) -> "tuple[int, any]":
+        """ Splits the reply to a get into the id of the get and the content """
+        if isinstance(data, str):
+            get_id, _, content = data.partition("\n")
+            return int(get_id), content
+
+        data = memoryview(data)
+        return int.from_bytes(data[:4], "little"), data[4:]
+
+    def _set_reply(self, get_id: int, content: any) -> None:
+        """
+        Hands the reply to a get to whoever is waiting on it. A reply to a get
+        that's no longer being waited on (we gave up, or it was sent over an
+        earlier socket) is dropped, unless it holds a request, which is kept
+        for the next get_command rather than lost.
+        """
+        reply = self._replies.get(get_id)
+        if reply is not None and not reply.done():
+            reply.set_result(content)
+        elif content:
+            self._unclaimed.append(content)
+
+    async def _send(self, message: JSON) -> bool:
+        if not self.connected:
+            return False
+
+        try:
+            async with self._send_lock:
+                await self._socket.send_str(json.dumps(message))
+            return True
+        except Exception:
+            return False
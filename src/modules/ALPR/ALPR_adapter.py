@@ -29,6 +29,8 @@ class ALPR_adapter(ModuleRunner):
             self.processor_type     = "GPU"
             self.execution_provider = "CUDA"   # PaddleOCR supports only CUDA enabled GPUs at this point
 
+        self.opts.cpu_threads = self.threads_per_worker
+
         init_detect_platenumber(self.opts)
 
 
@@ -61,6 +61,11 @@ class Face_adapter(ModuleRunner):
         self.models_lock     = Lock()
         self.face_lock       = Lock()
 
+        # Only commands whose result depends solely on the images sent can be
+        # cached. Never register or delete, and not recognize, since its result
+        # changes as faces are registered and deleted
+        self.cached_commands = [ "detect", "match" ]
+
         # Will be lazy initialised
         self.faceclassifier  = None
         self.detector        = None
@@ -290,7 +295,7 @@ class Face_adapter(ModuleRunner):
 
         try:
             threshold: float  = float(data.get_value("min_confidence", "0.67"))
-            img: Image        = data.get_image(0)
+            img               = data.get_image(0, as_numpy=True)
 
             start_time        = time.perf_counter()
             det               = self.detector.predictFromImage(img, threshold)
@@ -62,10 +62,13 @@ class YOLODetector(object):
         if img0 is None:
             return []
 
+        # Images are RGB, either as a PIL Image or as a numpy array. Reversing
+        # the channels of a numpy array that's a view over BGR pixels (eg a raw
+        # bgr24 image) gives back those pixels without a copy
         if (isinstance(img0, Image.Image)):
             img0 = cv2.cvtColor(np.array(img0), cv2.COLOR_RGB2BGR)
         else:
-            img0 = img0.convert("RGB")
+            img0 = np.ascontiguousarray(np.asarray(img0)[..., ::-1])
 
         confidence = max(0.1,confidence)
 
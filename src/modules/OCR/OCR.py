@@ -21,6 +21,7 @@ def init_detect_ocr(opts: Options) -> None:
     # See notes at the end of this file for options.
     ocr = PaddleOCR(lang                = opts.language,
                     use_gpu             = opts.use_gpu,
+                    cpu_threads         = opts.cpu_threads,
                     show_log            = opts.log_verbosity == LogVerbosity.Loud,
                     det_db_unclip_ratio = opts.det_db_unclip_ratio,
                     det_db_box_thresh   = opts.box_detect_threshold,
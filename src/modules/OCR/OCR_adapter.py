@@ -28,6 +28,8 @@ class OCR_adapter(ModuleRunner):
             self.processor_type     = "GPU"
             self.execution_provider = "CUDA"   # PaddleOCR supports only CUDA enabled GPUs at this point
 
+        self.opts.cpu_threads = self.threads_per_worker
+
         init_detect_ocr(self.opts)
 
     def process(self, data: RequestData) -> JSON:
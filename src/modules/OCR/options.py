@@ -8,6 +8,7 @@ class Options:
         
         # PaddleOCR settings
         self.use_gpu               = ModuleOptions.support_GPU  # We'll disable this if we can't find GPU libraries
+        self.cpu_threads           = 10    # CPU threads for Paddle inference. Set from the runner's thread budget
         self.box_detect_threshold  = 0.40  # confidence threshold for text box detection
         self.char_detect_threshold = 0.40  # confidence threshold for character detection
         self.det_db_unclip_ratio   = 2.0   # Differentiable Binarization expand ratio for output box
@@ -21,6 +21,12 @@ sem = threading.Semaphore()
 
 class CoralObjectDetector_adapter(ModuleRunner):
 
+    def __init__(self):
+        super().__init__()
+
+        # Identical detection requests (eg retries) can reuse an earlier result
+        self.cached_commands = [ "detect", "custom" ]
+
     # async 
     def initialise(self) -> None:
         # if the module was launched outside of the server then the queue name 
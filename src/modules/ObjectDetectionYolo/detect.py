@@ -1,36 +1,199 @@
+import copy
+import math
 import os
 from os.path import exists
+from pathlib import Path
+import shutil
 import sys
+import tempfile
 import time
 from threading import Lock
 
 import torch
 from yolov5.models.common import DetectMultiBackend, AutoShape
+import numpy as np
 from PIL import UnidentifiedImageError
 
 from module_logging import LogMethod
+from quantization import get_model_hash
 from options import Options
 
 
-# Setup a global bucket of YOLO detectors. One for each model
+# Setup a global bucket of YOLO detectors. One for each model. A torch detector
+# can run at any inference size, so one detector serves requests at every size.
+# Models exported for the CPU have a fixed input size, so there's one of those
+# for each model and size.
 detectors   = {}  # We'll use this to cache the detectors based on models
+warmed_up   = set()  # The (model name, inference size) pairs we've warmed up
 ODYOLO_models_lock = Lock()
+ODYOLO_export_lock = Lock()
+
+def get_export_path(model_path: str, size: int, backend: str) -> str:
+    """
+    Returns the path of the model exported to the given backend ("onnx" or
+    "openvino") for the given input size. Exports are stored next to the .pt
+    file, named by the hash of the .pt file and the size.
+    """
+    model_stem = Path(model_path).stem
+    suffix     = ".onnx" if backend == "onnx" else "_openvino_model"
+    return os.path.join(os.path.dirname(model_path),
+                        f"{model_stem}.{get_model_hash(model_path)}.{size}{suffix}")
+
+def get_exported_model(module_runner, model_path: str, size: int, backend: str) -> str:
+    """
+    Returns the path to the model exported to the given backend ("onnx" or
+    "openvino") for the given input size, exporting it first if it hasn't been
+    exported already (see get_export_path). Returns None if the export fails.
+    Exporting takes a while, so this is done when the module starts (see
+    export_models) rather than when a request needs it.
+    """
+    model_stem  = Path(model_path).stem
+    suffix      = ".onnx" if backend == "onnx" else "_openvino_model"
+    export_path = get_export_path(model_path, size, backend)
+
+    if exists(export_path):
+        return export_path
+
+    with ODYOLO_export_lock:
+        if exists(export_path):
+            return export_path
+
+        # The lock only covers this process, and the module may be running in
+        # several (see ModuleRunner's execution_mode). The export is written
+        # next to the model being exported, so export a copy of the model in a
+        # folder of our own, then move the result into place in one go.
+        export_dir = tempfile.mkdtemp(prefix=f"{model_stem}.export.", dir=os.path.dirname(model_path))
+        try:
+            from yolov5.export import run as export_model
+
+            start_time = time.perf_counter()
+            model_copy = os.path.join(export_dir, model_stem + ".pt")
+            shutil.copyfile(model_path, model_copy)
+            export_model(weights=model_copy, imgsz=(size, size), include=(backend,), device="cpu")
+
+            # OpenVINO's export is a folder, which can't replace one that
+            # another process has just put in place
+            try:
+                os.replace(os.path.join(export_dir, model_stem + suffix), export_path)
+            except OSError:
+                if not exists(export_path):
+                    raise
+
+            module_runner.log(LogMethod.Info | LogMethod.Server,
+            {
+                "filename": __file__,
+                "method": sys._getframe().f_code.co_name,
+                "loglevel": "information",
+                "message": f"Exported {model_stem} to {backend} at size {size} " + \
+                           f"in {int(time.perf_counter() - start_time)}s"
+            })
+            return export_path
+
+        except Exception as ex:
+            module_runner.report_error(ex, __file__, f"Unable to export {model_path} to {backend}. Using Torch instead")
+            return None
+
+        finally:
+            shutil.rmtree(export_dir, ignore_errors=True)
+
+def export_models(module_runner, model_paths: list, resolution: int, backend: str) -> None:
+    """
+    Exports each of the models to the given backend at the inference size for
+    the given (configured) resolution, if they haven't been already. Requests
+    at other sizes are run by torch.
+    """
+    for model_path in model_paths:
+        model_name = Path(model_path).stem
+        get_exported_model(module_runner, model_path, get_inference_size(model_name, resolution), backend)
+
+def get_quantized_model_path(export_path: str) -> str:
+    """
+    Returns the path of the INT8 version of a model exported to ONNX. These are
+    made by quantize.py and, like the export, are stored next to the .pt file.
+    """
+    return export_path[:-len(".onnx")] + ".int8.onnx"
+
+def load_exported_detector(module_runner, model_path: str, size: int, backend: str,
+                           precision: str = "fp32") -> any:
+    """
+    Loads the model exported to the given backend for the given input size, or
+    returns None if it hasn't been exported (see export_models) or can't be
+    loaded, in which case we fall back to running the model in torch. If
+    precision is "int8", the model's INT8 version is loaded if it's been made.
+    """
+    export_path = get_export_path(model_path, size, backend)
+    if not exists(export_path):
+        return None
+
+    if backend == "onnx" and precision == "int8":
+        quantized_path = get_quantized_model_path(export_path)
+        if exists(quantized_path):
+            export_path = quantized_path
+        else:
+            module_runner.log(LogMethod.Info | LogMethod.Server,
+            {
+                "filename": __file__,
+                "method": sys._getframe().f_code.co_name,
+                "loglevel": "warning",
+                "message": f"No INT8 version of {Path(model_path).stem} at size {size}. " + \
+                           "Run quantize.py to make one. Using FP32 instead"
+            })
+
+    try:
+        detector = DetectMultiBackend(export_path, device=torch.device("cpu"))
+        if backend == "onnx":
+            # DetectMultiBackend creates its ONNX Runtime session with thread
+            # pools sized to the whole machine. Swap in a session that uses our
+            # share of the CPU instead
+            import onnxruntime as ort
+            detector.session = ort.InferenceSession(export_path,
+                                                    sess_options=module_runner.onnx_session_options(),
+                                                    providers=[ "CPUExecutionProvider" ])
+
+        print(f"Inference processing will occur on device 'CPU' using {os.path.basename(export_path)}")
+        return AutoShape(detector)
+
+    except Exception as ex:
+        module_runner.report_error(ex, __file__, f"Unable to load {export_path}. Using Torch instead")
+        return None
 
 def get_detector(module_runner, models_dir: str, model_name: str, resolution: int,
                  use_Cuda: bool, accel_device_name: int, use_MPS: bool,
-                 use_DirectML: bool, half_precision: str) -> any:
+                 use_DirectML: bool, half_precision: str,
+                 cpu_backend: str = "torch", cpu_precision: str = "fp32") -> any:
 
     """
     We have a detector for each custom model. Lookup the detector, or if it's 
-    not found, create a new one and add it to our lookup.
+    not found, create a new one and add it to our lookup. On the CPU, models
+    exported to cpu_backend ("onnx" or "openvino") for the given resolution (see
+    export_models) are used if there are any, otherwise the model is run by
+    torch. cpu_precision "int8" uses the INT8 versions of exported models (see
+    quantize.py).
     """
 
-    detector = detectors.get(model_name, None)
+    use_export = cpu_backend in [ "onnx", "openvino" ] and \
+                 not use_Cuda and not use_MPS and not use_DirectML
+    key        = (model_name, resolution) if use_export else model_name
+
+    detector = detectors.get(key, None)
     if detector is None:
         with ODYOLO_models_lock:
-            detector = detectors.get(model_name, None)
+            detector = detectors.get(key, None)
             half     = False
 
+            if detector is None and use_export:
+                model_path = os.path.join(models_dir, model_name + ".pt")
+                if exists(model_path):
+                    detector = load_exported_detector(module_runner, model_path, resolution,
+                                                      cpu_backend, cpu_precision)
+
+                # If there's no export for this size, use (and share) the
+                # torch detector
+                if detector is None:
+                    detector = detectors.get(model_name, None)
+                if detector is not None:
+                    detectors[key] = detector
+
             if detector is None:
                 model_path = os.path.join(models_dir, model_name + ".pt")
 
@@ -91,6 +254,7 @@ def get_detector(module_runner, models_dir: str, model_name: str, resolution: in
                         detector = AutoShape(detector)
 
                         detectors[model_name] = detector
+                        detectors[key]        = detector
 
                         module_runner.log(LogMethod.Server,
                         { 
@@ -109,9 +273,191 @@ def get_detector(module_runner, models_dir: str, model_name: str, resolution: in
 
     return detector
 
+# The smallest size (longest side) we'll scale images to for inference. The
+# largest is the size the model was trained at: 640 for YoloV5?, 1280 for
+# YoloV5?6
+min_inference_size = 128
+
+def get_inference_size(model_name: str, size: int) -> int:
+    """
+    Returns the size (longest side) images should be scaled to for inference
+    with the given model: the size asked for, clamped to the sizes the model
+    supports and rounded to a multiple of the model's stride.
+    """
+    is_P6    = model_name[-1:] == "6"        # eg yolov5s6: trained at 1280, stride 64
+    max_size = 1280 if is_P6 else 640
+    stride   = 64   if is_P6 else 32
+
+    size = max(min(int(size), max_size), min_inference_size)
+    return max(int(round(size / stride)) * stride, stride)
+
+# The lowest confidence NMS considers: AutoShape's default, which detection
+# has always used. Lower thresholds let through so many candidate boxes that
+# NMS itself becomes the bottleneck, so a request for a lower threshold gets
+# what's at or above this
+min_nms_threshold = 0.25
+
+def get_class_ids(detector: any, classes: list) -> "tuple[list, list]":
+    """
+    Returns the class indexes for a list of classes, each given as a label (eg
+    "person") or a class index, and the entries in classes the model doesn't
+    know. The class indexes are None (all classes) if classes is None.
+    """
+    if classes is None:
+        return None, []
+
+    names  = detector.names
+    lookup = { str(label).lower(): index
+               for index, label in (names.items() if isinstance(names, dict) else enumerate(names)) }
+    valid_ids = set(lookup.values())
+
+    class_ids = set()
+    unknown   = []
+    for entry in classes:
+        entry = str(entry).strip().lower()
+        if entry.isdigit() and int(entry) in valid_ids:
+            class_ids.add(int(entry))
+        elif entry in lookup:
+            class_ids.add(lookup[entry])
+        else:
+            unknown.append(entry)
+
+    return sorted(class_ids), unknown
+
+def unknown_classes_error(model_name: str, unknown: list) -> dict:
+    """ The response to a request that asks for classes the model doesn't know """
+    return { "success": False, "error": f"Unknown labels for model {model_name}: {', '.join(unknown)}" }
+
+def get_nms_detector(detector: any, threshold: float, class_ids: list, max_detections: int) -> any:
+    """
+    AutoShape runs NMS with the threshold, classes and maximum number of
+    detections in its conf, classes and max_det attributes. A detector is
+    shared by every request, so rather than changing those this returns a
+    shallow copy of the detector (which shares its model) with them set.
+    """
+    nms_detector         = copy.copy(detector)
+    nms_detector.conf    = max(threshold, min_nms_threshold)
+    nms_detector.classes = class_ids
+    nms_detector.max_det = max_detections
+    return nms_detector
+
+def warm_up(detector: any, model_name: str, size: int) -> None:
+    """
+    Runs the detector once at a given size so the first real request at that
+    size doesn't pay for things like GPU kernel selection.
+    """
+    if (model_name, size) in warmed_up:
+        return
+
+    with ODYOLO_models_lock:
+        if (model_name, size) not in warmed_up:
+            try:
+                detector.model.warmup(imgsz=(1, 3, size, size))
+            except Exception:
+                pass
+            warmed_up.add((model_name, size))
+
+def run_detector(detector: any, imgs: list, size: int) -> "tuple[list, list]":
+    """
+    Runs a detector (usually from get_nms_detector) on a list of images at the
+    given size. Returns the predictions for each image, as tensors of rows of
+    (x_min, y_min, x_max, y_max, confidence, class), most confident first, and
+    the total ms the batch spent in each of the preprocess, inference and
+    postprocess stages (None if the detector didn't time them).
+    """
+    # Exported models take a batch of one, so their batches are run an image
+    # at a time
+    if getattr(detector, "pt", True):
+        dets = [ detector(imgs, size=size) ]
+    else:
+        dets = [ detector([ img ], size=size) for img in imgs ]
+
+    predictions = [ xyxy for det in dets for xyxy in det.xyxy ]
+
+    # The detector times its own stages, in ms per image
+    stage_times = [ getattr(det, "t", None) for det in dets ]
+    if not all(times and len(times) == 3 for times in stage_times):
+        return predictions, None
+
+    batch_times = [ sum(times[stage] * len(det.xyxy) for det, times in zip(dets, stage_times))
+                    for stage in range(3) ]
+    return predictions, batch_times
+
+def make_response(detector: any, rows: np.ndarray, threshold: float, class_ids: list,
+                  max_detections: int, scale: float, start_process_time: float,
+                  inferenceMs: int) -> dict:
+    """
+    Makes the response to a detection request from rows of (x_min, y_min,
+    x_max, y_max, confidence, class), most confident first. Only the first
+    max_detections rows at or above the threshold, and in class_ids (if not
+    None), are reported. scale maps the boxes to the original image's pixels.
+    """
+    keep = rows[:, 4] >= threshold
+    if class_ids is not None:
+        keep &= np.isin(rows[:, 5].astype(int), class_ids)
+    rows = rows[keep][:max_detections][::-1]    # least confident first, as always
+
+    boxes   = (rows[:, :4] * scale).astype(int).tolist()
+    outputs = [ {
+                    "confidence": confidence,
+                    "label": detector.names[cls],
+                    "x_min": box[0],
+                    "y_min": box[1],
+                    "x_max": box[2],
+                    "y_max": box[3],
+                }
+                for box, confidence, cls in zip(boxes, rows[:, 4].tolist(), rows[:, 5].astype(int).tolist()) ]
+
+    if len(outputs) > 3:
+        message = 'Found ' + (', '.join(det["label"] for det in outputs[0:3])) + "..."
+    elif len(outputs) > 0:
+        message = 'Found ' + (', '.join(det["label"] for det in outputs))
+    else:
+        message = "No objects found"
+
+    return {
+        "message"     : message,
+        "count"       : len(outputs),
+        "predictions" : outputs,
+        "success"     : True,
+        "processMs"   : int((time.perf_counter() - start_process_time) * 1000),
+        "inferenceMs" : inferenceMs
+    }
+
 def do_detection(module_runner, models_dir: str, model_name: str, resolution: int,
                  use_Cuda: bool, accel_device_name: int, use_MPS: bool,
-                 use_DirectML: bool, half_precision: str, img: any, threshold: float):
+                 use_DirectML: bool, half_precision: str, img: any, threshold: float,
+                 scale: float = 1.0, timings: any = None, cpu_backend: str = "torch",
+                 cpu_precision: str = "fp32", classes: list = None, max_detections: int = 0):
+    
+    return do_detection_batch(module_runner, models_dir, model_name, resolution,
+                              use_Cuda, accel_device_name, use_MPS, use_DirectML,
+                              half_precision, [img], [threshold], [scale],
+                              [timings], cpu_backend, cpu_precision,
+                              [classes], [max_detections])[0]
+
+def do_detection_batch(module_runner, models_dir: str, model_name: str, resolution: int,
+                       use_Cuda: bool, accel_device_name: int, use_MPS: bool,
+                       use_DirectML: bool, half_precision: str, imgs: list,
+                       thresholds: list, scales: list = None,
+                       timings_list: list = None, cpu_backend: str = "torch",
+                       cpu_precision: str = "fp32", classes_list: list = None,
+                       max_detections_list: list = None) -> list:
+    """
+    Performs detection on a list of images in a single batched forward pass.
+    Returns a list of responses, one per image, in the same order as imgs.
+    scales, if provided, holds the factor by which each image was shrunk when
+    it was loaded, so the boxes can be reported in the original image's pixels.
+    resolution is the size (longest side) images are scaled to for inference,
+    clamped to what the model supports (see get_inference_size).
+    timings_list, if provided, holds the RequestTimings for each image, to which
+    the preprocess, inference and postprocess (NMS) times are added.
+    cpu_backend and cpu_precision are the backend models are exported to, and
+    the precision they're run at, when running on the CPU (see get_detector).
+    classes_list, if provided, holds the classes (labels or class indexes) to
+    detect in each image, or None for all classes. max_detections_list, if
+    provided, holds the most objects to return for each image (0 for no limit).
+    """
     
     # We have a detector for each custom model. Lookup the detector, or if it's
     # not found, create a new one and add it to our lookup.
@@ -119,66 +465,272 @@ def do_detection(module_runner, models_dir: str, model_name: str, resolution: in
     create_err_msg = f"Unable to create YOLO detector for model {model_name}"
 
     start_process_time = time.perf_counter()
+    size               = get_inference_size(model_name, resolution)
 
     detector = None
     try:
         detector = get_detector(module_runner, models_dir, model_name,
-                                resolution, use_Cuda, accel_device_name, use_MPS,
-                                use_DirectML, half_precision)
+                                size, use_Cuda, accel_device_name, use_MPS,
+                                use_DirectML, half_precision, cpu_backend, cpu_precision)
     except Exception as ex:
         create_err_msg = f"{create_err_msg} ({str(ex)})"
 
     if detector is None:
         module_runner.report_error(None, __file__, create_err_msg)
-        return { "success": False, "error": create_err_msg }
-    
+        return [ { "success": False, "error": create_err_msg } for _ in imgs ]
+
+    # Images that couldn't be read, and requests for classes the model doesn't
+    # know, are rejected up front so they don't spoil the batch for everyone else
+    responses      = [ None ] * len(imgs)
+    class_ids_list = [ None ] * len(imgs)
+    for index, img in enumerate(imgs):
+        class_ids_list[index], unknown = get_class_ids(detector, classes_list[index] if classes_list else None)
+        if img is None:
+            responses[index] = { "success": False, "error": "invalid image file" }
+        elif unknown:
+            responses[index] = unknown_classes_error(model_name, unknown)
+
+    batch_indexes = [ index for index, response in enumerate(responses) if response is None ]
+
+    if not batch_indexes:
+        return responses
+
     # We have a detector for this model, so let's go ahead and detect
     try:
-        # the default resolution for YoloV5? is 640
-        #  YoloV5?6 is 1280
-
-        start_inference_time = time.perf_counter()
-        det                  = detector(img, size=640)
-        inferenceMs          = int((time.perf_counter() - start_inference_time) * 1000)
-
-        outputs = []
-
-        for *xyxy, conf, cls in reversed(det.xyxy[0]):
-            score = conf.item()
-            if score >= threshold:
-                x_min = xyxy[0].item()
-                y_min = xyxy[1].item()
-                x_max = xyxy[2].item()
-                y_max = xyxy[3].item()
-
-                label = detector.names[int(cls.item())]
-
-                detection = {
-                    "confidence": score,
-                    "label": label,
-                    "x_min": int(x_min),
-                    "y_min": int(y_min),
-                    "x_max": int(x_max),
-                    "y_max": int(y_max),
-                }
+        warm_up(detector, model_name, size)
+
+        # The threshold and class filter are applied in NMS, so boxes no one
+        # wants are dropped before the (comparatively expensive) NMS itself.
+        # NMS runs once for the whole batch, so with the loosest of the batch's
+        # filters. Each image's own filters are applied to what comes out
+        max_dets_list  = [ (max_detections_list[index] if max_detections_list else 0) or detector.max_det
+                           for index in range(len(imgs)) ]
+
+        batch_class_ids = [ class_ids_list[index] for index in batch_indexes ]
+        nms_class_ids   = None if any(class_ids is None for class_ids in batch_class_ids) \
+                          else sorted(set().union(*batch_class_ids))
+        nms_detector    = get_nms_detector(detector,
+                                           min(thresholds[index] for index in batch_indexes),
+                                           nms_class_ids,
+                                           max(max_dets_list[index] for index in batch_indexes))
+
+        start_inference_time     = time.perf_counter()
+        predictions, batch_times = run_detector(nms_detector, [ imgs[index] for index in batch_indexes ], size)
+        inferenceMs              = int((time.perf_counter() - start_inference_time) * 1000)
+
+        # Every image in the batch waits for the whole batch, so that's what
+        # each is charged
+        if timings_list and batch_times:
+            for index in batch_indexes:
+                if timings_list[index] is not None:
+                    for stage, ms in zip([ "preprocess", "inference", "postprocess" ], batch_times):
+                        timings_list[index].add(stage, ms)
+
+        for batch_index, index in enumerate(batch_indexes):
+            responses[index] = make_response(detector, predictions[batch_index].cpu().numpy(),
+                                             thresholds[index], class_ids_list[index],
+                                             max_dets_list[index], scales[index] if scales else 1.0,
+                                             start_process_time, inferenceMs)
+
+    except UnidentifiedImageError as img_ex:
+        module_runner.report_error(img_ex, __file__, "The image provided was of an unknown type")
+        for index in batch_indexes:
+            responses[index] = { "success": False, "error": "invalid image file"}
+
+    except Exception as ex:
+        module_runner.report_error(ex, __file__)
+        for index in batch_indexes:
+            responses[index] = { "success": False, "error": "Error occurred on the server" }
+
+    return responses
+
+def get_tiles(width: int, height: int, tile_size: int, overlap: float) -> list:
+    """
+    Returns (x_min, y_min, x_max, y_max) for each of a grid of tile_size square
+    tiles that cover an image, each overlapping its neighbours by (at least)
+    overlap (a fraction of tile_size). The last tile in each row and column is
+    aligned to the image's edge, so no tile hangs off the image.
+    """
+    def starts(length: int) -> list:
+        if length <= tile_size:
+            return [ 0 ]
+        stride = max(int(tile_size * (1 - overlap)), 1)
+        count  = math.ceil((length - tile_size) / stride) + 1
+        return [ min(index * stride, length - tile_size) for index in range(count) ]
+
+    return [ (x, y, min(x + tile_size, width), min(y + tile_size, height))
+             for y in starts(height) for x in starts(width) ]
+
+def _box_overlaps(boxes: np.ndarray) -> np.ndarray:
+    """
+    The intersection of each of boxes with each of the others, as a fraction
+    of the smaller box's area. An object cut by a tile's edge gives a part box
+    that's mostly inside the whole box found by the next tile, which IoU
+    wouldn't match.
+    """
+    x1 = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    y1 = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    x2 = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    y2 = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
 
-                outputs.append(detection)
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    areas        = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(np.minimum(areas[:, None], areas[None, :]), 1e-9)
 
-        if len(outputs) > 3:
-            message = 'Found ' + (', '.join(det["label"] for det in outputs[0:3])) + "..."
-        elif len(outputs) > 0:
-            message = 'Found ' + (', '.join(det["label"] for det in outputs))
+def merge_detections(rows: np.ndarray, method: str = "nms", overlap_threshold: float = 0.5) -> np.ndarray:
+    """
+    Merges the detections from overlapping tiles (and the full frame pass),
+    which will often have found the same object more than once. Taking the
+    boxes most confident first, each box not yet merged is merged with the
+    boxes of the same class that overlap it by overlap_threshold (see
+    _box_overlaps) and haven't been merged yet: "nms" keeps the most confident
+    box, "wbf" (weighted boxes fusion) replaces them with their confidence
+    weighted average, which evens out the boxes found for an object in
+    different tiles and in the full frame. Either way the merged box has the
+    highest of the confidences. Rows are (x_min, y_min, x_max, y_max,
+    confidence, class) and are returned most confident first.
+    """
+    rows   = rows[np.argsort(-rows[:, 4], kind="stable")]
+    merged = []
+
+    for cls in np.unique(rows[:, 5]):
+        class_rows = rows[rows[:, 5] == cls]
+        overlaps   = _box_overlaps(class_rows[:, :4]) >= overlap_threshold
+        np.fill_diagonal(overlaps, True)
+
+        # Each cluster is led by the most confident box not yet merged
+        unmerged = np.ones(len(class_rows), dtype=bool)
+        leaders  = []
+        clusters = []
+        while unmerged.any():
+            leader   = int(np.argmax(unmerged))
+            cluster  = overlaps[leader] & unmerged
+            unmerged &= ~cluster
+            leaders.append(leader)
+            clusters.append(cluster)
+
+        if method == "wbf":
+            weights = np.array(clusters, dtype=np.float32) * class_rows[:, 4]
+            boxes   = (weights @ class_rows[:, :4]) / weights.sum(axis=1, keepdims=True)
         else:
-            message = "No objects found"
+            boxes   = class_rows[leaders, :4]
+
+        merged.append(np.column_stack([ boxes, class_rows[leaders, 4], class_rows[leaders, 5] ]))
 
-        return {
-            "message"     : message,
-            "count"       : len(outputs),
-            "predictions" : outputs,
-            "success"     : True,
-            "processMs"   : int((time.perf_counter() - start_process_time) * 1000),
-            "inferenceMs" : inferenceMs
-        }
+    if not merged:
+        return np.zeros((0, 6), dtype=np.float32)
+
+    merged = np.concatenate(merged).astype(np.float32)
+    return merged[np.argsort(-merged[:, 4], kind="stable")]
+
+def do_tiled_detection(module_runner, models_dir: str, model_name: str, resolution: int,
+                       use_Cuda: bool, accel_device_name: int, use_MPS: bool,
+                       use_DirectML: bool, half_precision: str, img: any, threshold: float,
+                       timings: any = None, cpu_backend: str = "torch", cpu_precision: str = "fp32",
+                       classes: list = None, max_detections: int = 0, tile_size: int = 0,
+                       tile_overlap: float = 0.2, full_frame: bool = True, merge: str = "nms"):
+    """
+    Performs detection on a (large) image by cutting it into overlapping tiles
+    and running them through the model, so that small, distant objects aren't
+    lost when the image is scaled down to the inference size. With torch the
+    tiles go through the model as one batch. Exported models (see
+    CPU_BACKEND) take a batch of one, so there the tiles are run one at a
+    time, and a tiled request costs about one inference per tile.
+    img must be the image at its full size. tile_size defaults to the model's
+    native size (640, or 1280 for YoloV5?6 models), and tiles overlap by
+    tile_overlap. If full_frame, the whole image is also run at resolution, to
+    find objects too big to fit in a tile. The detections are merged using
+    merge ("nms" or "wbf", see merge_detections). An image that fits in one
+    tile is just run through do_detection.
+    """
+    start_process_time = time.perf_counter()
+
+    if img is None:
+        return { "success": False, "error": "invalid image file" }
+
+    size      = get_inference_size(model_name, resolution)
+    tile_size = get_inference_size(model_name, tile_size or 1280)  # 1280 is clamped to the native size
+
+    # The tiles, and the full frame, as (image, x offset, y offset) for each
+    # inference size
+    width, height = (img.shape[1], img.shape[0]) if isinstance(img, np.ndarray) else img.size
+    tiles         = get_tiles(width, height, tile_size, min(max(tile_overlap, 0.0), 0.9))
+
+    # An image that fits in a single tile gains nothing from tiling, and
+    # is detected as usual, at the requested resolution
+    if len(tiles) == 1:
+        response = do_detection(module_runner, models_dir, model_name, resolution,
+                                use_Cuda, accel_device_name, use_MPS, use_DirectML,
+                                half_precision, img, threshold, 1.0, timings,
+                                cpu_backend, cpu_precision, classes, max_detections)
+        response["tiles"] = 1
+        return response
+
+    passes        = {}
+    for x_min, y_min, x_max, y_max in tiles:
+        if isinstance(img, np.ndarray):
+            tile = np.ascontiguousarray(img[y_min:y_max, x_min:x_max])
+        else:
+            tile = img.crop((x_min, y_min, x_max, y_max))
+        passes.setdefault(tile_size, []).append((tile, x_min, y_min))
+
+    if full_frame:
+        passes.setdefault(size, []).append((img, 0, 0))
+
+    try:
+        rows         = []
+        inferenceMs  = 0
+        stage_totals = [ 0, 0, 0 ]
+        class_ids    = None
+
+        for pass_size, entries in passes.items():
+            detector = get_detector(module_runner, models_dir, model_name,
+                                    pass_size, use_Cuda, accel_device_name, use_MPS,
+                                    use_DirectML, half_precision, cpu_backend, cpu_precision)
+            if detector is None:
+                create_err_msg = f"Unable to create YOLO detector for model {model_name}"
+                module_runner.report_error(None, __file__, create_err_msg)
+                return { "success": False, "error": create_err_msg }
+
+            warm_up(detector, model_name, pass_size)
+
+            class_ids, unknown = get_class_ids(detector, classes)
+            if unknown:
+                return unknown_classes_error(model_name, unknown)
+
+            # Each tile is capped at the detector's default, not the request's
+            # max_detections, as the cap applies to the merged results
+            nms_detector = get_nms_detector(detector, threshold, class_ids, detector.max_det)
+
+            start_inference_time     = time.perf_counter()
+            predictions, batch_times = run_detector(nms_detector, [ tile for tile, _, _ in entries ], pass_size)
+            inferenceMs             += int((time.perf_counter() - start_inference_time) * 1000)
+
+            if batch_times:
+                stage_totals = [ total + ms for total, ms in zip(stage_totals, batch_times) ]
+
+            # Move each tile's boxes into the full image's coordinates
+            for prediction, (_, x_offset, y_offset) in zip(predictions, entries):
+                tile_rows = prediction.cpu().numpy().copy()
+                tile_rows[:, [ 0, 2 ]] += x_offset
+                tile_rows[:, [ 1, 3 ]] += y_offset
+                rows.append(tile_rows)
+
+        if timings is not None:
+            for stage, ms in zip([ "preprocess", "inference", "postprocess" ], stage_totals):
+                timings.add(stage, ms)
+
+        start_merge_time = time.perf_counter()
+        merged           = merge_detections(np.concatenate(rows) if rows else np.zeros((0, 6), dtype=np.float32),
+                                            "wbf" if merge == "wbf" else "nms")
+        if timings is not None:
+            timings.add("merge", (time.perf_counter() - start_merge_time) * 1000)
+
+        response = make_response(detector, merged, threshold, class_ids,
+                                 max_detections or detector.max_det, 1.0,
+                                 start_process_time, inferenceMs)
+        response["tiles"] = len(tiles)
+        return response
 
     except UnidentifiedImageError as img_ex:
         module_runner.report_error(img_ex, __file__, "The image provided was of an unknown type")
@@ -187,4 +739,3 @@ def do_detection(module_runner, models_dir: str, model_name: str, resolution: in
     except Exception as ex:
         module_runner.report_error(ex, __file__)
         return { "success": False, "error": "Error occurred on the server" }
-
@@ -17,7 +17,8 @@ from module_logging import LogMethod
 from PIL import Image
 from options import Options
 
-from detect import do_detection
+from detect import do_detection, do_detection_batch, do_tiled_detection, export_models, \
+                   get_inference_size
 
 
 class YOLO62_adapter(ModuleRunner):
@@ -28,6 +29,9 @@ class YOLO62_adapter(ModuleRunner):
         self.models_last_checked = None
         self.model_names         = []  # We'll use this to cache the available model names
 
+        # Identical detection requests (eg retries) can reuse an earlier result
+        self.cached_commands     = [ "detect", "custom" ]
+
         # These will be adjusted based on the hardware / packages found
         self.use_CUDA       = self.opts.use_CUDA
         self.use_MPS        = self.opts.use_MPS
@@ -82,6 +86,18 @@ class YOLO62_adapter(ModuleRunner):
         elif self.use_DirectML:
             self.execution_provider = "DirectML"
 
+        # Exporting a model takes a while, so it's done now, for the configured
+        # MODEL_SIZE only, rather than when the first request comes in. Other
+        # sizes are run by torch.
+        if self.opts.cpu_backend != "torch" and \
+           not self.use_CUDA and not self.use_MPS and not self.use_DirectML:
+            model_paths = [ os.path.join(self.opts.models_dir, self.opts.std_model_name + ".pt") ]
+            if os.path.isdir(self.opts.custom_models_dir):
+                model_paths += [ entry.path for entry in os.scandir(self.opts.custom_models_dir)
+                                 if entry.is_file() and entry.name.endswith(".pt") ]
+            export_models(self, [ path for path in model_paths if os.path.exists(path) ],
+                          self.opts.resolution_pixels, self.opts.cpu_backend)
+
 
     def process(self, data: RequestData) -> JSON:
         
@@ -93,55 +109,51 @@ class YOLO62_adapter(ModuleRunner):
 
             response = self.list_models(self.opts.custom_models_dir)
 
+        elif data.command == "detect" and data.get_bool("tiled", False):
+
+            # The route to here is /v1/vision/detection, with tiled=true
+
+            response = self.detect_tiled(data, self.opts.models_dir,
+                                         self.opts.std_model_name, self.use_MPS)
+
+        elif data.command == "custom" and data.get_bool("tiled", False):
+
+            model_dir, model_name = self.get_custom_model(data)
+            use_mX_GPU = False # Custom models don't currently work with pyTorch on MPS
+            response = self.detect_tiled(data, model_dir, model_name, use_mX_GPU)
+
         elif data.command == "detect":                  # Perform 'standard' object detection
 
             # The route to here is /v1/vision/detection
 
             threshold: float = float(data.get_value("min_confidence", "0.4"))
-            img: Image       = data.get_image(0)
+            size             = self.get_size(data, self.opts.std_model_name)
+            img, scale       = self.get_image(data, size)
 
             response = do_detection(self, self.opts.models_dir,
-                                    self.opts.std_model_name, self.opts.resolution_pixels,
+                                    self.opts.std_model_name, size,
                                     self.use_CUDA, self.accel_device_name,
                                     self.use_MPS, self.use_DirectML, self.half_precision,
-                                    img, threshold)
+                                    img, threshold, scale, data.timings,
+                                    self.opts.cpu_backend, self.opts.cpu_precision,
+                                    self.get_classes(data), data.get_int("max_detections", 0))
 
         elif data.command == "custom":                  # Perform custom object detection
 
             threshold: float  = float(data.get_value("min_confidence", "0.4"))
-            img: Image        = data.get_image(0)
-
-            # The route to here is /v1/vision/custom/<model-name>. if mode-name = general,
-            # or no model provided, then a built-in general purpose mode will be used.
-            model_dir:str  = self.opts.custom_models_dir
-            model_name:str = "general"
-            if data.segments and data.segments[0]:
-                model_name = data.segments[0]
-
-            # Map the "general" model to our current "general" model
-
-            # if model_name == "general":              # use the standard YOLO model
-            #    model_dir  = opts.models_dir
-            #    model_name = opts.std_model_name
 
-            if model_name == "general":                # Use the custom IP Cam general model
-                model_dir  = self.opts.custom_models_dir
-                model_name = "ipcam-general" 
-
-            self.log(LogMethod.Info | LogMethod.Server,
-            { 
-                "filename": __file__,
-                "loglevel": "information",
-                "method": sys._getframe().f_code.co_name,
-                "message": f"Detecting using {model_name}"
-            })
+            model_dir, model_name = self.get_custom_model(data)
+            size                  = self.get_size(data, model_name)
+            img, scale            = self.get_image(data, size)
 
             use_mX_GPU = False # self.opts.use_MPS   - Custom models don't currently work with pyTorch on MPS
             response = do_detection(self, model_dir, model_name, 
-                                    self.opts.resolution_pixels, self.use_CUDA,
+                                    size, self.use_CUDA,
                                     self.accel_device_name, use_mX_GPU,
                                     self.use_DirectML, self.half_precision,
-                                    img, threshold)
+                                    img, threshold, scale, data.timings,
+                                    self.opts.cpu_backend, self.opts.cpu_precision,
+                                    self.get_classes(data), data.get_int("max_detections", 0))
 
         else:
             self.report_error(None, __file__, f"Unknown command {data.command}")
@@ -149,6 +161,156 @@ class YOLO62_adapter(ModuleRunner):
         return response
 
 
+    def process_batch(self, data_list: "list[RequestData]") -> "list[JSON]":
+
+        # Group the detection requests by model and inference size so each group
+        # can be run through its model in a single forward pass. Anything else
+        # is processed as normal
+        responses = [ None ] * len(data_list)
+        groups    = {}
+
+        for index, data in enumerate(data_list):
+            if data.get_bool("tiled", False):
+                responses[index] = self.process(data)   # Tiled requests are a batch of their own
+            elif data.command == "detect":
+                size  = self.get_size(data, self.opts.std_model_name)
+                model = (self.opts.models_dir, self.opts.std_model_name, self.use_MPS, size)
+                groups.setdefault(model, []).append(index)
+            elif data.command == "custom":
+                model_dir, model_name = self.get_custom_model(data)
+                size       = self.get_size(data, model_name)
+                use_mX_GPU = False # Custom models don't currently work with pyTorch on MPS
+                groups.setdefault((model_dir, model_name, use_mX_GPU, size), []).append(index)
+            else:
+                responses[index] = self.process(data)
+
+        for (model_dir, model_name, use_MPS, size), indexes in groups.items():
+            images     = [ self.get_image(data_list[index], size) for index in indexes ]
+            imgs       = [ img for (img, _) in images ]
+            scales     = [ scale for (_, scale) in images ]
+            thresholds = [ float(data_list[index].get_value("min_confidence", "0.4")) for index in indexes ]
+
+            results = do_detection_batch(self, model_dir, model_name,
+                                         size, self.use_CUDA,
+                                         self.accel_device_name, use_MPS,
+                                         self.use_DirectML, self.half_precision,
+                                         imgs, thresholds, scales,
+                                         [ data_list[index].timings for index in indexes ],
+                                         self.opts.cpu_backend, self.opts.cpu_precision,
+                                         [ self.get_classes(data_list[index]) for index in indexes ],
+                                         [ data_list[index].get_int("max_detections", 0) for index in indexes ])
+
+            for index, result in zip(indexes, results):
+                responses[index] = result
+
+        return responses
+
+
+    def detect_tiled(self, data: RequestData, models_dir: str, model_name: str,
+                     use_MPS: bool) -> JSON:
+        """
+        Detects objects in overlapping tiles cut from the full size image, for
+        large images (eg 4K cameras) where small objects would be lost if the
+        whole image was scaled down (see do_tiled_detection). tile_size
+        (default the model's native size), tile_overlap (default 0.2 of a
+        tile), full_frame (also detect in the whole image at the usual size,
+        default true) and merge (nms or wbf, default nms) control the tiling.
+        """
+        threshold: float = float(data.get_value("min_confidence", "0.4"))
+        img, _           = self.get_image(data, None)
+
+        return do_tiled_detection(self, models_dir, model_name,
+                                  self.get_size(data, model_name), self.use_CUDA,
+                                  self.accel_device_name, use_MPS,
+                                  self.use_DirectML, self.half_precision,
+                                  img, threshold, data.timings,
+                                  self.opts.cpu_backend, self.opts.cpu_precision,
+                                  self.get_classes(data), data.get_int("max_detections", 0),
+                                  data.get_int("tile_size", 0), data.get_float("tile_overlap", 0.2),
+                                  data.get_bool("full_frame", True),
+                                  (data.get_value("merge") or "nms").lower())
+
+
+    def get_size(self, data: RequestData, model_name: str) -> int:
+        """
+        Gets the size (longest side) to scale the image to for inference. This
+        is the resolution for the MODEL_SIZE setting unless the request asks
+        for a different size (eg a small size for a quick look, or a large one
+        for distant objects), clamped to what the model supports.
+        """
+        size = data.get_int("size", self.opts.resolution_pixels) or self.opts.resolution_pixels
+        return get_inference_size(model_name, size)
+
+
+    def get_classes(self, data: RequestData) -> list:
+        """
+        Gets the classes the request wants detected, as a list of labels (eg
+        "person") or class indexes, from the comma separated labels and
+        classes values. Returns None if the request wants every class.
+        """
+        classes = []
+        for key in [ "labels", "classes" ]:
+            value = data.get_value(key)
+            if value:
+                classes += [ entry.strip() for entry in str(value).split(",") if entry.strip() ]
+
+        return classes or None
+
+
+    def get_image(self, data: RequestData, size: int) -> "tuple[Image, float]":
+        """
+        Gets the image to run detection on, already scaled down to the size the
+        detector will use (JPEGs are scaled as they're decoded, which is much
+        quicker than decoding at full size), or at full size if size is None.
+        Images sent as raw pixels are passed to the detector as a numpy array
+        over the pixels as they are.
+        Returns the image and the factor that maps its coordinates back to the
+        original image.
+        """
+        is_raw = data.get_raw_image_format(0) is not None
+        img    = data.get_image(0, max_size=size, as_numpy=is_raw)
+        if img is None:
+            return None, 1.0
+
+        width         = img.shape[1] if is_raw else img.width
+        original_size = data.get_image_size(0)
+        scale         = original_size[0] / width if original_size else 1.0
+        return img, scale
+
+
+    def get_custom_model(self, data: RequestData) -> "tuple[str, str]":
+        """
+        Gets the directory and name of the custom model requested
+        """
+
+        # The route to here is /v1/vision/custom/<model-name>. if mode-name = general,
+        # or no model provided, then a built-in general purpose mode will be used.
+        model_dir:str  = self.opts.custom_models_dir
+        model_name:str = "general"
+        if data.segments and data.segments[0]:
+            model_name = data.segments[0]
+
+        # Map the "general" model to our current "general" model
+
+        # if model_name == "general":              # use the standard YOLO model
+        #    model_dir  = opts.models_dir
+        #    model_name = opts.std_model_name
+
+        if model_name == "general":                # Use the custom IP Cam general model
+            model_dir  = self.opts.custom_models_dir
+            model_name = "ipcam-general" 
+
+        self.log(LogMethod.Info | LogMethod.Server,
+        { 
+            "filename": __file__,
+            "loglevel": "information",
+            "method": sys._getframe().f_back.f_code.co_name,
+            "message": f"Detecting using {model_name}"
+        })
+
+        return model_dir, model_name
+
+
     def selftest(self) -> None:
         
         file_name = os.path.join("test", "pexels-huseyn-kamaladdin-667838.jpg")
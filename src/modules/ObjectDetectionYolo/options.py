@@ -36,6 +36,8 @@ class Options:
 
         self.model_size         = ModuleOptions.getEnvVariable("MODEL_SIZE", "Medium")   # small, medium, large //, nano, x-large
         self.use_CUDA           = ModuleOptions.getEnvVariable("USE_CUDA",   "True")     # True / False
+        self.cpu_backend        = ModuleOptions.getEnvVariable("CPU_BACKEND", "Torch")   # Torch, ONNX, OpenVINO
+        self.cpu_precision      = ModuleOptions.getEnvVariable("MODEL_PRECISION", "FP32") # FP32, INT8
         self.use_MPS            = True          # only if available...
         self.use_DirectML       = True          # only if available...
 
@@ -46,6 +48,17 @@ class Options:
         if self.model_size not in [ "tiny", "small", "medium", "large" ]:
             self.model_size = "medium"
 
+        # When running on the CPU, models are exported to, and run by, this
+        # backend at the MODEL_SIZE resolution. Other sizes are run by torch
+        self.cpu_backend        = self.cpu_backend.lower()
+        if self.cpu_backend not in [ "torch", "onnx", "openvino" ]:
+            self.cpu_backend = "torch"
+
+        # INT8 models are made by quantize.py, and are run by ONNX Runtime
+        self.cpu_precision      = self.cpu_precision.lower()
+        if self.cpu_precision not in [ "fp32", "int8" ] or self.cpu_backend != "onnx":
+            self.cpu_precision = "fp32"
+
         # Get settings
         settings = self.MODEL_SETTINGS[self.model_size]   
         self.resolution_pixels = settings.RESOLUTION
@@ -58,3 +71,5 @@ class Options:
             print(f"Debug: APPDIR:      {self.app_dir}")
             print(f"Debug: MODEL_SIZE:  {self.model_size}")
             print(f"Debug: MODELS_DIR:  {self.models_dir}")
+            print(f"Debug: CPU_BACKEND: {self.cpu_backend}")
+            print(f"Debug: PRECISION:   {self.cpu_precision}")
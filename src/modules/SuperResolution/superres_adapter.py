@@ -37,7 +37,8 @@ class SuperRes_adapter(ModuleRunner):
 
             start_time = time.perf_counter()
 
-            (out_img, inferenceMs) = superresolution(img)
+            # Keep ONNX Runtime within this worker's share of the CPU threads
+            (out_img, inferenceMs) = superresolution(img, self.onnx_session_options())
 
             return {
                 "success": True,
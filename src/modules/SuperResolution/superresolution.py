@@ -94,7 +94,7 @@ def pre_process_image(orig_img: Image):
 
 
 # Run Model on Onnxruntime
-def run_onnx(asset_path: str, processed_img: Image) -> any:
+def run_onnx(asset_path: str, processed_img: Image, sess_options: any = None) -> any:
 
     # Start from ORT 1.10, ORT requires explicitly setting the providers 
     # parameter if you want to use execution providers other than the default 
@@ -107,9 +107,9 @@ def run_onnx(asset_path: str, processed_img: Image) -> any:
     model_path = os.path.normpath(asset_path + "/super-resolution-10.onnx")
 
     if ModuleOptions.support_GPU and torch.cuda.is_available():
-        ort_session = onnxruntime.InferenceSession(model_path, providers=['CUDAExecutionProvider'])
+        ort_session = onnxruntime.InferenceSession(model_path, sess_options=sess_options, providers=['CUDAExecutionProvider'])
     else:
-        ort_session = onnxruntime.InferenceSession(model_path)
+        ort_session = onnxruntime.InferenceSession(model_path, sess_options=sess_options)
         
     ort_inputs = {ort_session.get_inputs()[0].name: processed_img} 
     ort_outs = ort_session.run(None, ort_inputs)   
@@ -134,12 +134,12 @@ def post_process_image(img_out_y: any, img_cb: any, img_cr: any) -> Image:
     return final_img
 
 
-def superresolution(img: Image) -> Tuple[any, int]: # Tuple[Image, int]
+def superresolution(img: Image, sess_options: any = None) -> Tuple[any, int]: # Tuple[Image, int]
 
     (img_norm, img_cb, img_cr) = pre_process_image(img)
 
     start_time = time.perf_counter()
-    output = run_onnx(assets_path, img_norm)
+    output = run_onnx(assets_path, img_norm, sess_options)
     inferenceMs : int = int((time.perf_counter() - start_time) * 1000)
 
     result = post_process_image(output, img_cb, img_cr)
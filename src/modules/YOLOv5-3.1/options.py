@@ -36,6 +36,7 @@ class Options:
 
         self.model_size         = ModuleOptions.getEnvVariable("MODEL_SIZE", "Medium")   # small, medium, large //, nano, x-large
         self.use_CUDA           = ModuleOptions.getEnvVariable("USE_CUDA",   "True")     # True / False
+        self.cpu_precision      = ModuleOptions.getEnvVariable("MODEL_PRECISION", "FP32") # FP32, INT8
         self.use_MPS            = False   # Default is False, but we'll enable if possible
 
         # Normalise input
@@ -45,6 +46,11 @@ class Options:
         if self.model_size not in [ "tiny", "small", "medium", "large" ]:
             self.model_size = "medium"
 
+        # INT8 models are made by quantize.py, and are run on the CPU by ONNX Runtime
+        self.cpu_precision      = self.cpu_precision.lower()
+        if self.cpu_precision not in [ "fp32", "int8" ]:
+            self.cpu_precision = "fp32"
+
         # Get settings
         settings = self.MODEL_SETTINGS[self.model_size]   
         self.resolution_pixels = settings.RESOLUTION
@@ -57,4 +63,5 @@ class Options:
             print(f"Debug: APPDIR:      {self.app_dir}")
             print(f"Debug: MODEL_SIZE:  {self.model_size}")
             print(f"Debug: MODELS_DIR:  {self.models_dir}")
+            print(f"Debug: PRECISION:   {self.cpu_precision}")
 
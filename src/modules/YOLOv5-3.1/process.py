@@ -1,4 +1,5 @@
 
+import json
 import time
 from typing import Tuple
 import cv2
@@ -11,8 +12,10 @@ try:
 except: pass
 import torch
 
+from models.common import Conv
 from models.experimental import attempt_load
 from PIL import Image
+from utils.activations import Hardswish
 from utils.datasets import LoadImages, LoadStreams, letterbox
 from options import Options
 
@@ -22,6 +25,7 @@ from utils.general import (
 )
 
 from module_runner import ModuleRunner
+from quantization import get_model_hash
 
 
 def init_detect(opts: Options):
@@ -42,11 +46,56 @@ def init_detect(opts: Options):
         print("Unable to import test for Apple Silicon: " + str(ex))
 
 
+def get_onnx_model_path(model_path: str, reso: int, precision: str = "fp32") -> str:
+    """
+    Returns the path of the ONNX version of a .pt model for the given input
+    size, next to the .pt file and named by the hash of the .pt file and the
+    size. INT8 versions are made by quantize.py.
+    """
+    model_stem = os.path.splitext(model_path)[0]
+    suffix     = ".int8.onnx" if precision == "int8" else ".onnx"
+    return f"{model_stem}.{get_model_hash(model_path)}.{reso}{suffix}"
+
+
+def export_onnx(model_path: str, reso: int, onnx_path: str) -> None:
+    """
+    Exports a .pt model to ONNX for a fixed input size, with the model's class
+    names stored in the ONNX model's metadata.
+    """
+    import onnx
+
+    model = attempt_load(model_path, map_location=torch.device("cpu"))
+    names = model.module.names if hasattr(model, "module") else model.names
+
+    for _, module in model.named_modules():
+        module._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatibility
+        if isinstance(module, Conv) and isinstance(module.act, torch.nn.Hardswish):
+            module.act = Hardswish()                # an export friendly Hardswish
+
+    # The dry run also builds the Detect layer's grids for this size
+    img = torch.zeros((1, 3, reso, reso))
+    model(img)
+
+    # Export to a temporary file so a failed export doesn't leave a broken model
+    export_path = onnx_path + ".export"
+    try:
+        torch.onnx.export(model, img, export_path, opset_version=12,
+                          input_names=["images"], output_names=["output"])
+
+        onnx_model = onnx.load(export_path)
+        metadata   = onnx_model.metadata_props.add()
+        metadata.key, metadata.value = "names", json.dumps(list(names))
+        onnx.save(onnx_model, onnx_path)
+    finally:
+        if os.path.exists(export_path):
+            os.remove(export_path)
+
+
 class YOLODetector(object):
 
     def __init__(self, model_path: str, reso: int = 640, cuda: bool = False, 
                  accel_device_name: str = 0, mps: bool = False,
-                 half_precision: str = 'enable'):
+                 half_precision: str = 'enable', session_options: any = None):
 
         if cuda:
             self.device_type = "cuda"
@@ -85,12 +134,25 @@ class YOLODetector(object):
 
         self.reso = (reso, reso)
         self.cuda = cuda
-        self.model = attempt_load(model_path, map_location=self.device)
-        self.names = (
-            self.model.module.names
-            if hasattr(self.model, "module")
-            else self.model.names
-        )
+        self.onnx = model_path.endswith(".onnx")
+
+        if self.onnx:
+            # Models exported to ONNX (see export_onnx) are run on the CPU by
+            # ONNX Runtime, at the fixed size they were exported at
+            import onnxruntime as ort
+            self.session     = ort.InferenceSession(model_path, sess_options=session_options,
+                                                    providers=[ "CPUExecutionProvider" ])
+            self.input_name  = self.session.get_inputs()[0].name
+            self.output_name = self.session.get_outputs()[0].name
+            self.names       = json.loads(self.session.get_modelmeta().custom_metadata_map["names"])
+            self.half        = False
+        else:
+            self.model = attempt_load(model_path, map_location=self.device)
+            self.names = (
+                self.model.module.names
+                if hasattr(self.model, "module")
+                else self.model.names
+            )
 
         # Multi-GPU untested: use all GPUs for inference
         # self.model = torch.nn.DataParallel(model) #, device_ids=[0, 1, 2])        
@@ -112,14 +174,17 @@ class YOLODetector(object):
         if img0 is None:
             return [], 0
 
+        # Images are RGB, either as a PIL Image or as a numpy array. Reversing
+        # the channels of a numpy array that's a view over BGR pixels (eg a raw
+        # bgr24 image) gives back those pixels without a copy
         if (isinstance(img0, Image.Image)):
             img0 = cv2.cvtColor(np.array(img0), cv2.COLOR_RGB2BGR)
         else:
-            img0 = img0.convert("RGB")
+            img0 = np.ascontiguousarray(np.asarray(img0)[..., ::-1])
 
         confidence = max(0.1,confidence)
 
-        img = np.asarray(letterbox(img0, new_shape=self.reso)[0])
+        img = np.asarray(letterbox(img0, new_shape=self.reso, auto=not self.onnx)[0])
         img = img.transpose(2, 0, 1)
         img = np.ascontiguousarray(img)
 
@@ -131,7 +196,10 @@ class YOLODetector(object):
             img = img.unsqueeze(0)
 
         start_inference_time = time.perf_counter()       
-        pred = self.model(img, augment=False)[0]
+        if self.onnx:
+            pred = torch.from_numpy(self.session.run([ self.output_name ], { self.input_name: img.numpy() })[0])
+        else:
+            pred = self.model(img, augment=False)[0]
         inferenceMs = int((time.perf_counter() - start_inference_time) * 1000)
 
         pred = non_max_suppression(
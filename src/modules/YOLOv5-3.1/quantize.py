@@ -0,0 +1,92 @@
+"""
+Makes INT8 versions of this module's models, for running on the CPU with ONNX
+Runtime (set MODEL_PRECISION to INT8 to use them), and reports how much faster
+they are and how much their detections differ from the FP32 models'.
+
+Each model is exported to ONNX at the inference size, then quantized with
+ONNX Runtime's static quantization using a sample of images from --images to
+calibrate it. The ONNX and INT8 models are stored alongside the .pt file.
+Exported models have a fixed input size, so quantize at the size (MODEL_SIZE)
+the models will be used at.
+
+Usage:
+    python quantize.py
+    python quantize.py --images /path/to/camera/captures --model ipcam-general
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.append("../../SDK/Python")
+from quantization import find_models, load_calibration_images, quantize_model, evaluate_quantization, \
+                         print_quantization_report
+
+import numpy as np
+
+from options import Options
+from process import YOLODetector, export_onnx, get_onnx_model_path
+
+
+def get_detect(model_path: str, size: int) -> callable:
+    """ Returns a function that runs an exported model on an image """
+    detector = YOLODetector(model_path, size)
+
+    def detect(img: any) -> np.ndarray:
+        pred, _ = detector.predictFromImage(img, 0.25)
+        return pred.cpu().numpy() if len(pred) else np.zeros((0, 6))
+
+    return detect
+
+
+def main() -> None:
+    opts = Options()
+
+    parser = argparse.ArgumentParser(description="Makes INT8 versions of the YOLO models for the CPU")
+    parser.add_argument("--images",  default=os.path.join(opts.app_dir, "..", "..", "..", "demos", "TestData", "Objects"),
+                        help="The folder of images to calibrate and evaluate with (default: demos/TestData/Objects)")
+    parser.add_argument("--model",   action="append",
+                        help="The model to quantize, eg ipcam-general. May be repeated (default: the standard and custom models)")
+    parser.add_argument("--size",    type=int, default=opts.resolution_pixels,
+                        help="The inference size to quantize for (default: the size for MODEL_SIZE)")
+    parser.add_argument("--samples", type=int, default=100, help="The most images to use")
+    parser.add_argument("--output",  help="A file to write the JSON report to")
+    args = parser.parse_args()
+
+    images = load_calibration_images(args.images, args.samples)
+    if not images:
+        print(f"No images found in {args.images}", file=sys.stderr)
+        sys.exit(1)
+
+    size    = max(int(round(args.size / 32)) * 32, 32)   # A multiple of the model's stride
+    results = []
+    for model_path in find_models(opts, args.model):
+        model_name = os.path.splitext(os.path.basename(model_path))[0]
+        result     = { "model": model_name, "size": size }
+        results.append(result)
+
+        try:
+            fp32_path = get_onnx_model_path(model_path, size)
+            if not os.path.exists(fp32_path):
+                print(f"Exporting {model_name} to ONNX at size {size}")
+                export_onnx(model_path, size, fp32_path)
+
+            # This module feeds its models BGR images
+            int8_path = get_onnx_model_path(model_path, size, "int8")
+            print(f"Quantizing {model_name} at size {size} with {len(images)} images")
+            quantize_model(fp32_path, int8_path, images, size, bgr=True)
+
+            result.update(evaluate_quantization(images, get_detect(fp32_path, size), get_detect(int8_path, size)))
+            result["path"] = int8_path
+        except Exception as ex:
+            result["error"] = f"Unable to quantize ({str(ex)})"
+
+    print_quantization_report(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
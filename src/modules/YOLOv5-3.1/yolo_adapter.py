@@ -19,7 +19,7 @@ from options import Options
 
 from PIL import UnidentifiedImageError, Image
 
-from process import YOLODetector, init_detect
+from process import YOLODetector, init_detect, get_onnx_model_path
 
 
 class YOLO31_adapter(ModuleRunner):
@@ -32,6 +32,9 @@ class YOLO31_adapter(ModuleRunner):
         self.detectors      = {}  # We'll use this to cache the detectors based on models
         self.models_lock    = Lock()
 
+        # Identical detection requests (eg retries) can reuse an earlier result
+        self.cached_commands = [ "detect", "custom" ]
+
     def initialise(self):
 
         # if the module was launched outside of the server then the queue name 
@@ -68,17 +71,17 @@ class YOLO31_adapter(ModuleRunner):
             # The route to here is /v1/vision/detection
 
             threshold: float = float(data.get_value("min_confidence", "0.4"))
-            img: Image       = data.get_image(0)
+            img, scale       = self.get_image(data)
 
             response = self.do_detection(self.opts.models_dir, self.opts.std_model_name,
                                          self.opts.resolution_pixels, self.opts.use_CUDA,
                                          self.accel_device_name, self.opts.use_MPS,
-                                         self.half_precision, img, threshold)
+                                         self.half_precision, img, threshold, scale)
 
         elif data.command == "custom":                  # Perform custom object detection
 
             threshold: float  = float(data.get_value("min_confidence", "0.4"))
-            img: Image        = data.get_image(0)
+            img, scale        = self.get_image(data)
 
             # The route to here is /v1/vision/custom/<model-name>. if mode-name = general,
             # or no model provided, then a built-in general purpose mode will be used.
@@ -108,7 +111,7 @@ class YOLO31_adapter(ModuleRunner):
             use_mX_GPU = False # self.opts.use_MPS   - Custom models don't currently work with pyTorch on MPS
             response = self.do_detection(model_dir, model_name, self.opts.resolution_pixels,
                                          self.opts.use_CUDA, self.accel_device_name, use_mX_GPU,
-                                         self.half_precision, img, threshold)
+                                         self.half_precision, img, threshold, scale)
 
         else:
             self.report_error(None, __file__, f"Unknown command {data.command}")
@@ -116,6 +119,20 @@ class YOLO31_adapter(ModuleRunner):
         return response
 
 
+    def get_image(self, data: RequestData) -> "tuple[any, float]":
+        """
+        Gets the image to run detection on as an RGB numpy array, already scaled
+        down to the resolution the detector will use. Returns the image and the
+        factor that maps its coordinates back to the original image.
+        """
+        img = data.get_image(0, max_size=self.opts.resolution_pixels, as_numpy=True)
+        if img is None:
+            return None, 1.0
+
+        original_size = data.get_image_size(0)
+        scale         = original_size[0] / img.shape[1] if original_size else 1.0
+        return img, scale
+
     def list_models(self, models_path):
 
         """
@@ -140,7 +157,9 @@ class YOLO31_adapter(ModuleRunner):
 
         """
         We have a detector for each custom model. Lookup the detector, or if it's 
-        not found, create a new one and add it to our lookup.
+        not found, create a new one and add it to our lookup. On the CPU, if
+        MODEL_PRECISION is INT8, the INT8 version of the model (made by
+        quantize.py) is used if there is one.
         """
 
         detector = self.detectors.get(model_name, None)
@@ -157,9 +176,26 @@ class YOLO31_adapter(ModuleRunner):
                     # exist. Set things up correctly at install time.
                     if exists(model_path):
                         try:
+                            session_options = None
+                            if self.opts.cpu_precision == "int8" and not use_Cuda and not use_MPS:
+                                quantized_path = get_onnx_model_path(model_path, resolution, "int8")
+                                if exists(quantized_path):
+                                    model_path      = quantized_path
+                                    session_options = self.onnx_session_options()
+                                else:
+                                    self.log(LogMethod.Info | LogMethod.Server,
+                                    {
+                                        "filename": __file__,
+                                        "method": sys._getframe().f_code.co_name,
+                                        "loglevel": "warning",
+                                        "message": f"No INT8 version of {model_name} at size {resolution}. " + \
+                                                   "Run quantize.py to make one. Using FP32 instead"
+                                    })
+
                             detector = YOLODetector(model_path, resolution, 
                                                     use_Cuda, accel_device_name,
-                                                    use_MPS, half_precision)
+                                                    use_MPS, half_precision,
+                                                    session_options)
                             self.detectors[model_name] = detector
 
                             self.log(LogMethod.Server,
@@ -181,7 +217,7 @@ class YOLO31_adapter(ModuleRunner):
 
     def do_detection(self, models_dir: str, model_name: str, resolution: int,
                     use_Cuda: bool, accel_device_name: str, use_MPS: bool,
-                    half_precision: str, img: any, threshold: float):
+                    half_precision: str, img: any, threshold: float, scale: float = 1.0):
         
         # We have a detector for each custom model. Lookup the detector, or if it's
         # not found, create a new one and add it to our lookup.
@@ -207,10 +243,10 @@ class YOLO31_adapter(ModuleRunner):
             outputs = []
 
             for *xyxy, conf, cls in reversed(det):
-                x_min = xyxy[0]
-                y_min = xyxy[1]
-                x_max = xyxy[2]
-                y_max = xyxy[3]
+                x_min = xyxy[0] * scale
+                y_min = xyxy[1] * scale
+                x_max = xyxy[2] * scale
+                y_max = xyxy[3] * scale
                 score = conf.item()
 
                 label = detector.names[int(cls.item())]
@@ -22,6 +22,13 @@ namespace CodeProject.AI.Server.Backend
         /// </summary>
         public int MaxQueueLength { get; set; } = 32;
 
+        /// <summary>
+        /// Get or set the commands that are cheap to handle (eg status or listing models) and so
+        /// are queued in a separate control lane. Modules take requests from the control lane
+        /// first, so these commands don't wait behind a queue of inference requests.
+        /// </summary>
+        public string[] ControlCommands { get; set; } = new[] { "status", "list-custom", "list" };
+
         /* Currently unused, but we'll keep the code for the future just in case
         public string ImageTempDir { get; set; } = "CodeProject.AI.TempImages";
         */
@@ -4,6 +4,7 @@ using Microsoft.Extensions.Options;
 
 using System;
 using System.Collections.Concurrent;
+using System.Linq;
 using System.Text.Json;
 using System.Text.Json.Nodes;
 using System.Threading;
@@ -11,6 +12,7 @@ using System.Threading.Channels;
 using System.Threading.Tasks;
 
 using CodeProject.AI.SDK;
+using CodeProject.AI.SDK.Utils;
 using Microsoft.Extensions.Logging;
 
 namespace CodeProject.AI.Server.Backend
@@ -20,12 +22,20 @@ namespace CodeProject.AI.Server.Backend
     /// </summary>
     public class QueueServices
     {
+        /// <summary>
+        /// The name of the lane that holds control commands (see QueueProcessingOptions.ControlCommands)
+        /// </summary>
+        public const string ControlLane = "control";
+
         private readonly QueueProcessingOptions _settings;
         private readonly ILogger _logger;
 
         // Keeping track of the queues being used.  Will be created as needed.
         private readonly ConcurrentDictionary<string, Channel<BackendRequestBase>> _queues =
                             new ConcurrentDictionary<string, Channel<BackendRequestBase>>();
+        // The control lane for each queue. Control commands go here rather than to the main queue.
+        private readonly ConcurrentDictionary<string, Channel<BackendRequestBase>> _controlQueues =
+                            new ConcurrentDictionary<string, Channel<BackendRequestBase>>();
         private readonly ConcurrentDictionary<string, TaskCompletionSource<string?>> _pendingResponses =
                             new ConcurrentDictionary<string, TaskCompletionSource<string?>>();
 
@@ -70,7 +80,11 @@ namespace CodeProject.AI.Server.Backend
                                                         BackendRequestBase request,
                                                         CancellationToken token = default)
         {
+            // Make sure the main queue exists even if this request goes to the control lane, since
+            // modules wait on the main queue
             Channel<BackendRequestBase> queue = GetOrCreateQueue(queueName);
+            if (IsControlCommand(request.reqtype))
+                queue = GetOrCreateControlQueue(queueName);
 
             // the backend process will return a JSON string as a response.
             var completion = new TaskCompletionSource<string?>();
@@ -83,8 +97,9 @@ namespace CodeProject.AI.Server.Backend
                 return new BackendErrorResponse(msg);
             }
 
-            // setup a request timeout.
+            // setup a request timeout, and let the module know when that will be
             using var cancellationSource = new CancellationTokenSource(_settings.ResponseTimeout);
+            request.deadline = DateTimeOffset.UtcNow.Add(_settings.ResponseTimeout).ToUnixTimeMilliseconds();
             var timeoutToken = cancellationSource.Token;
 
             try
@@ -146,6 +161,18 @@ namespace CodeProject.AI.Server.Backend
                             Channel.CreateBounded<BackendRequestBase>(_settings.MaxQueueLength));
         }
 
+        private Channel<BackendRequestBase> GetOrCreateControlQueue(string queueName)
+        {
+            return _controlQueues.GetOrAdd(queueName.ToLower(),
+                            _ => Channel.CreateBounded<BackendRequestBase>(_settings.MaxQueueLength));
+        }
+
+        private bool IsControlCommand(string? command)
+        {
+            return command is not null && _settings.ControlCommands is not null &&
+                   _settings.ControlCommands.Any(controlCommand => controlCommand.EqualsIgnoreCase(command));
+        }
+
         /// <summary>
         /// Set the result for the request.
         /// </summary>
@@ -160,7 +187,9 @@ namespace CodeProject.AI.Server.Backend
             if (!_pendingResponses.TryGetValue(req_id, out TaskCompletionSource<string?>? completion))
                 return false;
 
-            completion.SetResult(responseString);
+            // A request that was requeued may end up being answered twice. The first answer wins
+            if (!completion.TrySetResult(responseString))
+                return false;
             
             var response = JsonSerializer.Deserialize<JsonObject>(responseString ?? "");
             if (response?["message"] is not null)
@@ -171,6 +200,34 @@ namespace CodeProject.AI.Server.Backend
             return true;
         }
 
+        /// <summary>
+        /// Puts a request that was taken from the queue, but never got to the module that took it
+        /// (eg its WebSocket closed first), back on the queue for the next module to take. It
+        /// goes to the back of its lane.
+        /// </summary>
+        /// <param name="queueName">The name of the queue.</param>
+        /// <param name="request">The request.</param>
+        /// <returns>True if the request was put back, or no longer needs a response; false if
+        /// the queue is full.</returns>
+        public bool RequeueRequest(string queueName, BackendRequestBase request)
+        {
+            // No one is waiting on this any more
+            if (!ValidateRequest(request))
+                return true;
+
+            Channel<BackendRequestBase> queue = IsControlCommand(request.reqtype)
+                                              ? GetOrCreateControlQueue(queueName)
+                                              : GetOrCreateQueue(queueName);
+            if (!queue.Writer.TryWrite(request))
+            {
+                _logger.LogWarning($"Unable to requeue request '{request.reqtype}' in '{queueName}': the queue is full (#reqid {request.reqid})");
+                return false;
+            }
+
+            _logger.LogTrace($"Request '{request.reqtype}' requeued in '{queueName}' (#reqid {request.reqid})");
+            return true;
+        }
+
         /// <summary>
         /// Get a request from the queue.
         /// </summary>
@@ -181,10 +238,13 @@ namespace CodeProject.AI.Server.Backend
             if(!_queues.TryGetValue(queueName.ToLower(), out Channel<BackendRequestBase>? queue))
                 return null;
 
-            BackendRequestBase? request;
+            _controlQueues.TryGetValue(queueName.ToLower(), out Channel<BackendRequestBase>? controlQueue);
+
+            BackendRequestBase? request = null;
             do
             {
-                if (!queue.Reader.TryRead(out request))
+                bool found = controlQueue is not null && controlQueue.Reader.TryRead(out request);
+                if (!found && !queue.Reader.TryRead(out request))
                     return null;
 
             } while (!ValidateRequest(request));
@@ -197,14 +257,20 @@ namespace CodeProject.AI.Server.Backend
         /// </summary>
         /// <param name="queueName">The name of the queue.</param>
         /// <param name="token">The cancellation token</param>
+        /// <param name="controlOnly">Whether to only take requests from the control lane. Otherwise
+        /// requests are taken from the control lane first, then the main queue.</param>
         /// <returns>A request if available. null if the queue does not exist or is cancelled 
         /// waiting for a value.</returns>
         public async ValueTask<BackendRequestBase?> DequeueRequestAsync(string queueName, 
-                                                                        CancellationToken token = default)
+                                                                        CancellationToken token = default,
+                                                                        bool controlOnly = false)
         {
-            if (!_queues.TryGetValue(queueName.ToLower(), out Channel<BackendRequestBase>? queue))
+            Channel<BackendRequestBase>? queue = null;
+            if (!controlOnly && !_queues.TryGetValue(queueName.ToLower(), out queue))
                 return null;
 
+            Channel<BackendRequestBase> controlQueue = GetOrCreateControlQueue(queueName);
+
             BackendRequestBase? request = null;
             do
             {
@@ -222,7 +288,7 @@ namespace CodeProject.AI.Server.Backend
 
                 try
                 {
-                    request = await queue.Reader.ReadAsync(theToken).ConfigureAwait(false);
+                    request = await ReadAsync(controlQueue, queue, theToken).ConfigureAwait(false);
                     if (request != null)
                         _logger.LogTrace($"Request '{request.reqtype}' dequeued from '{queueName}' (#reqid {request.reqid})");
                 }
@@ -236,6 +302,35 @@ namespace CodeProject.AI.Server.Backend
             return request;
         }
 
+        /// <summary>
+        /// Reads the next request from the control lane or, if there's nothing waiting there, the
+        /// main queue (if given), waiting for a request to arrive in either.
+        /// </summary>
+        private static async ValueTask<BackendRequestBase?> ReadAsync(Channel<BackendRequestBase> controlQueue,
+                                                                     Channel<BackendRequestBase>? queue,
+                                                                     CancellationToken token)
+        {
+            if (queue is null)
+                return await controlQueue.Reader.ReadAsync(token).ConfigureAwait(false);
+
+            while (true)
+            {
+                if (controlQueue.Reader.TryRead(out BackendRequestBase? request) ||
+                    queue.Reader.TryRead(out request))
+                    return request;
+
+                // Stop waiting on the other lane once one has something, so we don't leave waiters
+                // behind on the channels
+                using var waitCancellation = CancellationTokenSource.CreateLinkedTokenSource(token);
+                Task<bool> controlWait = controlQueue.Reader.WaitToReadAsync(waitCancellation.Token).AsTask();
+                Task<bool> queueWait   = queue.Reader.WaitToReadAsync(waitCancellation.Token).AsTask();
+
+                await Task.WhenAny(controlWait, queueWait).ConfigureAwait(false);
+                waitCancellation.Cancel();
+                token.ThrowIfCancellationRequested();
+            }
+        }
+
         private bool ValidateRequest(BackendRequestBase request)
         {
             var reqId = request.reqid;
@@ -1,4 +1,5 @@
-﻿using System.Collections.Generic;
+﻿using System;
+using System.Collections.Generic;
 using System.Text.RegularExpressions;
 using CodeProject.AI.SDK.API;
 using Microsoft.AspNetCore.Http;
@@ -41,6 +42,58 @@ namespace CodeProject.AI.Server.Controllers
             if (entry == null)
                 return new ErrorResponse("No log entry provided");
 
+            WriteLog(entry, category, label, log_level);
+
+            return new ResponseBase
+            {
+                success = true,
+            };
+        }
+
+        /// <summary>
+        /// Adds a batch of log entries in one request. Modules use this to send
+        /// the entries that have built up since their last post all at once,
+        /// rather than making one request per entry. A POST request.
+        /// </summary>
+        /// <param name="entries">The log entries.</param>
+        /// <returns>A Response Object.</returns>
+        [HttpPost("batch", Name = "Add Log Entries")]
+        [Consumes("application/json")]
+        [Produces("application/json")]
+        [ProducesResponseType(StatusCodes.Status200OK)]
+        [ProducesResponseType(StatusCodes.Status400BadRequest)]
+        public ResponseBase AddLogs([FromBody] List<LogEntryRequest>? entries)
+        {
+            if (entries == null)
+                return new ErrorResponse("No log entries provided");
+
+            foreach (LogEntryRequest logEntry in entries)
+            {
+                if (logEntry.entry == null)
+                    continue;
+
+                LogLevel? logLevel = null;
+                if (Enum.TryParse(logEntry.log_level, true, out LogLevel level))
+                    logLevel = level;
+
+                WriteLog(logEntry.entry, logEntry.category, logEntry.label, logLevel);
+            }
+
+            return new ResponseBase
+            {
+                success = true,
+            };
+        }
+
+        /// <summary>
+        /// Writes a log entry to the server's log.
+        /// </summary>
+        /// <param name="entry">The log entry</param>
+        /// <param name="category">The category (usually the module) of the entry</param>
+        /// <param name="label">An optional label for the entry</param>
+        /// <param name="log_level">The log level</param>
+        private void WriteLog(string entry, string? category, string? label, LogLevel? log_level)
+        {
             // We're using the .NET logger which means we don't have a huge amount of control
             // when it comes to adding extra info. We'll encode category and label info in the
             // leg message itself using special markers: [[...]] for category, {{..}} for label
@@ -67,11 +120,6 @@ namespace CodeProject.AI.Server.Controllers
                 case LogLevel.Critical:    _logger.LogCritical(msg);    break;
                 default:                   _logger.LogInformation(msg); break;
             }
-
-            return new ResponseBase
-            {
-                success = true,
-            };
         }
 
         /// <summary>
@@ -104,4 +152,30 @@ namespace CodeProject.AI.Server.Controllers
             return response;
         }
     }
+
+    /// <summary>
+    /// A log entry, as sent to the batch log endpoint.
+    /// </summary>
+    public class LogEntryRequest
+    {
+        /// <summary>
+        /// Gets or sets the log entry.
+        /// </summary>
+        public string? entry { get; set; }
+
+        /// <summary>
+        /// Gets or sets the category (usually the module) of the entry.
+        /// </summary>
+        public string? category { get; set; }
+
+        /// <summary>
+        /// Gets or sets the label of the entry.
+        /// </summary>
+        public string? label { get; set; }
+
+        /// <summary>
+        /// Gets or sets the log level (eg "information", "error").
+        /// </summary>
+        public string? log_level { get; set; }
+    }
 }
@@ -1,5 +1,10 @@
 ﻿using System;
+using System.Buffers.Binary;
+using System.Collections.Generic;
 using System.IO;
+using System.Linq;
+using System.Net.WebSockets;
+using System.Text;
 using System.Text.Json;
 using System.Text.Json.Nodes;
 using System.Threading;
@@ -7,6 +12,7 @@ using System.Threading.Tasks;
 
 using Microsoft.AspNetCore.Http;
 using Microsoft.AspNetCore.Mvc;
+using Microsoft.Extensions.Logging;
 
 using CodeProject.AI.SDK;
 using CodeProject.AI.Server.Backend;
@@ -23,19 +29,28 @@ namespace CodeProject.AI.Server.Controllers
     [ApiController]
     public class QueueController : ControllerBase
     {
+        // The content type of a request sent as a binary frame. See BuildBinaryFrame.
+        private const string BinaryFrameContentType = "application/octet-stream";
+
+        private static readonly JsonSerializerOptions _jsonOptions = new(JsonSerializerDefaults.Web);
+
         private readonly QueueServices         _queueService;
         private readonly ModuleProcessServices _moduleProcessService;
+        private readonly ILogger               _logger;
 
         /// <summary>
         /// Initializes a new instance of the QueueController class.
         /// </summary>
         /// <param name="queueService">The QueueService.</param>
         /// <param name="moduleProcessService">The Module Process Service.</param>
+        /// <param name="logger">The logger</param>
         public QueueController(QueueServices queueService,
-                               ModuleProcessServices moduleProcessService)
+                               ModuleProcessServices moduleProcessService,
+                               ILogger<QueueController> logger)
         {
             _queueService         = queueService;
             _moduleProcessService = moduleProcessService;
+            _logger               = logger;
         }
 
         /// <summary>
@@ -45,39 +60,198 @@ namespace CodeProject.AI.Server.Controllers
         /// <param name="moduleId">The ID of the module making the request</param>
         /// <param name="executionProvider">The execution provider, typically the GPU library in use</param>
         /// <param name="canUseGPU">Whether or not the module can use the current GPU</param>
+        /// <param name="binary">Whether the module would like requests that include files sent
+        /// as binary frames rather than as JSON with base64 encoded files</param>
+        /// <param name="lane">If "control", only control commands (eg status) are returned. This
+        /// allows a module to keep handling these quickly while its workers are busy. The response
+        /// has an X-Queue-Lane header so the module knows the lane was honoured.</param>
         /// <param name="token">The aborted request token.</param>
         /// <returns>The Request Object.</returns>
         [HttpGet("{name}", Name = "GetRequestFromQueue")]
         [Produces("application/json")]
         [ProducesResponseType(StatusCodes.Status200OK)]
         [ProducesResponseType(StatusCodes.Status400BadRequest)]
-        public async Task<OkObjectResult> GetQueue([FromRoute] string name,
-                                                   [FromQuery] string moduleId,
-                                                   [FromQuery] string? executionProvider,
-                                                   [FromQuery] bool? canUseGPU,
-                                                   CancellationToken token)
+        public async Task<IActionResult> GetQueue([FromRoute] string name,
+                                                  [FromQuery] string moduleId,
+                                                  [FromQuery] string? executionProvider,
+                                                  [FromQuery] bool? canUseGPU,
+                                                  [FromQuery] bool? binary,
+                                                  [FromQuery] string? lane,
+                                                  CancellationToken token)
         {
-            BackendRequestBase? request = await _queueService.DequeueRequestAsync(name, token)
-                                                             .ConfigureAwait(false);
+            bool controlOnly = lane.EqualsIgnoreCase(QueueServices.ControlLane);
+            if (controlOnly)
+                Response.Headers["X-Queue-Lane"] = QueueServices.ControlLane;
 
-            bool shuttingDown = false;
+            BackendRequestBase? request = await DequeueRequestAsync(name, moduleId, executionProvider,
+                                                                    canUseGPU, token, controlOnly)
+                                                .ConfigureAwait(false);
 
-            if (request != null)
+            byte[]? frame = binary == true && request is not null ? BuildBinaryFrame(request) : null;
+            if (frame is not null)
+                return File(frame, BinaryFrameContentType);
+
+            return new OkObjectResult(request);
+        }
+
+        /// <summary>
+        /// Opens a WebSocket to the named queue. This is an alternative to long-polling
+        /// GetRequestFromQueue and posting each response to SetResponseInQueue, and saves the
+        /// overhead of a HTTP request for each. The module sends {"type": "get", "id": 7} for each
+        /// request it is ready to take, and is sent the request (or nothing if none arrived in
+        /// time) in return, prefixed with the id of the get so the module can match the two up:
+        /// "7\n" before a text message, or the id as 4 bytes (little endian) before a binary one.
+        /// It sends {"type": "response", "reqid": "...", "response": {...}} to return the
+        /// response for a request.
+        /// </summary>
+        /// <param name="name">The name of the Queue.</param>
+        /// <param name="moduleId">The ID of the module making the request</param>
+        /// <param name="executionProvider">The execution provider, typically the GPU library in use</param>
+        /// <param name="canUseGPU">Whether or not the module can use the current GPU</param>
+        /// <param name="binary">Whether the module would like requests that include files sent
+        /// as binary frames (binary messages) rather than as JSON with base64 encoded files</param>
+        /// <param name="token">The aborted request token.</param>
+        [HttpGet("{name}/ws", Name = "OpenQueueWebSocket")]
+        [ApiExplorerSettings(IgnoreApi = true)]
+        public async Task OpenQueueWebSocket([FromRoute] string name,
+                                             [FromQuery] string moduleId,
+                                             [FromQuery] string? executionProvider,
+                                             [FromQuery] bool? canUseGPU,
+                                             [FromQuery] bool? binary,
+                                             CancellationToken token)
+        {
+            if (!HttpContext.WebSockets.IsWebSocketRequest)
             {
-                // We're going to sniff the request to see if it's a Quit command. If so it allows us
-                // to update the status of the process. If it's a quit command then the process will
-                // shut down and no longer updating its status via the queue. This is our last chance.
-                if (request.reqtype?.ToLower() == "quit" && request is BackendRequest origRequest)
+                HttpContext.Response.StatusCode = StatusCodes.Status400BadRequest;
+                return;
+            }
+
+            using WebSocket socket = await HttpContext.WebSockets.AcceptWebSocketAsync()
+                                                                 .ConfigureAwait(false);
+
+            // Only one send at a time is allowed on a WebSocket
+            using var sendLock = new SemaphoreSlim(1, 1);
+
+            // Used to stop waiting on the queue once the socket's closed
+            using var closing  = CancellationTokenSource.CreateLinkedTokenSource(token);
+            var pendingSends   = new List<Task>();
+
+            async Task SendRequestAsync(int getId)
+            {
+                // Don't take a request off the queue for a module that's gone
+                if (socket.State != WebSocketState.Open)
+                    return;
+
+                BackendRequestBase? request = await DequeueRequestAsync(name, moduleId, executionProvider,
+                                                                        canUseGPU, closing.Token)
+                                                    .ConfigureAwait(false);
+
+                byte[]? frame = binary == true && request is not null ? BuildBinaryFrame(request) : null;
+                byte[] message = frame is not null
+                               ? TagWebSocketReply(getId, frame)
+                               : Encoding.UTF8.GetBytes($"{getId}\n" +
+                                                        (request is null ? string.Empty
+                                                         : JsonSerializer.Serialize(request, request.GetType(),
+                                                                                    _jsonOptions)));
+
+                bool sent = false;
+                try
                 {
-                    string? requestModuleId = origRequest.payload?.GetValue("moduleId");
-                    shuttingDown = moduleId.EqualsIgnoreCase(requestModuleId);
+                    await sendLock.WaitAsync(closing.Token).ConfigureAwait(false);
+                    try
+                    {
+                        if (socket.State == WebSocketState.Open)
+                        {
+                            await socket.SendAsync(new ArraySegment<byte>(message),
+                                                   frame is null ? WebSocketMessageType.Text
+                                                                 : WebSocketMessageType.Binary,
+                                                   true, closing.Token)
+                                        .ConfigureAwait(false);
+                            sent = true;
+                        }
+                    }
+                    finally
+                    {
+                        sendLock.Release();
+                    }
+                }
+                finally
+                {
+                    // The socket closed between taking the request and sending it, so put it back
+                    // for another module (or this one, once it's reconnected) to take
+                    if (!sent && request is not null)
+                        _queueService.RequeueRequest(name, request);
                 }
             }
 
-            UpdateProcessStatus(moduleId, incrementProcessCount: false, executionProvider,
-                                canUseGPU, shuttingDown);
+            var buffer  = new byte[16 * 1024];
+            var message = new MemoryStream();
 
-            return new OkObjectResult(request);
+            try
+            {
+                while (socket.State == WebSocketState.Open && !token.IsCancellationRequested)
+                {
+                    WebSocketReceiveResult result = await socket.ReceiveAsync(new ArraySegment<byte>(buffer), token)
+                                                                .ConfigureAwait(false);
+                    if (result.MessageType == WebSocketMessageType.Close)
+                    {
+                        await socket.CloseAsync(WebSocketCloseStatus.NormalClosure, null, token)
+                                    .ConfigureAwait(false);
+                        break;
+                    }
+
+                    message.Write(buffer, 0, result.Count);
+                    if (!result.EndOfMessage)
+                        continue;
+
+                    byte[] data = message.ToArray();
+                    message.SetLength(0);
+
+                    try
+                    {
+                        if (JsonNode.Parse(data) is not JsonObject entry)
+                            throw new JsonException("The message isn't a JSON object.");
+
+                        string? type = entry["type"]?.ToString();
+                        if (type.EqualsIgnoreCase("get"))
+                        {
+                            // Don't wait: the module may ask for several requests at once
+                            pendingSends.RemoveAll(task => task.IsCompleted);
+                            int getId = entry["id"] is JsonValue id && id.TryGetValue(out int value) ? value : 0;
+                            pendingSends.Add(SendRequestAsync(getId));
+                        }
+                        else if (type.EqualsIgnoreCase("response"))
+                        {
+                            string? reqid = entry["reqid"]?.ToString();
+                            if (!string.IsNullOrWhiteSpace(reqid))
+                                SaveResponse(reqid, entry["response"]?.ToJsonString());
+                        }
+                    }
+                    catch (JsonException ex)
+                    {
+                        // One bad message shouldn't cost the module its connection
+                        _logger.LogWarning($"Ignoring a bad message on the WebSocket for '{name}': {ex.Message}");
+                    }
+                }
+            }
+            catch (OperationCanceledException)
+            {
+            }
+            catch (WebSocketException)
+            {
+                // The module has gone away. It'll reconnect, or fall back to HTTP
+            }
+            finally
+            {
+                closing.Cancel();
+                try
+                {
+                    await Task.WhenAll(pendingSends).ConfigureAwait(false);
+                }
+                catch
+                {
+                }
+            }
         }
 
         /// <summary>
@@ -99,6 +273,159 @@ namespace CodeProject.AI.Server.Controllers
                 responseString = await textreader.ReadToEndAsync().ConfigureAwait(false);
             }
 
+            if (!SaveResponse(reqid, responseString))
+                return BadRequest("failure to set response.");
+
+            return Ok("Response saved.");
+        }
+
+        /// <summary>
+        /// Sets the responses for a number of requests in one call. The body is a JSON array of
+        /// { "reqid": "...", "response": { ... } } objects. This allows a module to return the
+        /// responses that have built up while it was busy without a round trip for each.
+        /// </summary>
+        /// <returns>The number of responses saved.</returns>
+        [HttpPost("responses", Name = "SetResponsesInQueue")]
+        [ProducesResponseType(StatusCodes.Status200OK)]
+        [ProducesResponseType(StatusCodes.Status400BadRequest)]
+        public async Task<ObjectResult> SetResponses()
+        {
+            string? responsesString = null;
+            using var bodyStream = HttpContext.Request.Body;
+            if (bodyStream != null)
+            {
+                using var textreader = new StreamReader(bodyStream);
+                responsesString = await textreader.ReadToEndAsync().ConfigureAwait(false);
+            }
+
+            JsonArray? responses;
+            try
+            {
+                responses = JsonSerializer.Deserialize<JsonArray>(responsesString ?? "");
+            }
+            catch (JsonException)
+            {
+                return BadRequest("Responses must be an array.");
+            }
+
+            // A bad entry is skipped rather than failing the whole batch, since the module would
+            // then have to send the good responses again
+            int saved = 0;
+            foreach (JsonNode? entry in responses ?? new JsonArray())
+            {
+                if (entry is not JsonObject item || item["response"] is not JsonNode response)
+                    continue;
+
+                string? reqid = item["reqid"]?.ToString();
+                if (string.IsNullOrWhiteSpace(reqid))
+                    continue;
+
+                try
+                {
+                    if (SaveResponse(reqid, response.ToJsonString()))
+                        saved++;
+                }
+                catch (JsonException)
+                {
+                }
+            }
+
+            return Ok($"{saved} responses saved.");
+        }
+
+        /// <summary>
+        /// Builds a binary frame for a request that has files. A frame is the length of the header
+        /// (4 bytes, little endian), then the header, which is the request as UTF-8 JSON with each
+        /// file's data replaced by its length, followed by the raw contents of each file in turn.
+        /// This saves base64 encoding the files here and decoding them in the module.
+        /// </summary>
+        /// <param name="request">The request</param>
+        /// <returns>The frame, or null if the request has no files to send this way</returns>
+        private static byte[]? BuildBinaryFrame(BackendRequestBase request)
+        {
+            if (request is not BackendRequest backendRequest || backendRequest.payload?.files?.Any() != true)
+                return null;
+
+            List<byte[]> contents = backendRequest.payload.files
+                                                  .Select(file => file.data ?? Array.Empty<byte>())
+                                                  .ToList();
+
+            JsonNode? header = JsonSerializer.SerializeToNode(request, request.GetType(), _jsonOptions);
+            if (header?["payload"]?["files"] is not JsonArray files || files.Count != contents.Count)
+                return null;
+
+            for (int i = 0; i < files.Count; i++)
+            {
+                if (files[i] is JsonObject file)
+                {
+                    file.Remove("data");
+                    file["length"] = contents[i].Length;
+                }
+            }
+
+            byte[] headerBytes = Encoding.UTF8.GetBytes(header!.ToJsonString(_jsonOptions));
+
+            var frame = new byte[4 + headerBytes.Length + contents.Sum(content => content.Length)];
+            BinaryPrimitives.WriteInt32LittleEndian(frame, headerBytes.Length);
+            headerBytes.CopyTo(frame, 4);
+
+            int offset = 4 + headerBytes.Length;
+            foreach (byte[] content in contents)
+            {
+                content.CopyTo(frame, offset);
+                offset += content.Length;
+            }
+
+            return frame;
+        }
+
+        /// <summary>
+        /// Prefixes a binary frame sent over a queue's WebSocket with the id of the module's
+        /// "get" it answers, as 4 bytes (little endian). See OpenQueueWebSocket.
+        /// </summary>
+        /// <param name="getId">The id of the get</param>
+        /// <param name="frame">The frame</param>
+        /// <returns>The tagged frame</returns>
+        private static byte[] TagWebSocketReply(int getId, byte[] frame)
+        {
+            var message = new byte[4 + frame.Length];
+            BinaryPrimitives.WriteInt32LittleEndian(message.AsSpan(0, 4), getId);
+            frame.CopyTo(message, 4);
+
+            return message;
+        }
+
+        private async Task<BackendRequestBase?> DequeueRequestAsync(string name, string moduleId,
+                                                                    string? executionProvider,
+                                                                    bool? canUseGPU,
+                                                                    CancellationToken token,
+                                                                    bool controlOnly = false)
+        {
+            BackendRequestBase? request = await _queueService.DequeueRequestAsync(name, token, controlOnly)
+                                                             .ConfigureAwait(false);
+
+            bool shuttingDown = false;
+
+            if (request != null)
+            {
+                // We're going to sniff the request to see if it's a Quit command. If so it allows us
+                // to update the status of the process. If it's a quit command then the process will
+                // shut down and no longer updating its status via the queue. This is our last chance.
+                if (request.reqtype?.ToLower() == "quit" && request is BackendRequest origRequest)
+                {
+                    string? requestModuleId = origRequest.payload?.GetValue("moduleId");
+                    shuttingDown = moduleId.EqualsIgnoreCase(requestModuleId);
+                }
+            }
+
+            UpdateProcessStatus(moduleId, incrementProcessCount: false, executionProvider,
+                                canUseGPU, shuttingDown);
+
+            return request;
+        }
+
+        private bool SaveResponse(string reqid, string? responseString)
+        {
             var response = JsonSerializer.Deserialize<JsonObject>(responseString ?? "");
  
             string? command           = response?["command"]?.ToString();
@@ -113,11 +440,7 @@ namespace CodeProject.AI.Server.Controllers
                                     executionProvider: executionProvider, canUseGPU: canUseGPU);
             }
 
-            var success = _queueService.SetResult(reqid, responseString);
-            if (!success)
-                return BadRequest("failure to set response.");
-
-            return Ok("Response saved.");
+            return _queueService.SetResult(reqid, responseString);
         }
 
         private void UpdateProcessStatus(string moduleId, bool incrementProcessCount = false,
@@ -101,6 +101,13 @@ namespace CodeProject.AI.Server.Modules
         /// </summary>
         public int? Parallelism { get; set; }
 
+        /// <summary>
+        /// Gets or sets how the module runs its work: "thread" (the default) to use threads within
+        /// the module's process, or "process" to use a pool of worker processes, each holding its
+        /// own copy of the module. Currently supported by Python modules only.
+        /// </summary>
+        public string? ExecutionMode { get; set; }
+
         /// <summary>
         /// Gets or sets the device name (eg CUDA device number, TPU device name) to use. Be careful to
         /// ensure this device exists.
@@ -179,6 +186,7 @@ namespace CodeProject.AI.Server.Modules
                 summary.AppendLine($"Platforms:     {string.Join(',', Platforms)}");
                 summary.AppendLine($"GPU:           Support {((SupportGPU == true)? "enabled" : "disabled")}");
                 summary.AppendLine($"Parallelism:   {Parallelism}");
+                summary.AppendLine($"Exec Mode:     {ExecutionMode ?? "thread"}");
                 summary.AppendLine($"Accelerator:   {AcceleratorDeviceName}");
                 summary.AppendLine($"Half Precis.:  {HalfPrecision}");
                 summary.AppendLine($"Runtime:       {Runtime}");
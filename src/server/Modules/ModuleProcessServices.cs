@@ -649,6 +649,8 @@ namespace CodeProject.AI.Server.Modules
             processEnvironmentVars.TryAdd("CPAI_MODULE_PATH",        _moduleSettings.GetModulePath(module));
             processEnvironmentVars.TryAdd("CPAI_MODULE_PARALLELISM", module.Parallelism.ToString());
             processEnvironmentVars.TryAdd("CPAI_MODULE_QUEUENAME",   module.Queue);
+            if (!string.IsNullOrWhiteSpace(module.ExecutionMode))
+                processEnvironmentVars.TryAdd("CPAI_MODULE_EXECUTION_MODE", module.ExecutionMode);
             if ((module.RequiredMb ?? 0) > 0)
                 processEnvironmentVars.TryAdd("CPAI_MODULE_REQUIRED_MB", module.RequiredMb?.ToString());
             processEnvironmentVars.TryAdd("CPAI_MODULE_SUPPORT_GPU", (module.SupportGPU ?? false).ToString());
@@ -165,6 +165,9 @@ namespace CodeProject.AI.Server
             https://learn.microsoft.com/en-us/aspnet/core/fundamentals/static-files?view=aspnetcore-7.0#serve-files-from-multiple-locations
             */
 
+            // Modules can keep a WebSocket open to their queue (see QueueController)
+            app.UseWebSockets();
+
             app.UseRouting();
 
             app.UseCors("allowAllOrigins");
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The SDK isn't installed as a package: modules add it to their path, and so do we
+sdk_dir = os.path.join(os.path.dirname(__file__), "..", "..", "src", "SDK", "Python")
+sys.path.append(sdk_dir)
+sys.path.append(os.path.join(sdk_dir, "tools"))
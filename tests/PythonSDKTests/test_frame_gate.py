@@ -0,0 +1,113 @@
+import base64
+import io
+import json
+import time
+
+from PIL import Image, ImageDraw
+
+from frame_gate import FrameGate
+from request_data import RequestData
+
+
+def make_frame(camera_id: str = "driveway", box: tuple = None, command: str = "detect") -> RequestData:
+    img = Image.new("RGB", (320, 240), (90, 110, 70))
+    if box:
+        ImageDraw.Draw(img).rectangle(box, fill=(250, 250, 250))
+
+    with io.BytesIO() as buffer:
+        img.save(buffer, format="PNG")
+        png = base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    values = [ { "key": "camera_id", "value": [ camera_id ] } ] if camera_id else []
+    return RequestData(json.dumps({
+        "reqid": "1",
+        "payload": { "command": command, "urlSegments": [], "values": values,
+                     "files": [ { "contentType": "image/png", "data": png } ] }
+    }))
+
+
+def process(gate: FrameGate, data: RequestData, result: dict) -> dict:
+    """ Does what the module runner does with each frame """
+    key       = FrameGate.make_key(data)
+    thumbnail = gate.make_thumbnail(data)
+    reused    = gate.get_reusable_result(key, thumbnail)
+    if reused is not None:
+        return reused
+
+    gate.update(key, thumbnail, result)
+    return result
+
+
+def test_no_key_without_camera():
+    assert FrameGate.make_key(make_frame(camera_id=None)) is None
+    assert FrameGate.make_key(make_frame()) == FrameGate.make_key(make_frame(box=(0, 0, 50, 50)))
+    assert FrameGate.make_key(make_frame()) != FrameGate.make_key(make_frame("porch"))
+    assert FrameGate.make_key(make_frame()) != FrameGate.make_key(make_frame(command="custom"))
+
+
+def test_thumbnail():
+    gate      = FrameGate(0.01, thumbnail_size=(64, 48))
+    thumbnail = gate.make_thumbnail(make_frame())
+
+    assert thumbnail.size == (64, 48)
+    assert thumbnail.mode == "L"
+
+
+def test_duplicate_frame_reuses_result():
+    gate   = FrameGate(0.01)
+    result = process(gate, make_frame(), { "success": True, "count": 1 })
+    assert "reused" not in result
+
+    result = process(gate, make_frame(), { "success": True, "count": 2 })
+    assert result == { "success": True, "count": 1, "reused": True }
+    assert gate.reused == 1
+
+
+def test_changed_frame_is_processed():
+    gate = FrameGate(0.01)
+    process(gate, make_frame(), { "success": True, "count": 1 })
+
+    # An object 40 x 40 pixels in a 320 x 240 frame is 2% of it
+    result = process(gate, make_frame(box=(100, 100, 139, 139)), { "success": True, "count": 2 })
+    assert result == { "success": True, "count": 2 }
+
+    # and the changed frame is what later frames are compared with
+    result = process(gate, make_frame(box=(100, 100, 139, 139)), { "success": True, "count": 3 })
+    assert result["count"] == 2 and result["reused"]
+
+
+def test_cameras_are_kept_apart():
+    gate = FrameGate(0.01)
+    process(gate, make_frame("driveway"), { "success": True, "count": 1 })
+
+    result = process(gate, make_frame("porch"), { "success": True, "count": 2 })
+    assert result == { "success": True, "count": 2 }
+
+
+def test_failures_are_not_reused():
+    gate = FrameGate(0.01)
+    process(gate, make_frame(), { "success": False, "error": "Out of memory" })
+
+    result = process(gate, make_frame(), { "success": True, "count": 2 })
+    assert result == { "success": True, "count": 2 }
+
+
+def test_results_are_not_reused_for_ever(monkeypatch):
+    now = [ 1000.0 ]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    gate = FrameGate(0.01, max_reuse_secs=60)
+    process(gate, make_frame(), { "success": True, "count": 1 })
+
+    now[0] += 61
+    result = process(gate, make_frame(), { "success": True, "count": 2 })
+    assert result == { "success": True, "count": 2 }
+
+
+def test_least_recently_seen_camera_is_dropped():
+    gate = FrameGate(0.01, max_sources=2)
+    for camera_id in [ "a", "b", "c" ]:
+        process(gate, make_frame(camera_id), { "success": True, "camera": camera_id })
+
+    assert process(gate, make_frame("a"), { "success": True, "camera": "a2" }) == { "success": True, "camera": "a2" }
+    assert process(gate, make_frame("c"), { "success": True, "camera": "c2" })["reused"]
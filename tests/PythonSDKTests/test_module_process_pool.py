@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+from module_process_pool import ModuleProcessPool
+from module_runner import ModuleRunner
+from request_data import RequestData
+
+
+class QueueModule(ModuleRunner):
+    """ A module whose initialise sets the properties the runner needs """
+
+    def initialise(self):
+        self.queue_name     = "test_queue"
+        self.processor_type = "GPU"
+
+
+def test_worker_properties_are_copied_back():
+    async def run():
+        pool = ModuleProcessPool(QueueModule, 1)
+        try:
+            properties, _ = await pool.start()
+        finally:
+            pool.shutdown()
+        return properties
+
+    properties = asyncio.run(run())
+    assert properties["queue_name"] == "test_queue"
+    assert properties["processor_type"] == "GPU"
+
+
+class SlowModule(ModuleRunner):
+    """ A module that is busy for a while with each request """
+
+    def process(self, data):
+        time.sleep(2)
+        return { "success": True }
+
+
+def test_status_does_not_wait_for_workers():
+    async def run():
+        module = SlowModule()
+        module._process_pool = ModuleProcessPool(SlowModule, 1)
+        try:
+            await module._process_pool.start()
+
+            busy = asyncio.create_task(module.call_module_method(module.process, RequestData()))
+            await asyncio.sleep(0.1)
+
+            start  = time.perf_counter()
+            status = await module.call_module_method(module.status, RequestData())
+            status_secs = time.perf_counter() - start
+
+            await busy
+        finally:
+            module._process_pool.shutdown()
+        return status, status_secs
+
+    status, status_secs = asyncio.run(run())
+    assert status["executionMode"] == "process"
+    assert status_secs < 1
@@ -0,0 +1,208 @@
+import base64
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from request_data import RequestData
+
+
+def make_request(files: list, values: dict = None) -> dict:
+    return {
+        "reqid":   "1",
+        "payload": {
+            "queue":       "objectdetection_queue",
+            "urlSegments": [ "detect" ],
+            "command":     "detect",
+            "files":       files,
+            "values":      [ { "key": key, "value": [ value ] } for key, value in (values or {}).items() ]
+        }
+    }
+
+
+def test_frame_round_trip():
+    contents = [ b"\x00\x01\x02\xff", b"", b"second file" ]
+    files    = [ { "name": f"file{index}", "contentType": "application/octet-stream", "data": "ignored" }
+                 for index in range(len(contents)) ]
+    request  = make_request(files, { "min_confidence": "0.4" })
+
+    frame   = RequestData.encode_frame(request, contents)
+    decoded = RequestData.decode_frame(frame)
+
+    assert decoded["reqid"] == "1"
+    assert decoded["payload"]["values"] == request["payload"]["values"]
+    for file, decoded_file, content in zip(files, decoded["payload"]["files"], contents):
+        assert decoded_file["name"] == file["name"]
+        assert "data" not in decoded_file and "length" not in decoded_file
+        assert bytes(decoded_file["bytes"]) == content
+
+    # The caller's request is left as it was
+    assert request["payload"]["files"][0]["data"] == "ignored"
+
+
+def test_frame_files_are_views():
+    frame   = bytearray(RequestData.encode_frame(make_request([ { "name": "a" } ]), [ b"abcd" ]))
+    decoded = RequestData.decode_frame(frame)
+
+    frame[-4:] = b"wxyz"
+    assert bytes(decoded["payload"]["files"][0]["bytes"]) == b"wxyz"
+
+
+def test_request_from_frame():
+    png  = base64.b64decode(RequestData.encode_image(Image.new("RGB", (6, 4), (10, 20, 30))))
+    data = RequestData(RequestData.encode_frame(make_request([ { "name": "a.png" } ]), [ png ]))
+
+    assert data.request_id == "1"
+    assert data.command == "detect"
+    assert data.get_image(0).getpixel((0, 0)) == (10, 20, 30)
+
+    # and it still goes back to the server as JSON
+    file = json.loads(data.json())["payload"]["files"][0]
+    assert base64.b64decode(file["data"]) == png
+
+
+def test_parsed_on_first_use():
+    data = RequestData("not JSON")
+
+    with pytest.raises(json.JSONDecodeError):
+        data.command
+
+
+def test_values():
+    request = make_request([])
+    request["payload"]["values"] = [
+        { "key": "label",          "value": [ "person", "car" ] },
+        { "key": "label",          "value": [ "dog" ] },
+        { "key": "empty",          "value": [] },
+        { "key": "min_confidence", "value": [ "0.4" ] },
+        { "key": "count",          "value": [ "3" ] },
+        { "key": "bad_count",      "value": [ "three" ] },
+        { "key": "enabled",        "value": [ "Yes" ] }
+    ]
+    data = RequestData(json.dumps(request))
+
+    # The first entry for a key wins
+    assert data.get_values("label") == [ "person", "car" ]
+    assert data.get_value("label") == "person"
+    assert data.get_values("missing") == []
+    assert data.get_value("empty", "default") == "default"
+
+    assert data.get_float("min_confidence") == 0.4
+    assert data.get_int("count") == 3
+    assert data.get_int("bad_count", 5) == 5
+    assert data.get_int("missing", 7) == 7
+    assert data.get_bool("enabled") is True
+    assert data.get_bool("missing", False) is False
+
+
+def test_new_payload_replaces_values():
+    data = RequestData(json.dumps(make_request([], { "count": "3" })))
+    assert data.get_int("count") == 3
+
+    data.payload = make_request([], { "count": "4" })["payload"]
+    assert data.get_int("count") == 4
+
+
+def test_image_scaled_as_decoded():
+    jpeg = RequestData.encode_image(Image.new("RGB", (640, 480), (10, 20, 30)), "JPEG")
+    data = RequestData(json.dumps(make_request([ { "data": jpeg } ])))
+
+    img = data.get_image(0, max_size=160)
+    assert img.size == (160, 120)
+    assert data.get_image_size(0) == (640, 480)
+
+    # Each size is decoded once
+    assert data.get_image(0, max_size=160) is img
+
+    # and images are never scaled up
+    assert data.get_image(0).size == (640, 480)
+    assert data.get_image(0, max_size=1000).size == (640, 480)
+
+    assert data.get_image(0, max_size=320, as_numpy=True).shape == (240, 320, 3)
+
+
+def test_image_size_without_decoding():
+    png  = RequestData.encode_image(Image.new("RGB", (30, 20)))
+    data = RequestData(json.dumps(make_request([ { "data": png } ])))
+
+    assert data.get_image_size(0) == (30, 20)
+    assert data.get_image_size(1) is None
+
+
+def to_yuv420(rgb: np.ndarray, pixel_format: str) -> bytes:
+    """ Converts an RGB image to BT.601 (video range) nv12 or i420 pixels """
+    rgb = rgb.astype(np.float32)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+
+    y = 16  + 0.257 * r + 0.504 * g + 0.098 * b
+    u = 128 - 0.148 * r - 0.291 * g + 0.439 * b
+    v = 128 + 0.439 * r - 0.368 * g - 0.071 * b
+
+    # One U and V for each 2x2 block
+    height, width = y.shape
+    u = u.reshape(height // 2, 2, width // 2, 2).mean(axis=(1, 3))
+    v = v.reshape(height // 2, 2, width // 2, 2).mean(axis=(1, 3))
+
+    planes = [ y ]
+    planes += [ np.stack([ u, v ], axis=-1) ] if pixel_format == "nv12" else [ u, v ]
+    return b"".join(np.clip(np.round(plane), 0, 255).astype(np.uint8).tobytes() for plane in planes)
+
+
+def make_test_image(width: int = 8, height: int = 4) -> np.ndarray:
+    """ Blocks of flat colour, 2x2 pixels each, so chroma subsampling loses nothing """
+    colours = np.array([ [ 200, 30, 40 ], [ 20, 180, 60 ], [ 30, 50, 220 ], [ 128, 128, 128 ] ], dtype=np.uint8)
+    blocks  = np.arange((height // 2) * (width // 2)).reshape(height // 2, width // 2) % len(colours)
+    return colours[blocks].repeat(2, axis=0).repeat(2, axis=1)
+
+
+def test_raw_yuv_images():
+    rgb = make_test_image()
+    height, width = rgb.shape[:2]
+
+    for pixel_format in [ "nv12", "i420" ]:
+        content_type = f"image/x-raw; format={pixel_format}; width={width}; height={height}"
+        files        = [ { "contentType": content_type,
+                           "data": base64.b64encode(to_yuv420(rgb, pixel_format)).decode("ascii") } ]
+        data         = RequestData(json.dumps(make_request(files)))
+
+        assert data.get_raw_image_format(0) == (pixel_format, width, height)
+
+        img = data.get_image(0, as_numpy=True)
+        assert img.shape == (height, width, 3)
+        assert np.abs(img.astype(int) - rgb.astype(int)).max() <= 3, pixel_format
+
+        assert data.get_image(0).size == (width, height)
+
+
+def test_raw_rgb_images():
+    rgb = make_test_image()
+    for pixel_format, pixels in [ ("rgb24", rgb), ("bgr24", rgb[..., ::-1]) ]:
+        content_type = f"image/x-raw; format={pixel_format}; width=8; height=4"
+        files        = [ { "contentType": content_type, "data": base64.b64encode(pixels.tobytes()).decode("ascii") } ]
+        data         = RequestData(json.dumps(make_request(files)))
+
+        assert np.array_equal(data.get_image(0, as_numpy=True), rgb), pixel_format
+        assert np.array_equal(np.asarray(data.get_image(0)), rgb), pixel_format
+
+
+def test_raw_format_from_values():
+    rgb   = make_test_image()
+    files = [ { "data": base64.b64encode(rgb[..., ::-1].tobytes()).decode("ascii") } ]
+    data  = RequestData(json.dumps(make_request(files, { "pixel_format": "BGR24", "width": "8", "height": "4" })))
+
+    assert data.get_raw_image_format(0) == ("bgr24", 8, 4)
+    assert np.array_equal(data.get_image(0, as_numpy=True), rgb)
+
+
+def test_raw_format_not_understood():
+    for content_type in [ "image/x-raw; format=yuyv; width=8; height=4",
+                          "image/x-raw; format=nv12; width=8",
+                          "image/jpeg" ]:
+        data = RequestData(json.dumps(make_request([ { "contentType": content_type, "data": "" } ])))
+        assert data.get_raw_image_format(0) is None
+
+
+def test_raw_yuv_odd_size():
+    with pytest.raises(ValueError):
+        RequestData.decode_raw_image(bytes(7 * 4 * 3 // 2), "nv12", 7, 4)
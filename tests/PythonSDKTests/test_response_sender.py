@@ -0,0 +1,69 @@
+import asyncio
+import json
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from response_sender import ResponseSender
+
+
+def send(responses: list, batch_status: int) -> "tuple[list, list, ResponseSender]":
+    """
+    Sends responses to a server whose batch endpoint answers with batch_status,
+    and which rejects single responses for request "bad". Returns the batches
+    and single responses the server received, and the sender.
+    """
+    batches, singles = [], []
+
+    async def set_responses(request: web.Request) -> web.Response:
+        batches.append(json.loads(await request.text()))
+        return web.Response(status = batch_status)
+
+    async def set_response(request: web.Request) -> web.Response:
+        request_id = request.match_info["reqid"]
+        singles.append(request_id)
+        return web.Response(status = 400 if request_id == "bad" else 200)
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/v1/queue/responses", set_responses)
+        app.router.add_post("/v1/queue/{reqid}",   set_response)
+
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            sender = ResponseSender(session, str(server.make_url("/v1/queue/")), retry_pause_secs = 0)
+            for request_id, body in responses:
+                sender.queue_response(request_id, body)
+            await sender.close()
+            await sender.sending_loop()
+            return sender
+
+    sender = asyncio.run(run())
+    return batches, singles, sender
+
+
+def test_responses_sent_together():
+    batches, singles, sender = send([ ("1", { "success": True }), ("2", { "success": True }) ], 200)
+
+    assert batches == [ [ { "reqid": "1", "response": { "success": True } },
+                          { "reqid": "2", "response": { "success": True } } ] ]
+    assert singles == []
+    assert sender._batch_supported == True
+
+
+def test_old_server_gets_single_responses():
+    batches, singles, sender = send([ ("1", { "success": True }), ("2", { "success": True }) ], 404)
+
+    assert len(batches) == 1
+    assert sorted(singles) == [ "1", "2" ]
+    assert sender._batch_supported == False
+
+
+def test_rejected_batch_is_sent_one_at_a_time():
+    responses = [ ("1", { "success": True }), ("bad", { "success": True }), ("2", { "success": True }) ]
+    batches, singles, sender = send(responses, 400)
+
+    # Only the bad response is rejected, and it isn't sent again
+    assert len(batches) == 1
+    assert sorted(singles) == [ "1", "2", "bad" ]
+    assert sender._batch_supported is None
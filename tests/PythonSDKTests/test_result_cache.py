@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+from result_cache import ResultCache
+
+
+def test_get_returns_copy():
+    cache = ResultCache(max_bytes=10000, ttl_secs=60)
+    cache.put("a", { "success": True, "count": 1 })
+
+    result = cache.get("a")
+    result["count"] = 2
+    assert cache.get("a")["count"] == 1
+
+
+def test_predictions_are_not_shared():
+    cache = ResultCache(max_bytes=10000, ttl_secs=60)
+    cache.put("a", { "success": True, "predictions": [ { "label": "car" } ] })
+
+    result = cache.get("a")
+    result["predictions"][0]["label"] = "bus"
+    result["predictions"].append({ "label": "dog" })
+    assert cache.get("a")["predictions"] == [ { "label": "car" } ]
+
+
+def test_waiters_get_their_own_results():
+    cache = ResultCache(max_bytes=10000, ttl_secs=60)
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return { "success": True, "predictions": [ { "label": "car" } ] }
+
+    async def run():
+        return await asyncio.gather(*[ cache.get_or_compute("a", compute) for _ in range(3) ])
+
+    results = asyncio.run(run())
+    results[1]["predictions"].clear()
+    assert results[2]["predictions"] == [ { "label": "car" } ]
+    assert cache.get("a")["predictions"] == [ { "label": "car" } ]
+
+
+def test_only_successful_results_are_kept():
+    cache = ResultCache(max_bytes=10000, ttl_secs=60)
+    cache.put("a", { "success": False, "error": "Out of memory" })
+    cache.put("b", "not a result")
+
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.size == 0
+
+
+def test_results_expire(monkeypatch):
+    now = [ 1000.0 ]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    cache = ResultCache(max_bytes=10000, ttl_secs=5)
+    cache.put("a", { "success": True })
+
+    now[0] += 4
+    assert cache.get("a") is not None
+
+    now[0] += 2
+    assert cache.get("a") is None
+    assert cache.size == 0
+
+
+def test_least_recently_used_is_dropped():
+    result = { "success": True, "label": "x" * 50 }
+    cache  = ResultCache(max_bytes=0, ttl_secs=60)
+    cache.put("probe", result)
+    assert cache.size == 0          # Bigger than the whole cache, so not kept
+
+    cache.max_bytes = 3 * len('{"success": true, "label": "' + "x" * 50 + '"}')
+    cache.put("a", result)
+    cache.put("b", result)
+    cache.put("c", result)
+    assert cache.get("a") is not None   # a is now more recently used than b
+
+    cache.put("d", result)
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in [ "a", "c", "d" ])
+    assert cache.size <= cache.max_bytes
+
+
+def test_identical_requests_share_one_computation():
+    cache = ResultCache(max_bytes=10000, ttl_secs=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return { "success": True, "count": len(calls) }
+
+    async def run():
+        return await asyncio.gather(*[ cache.get_or_compute("a", compute) for _ in range(5) ])
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert all(result == { "success": True, "count": 1 } for result in results)
+    assert cache.misses == 1 and cache.hits == 4
+
+    # and later ones come straight from the cache
+    assert asyncio.run(cache.get_or_compute("a", compute))["count"] == 1
+    assert len(calls) == 1
+
+
+def test_failure_is_shared_but_not_cached():
+    cache = ResultCache(max_bytes=10000, ttl_secs=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise RuntimeError("Inference failed")
+
+    async def run():
+        return await asyncio.gather(*[ cache.get_or_compute("a", compute) for _ in range(3) ],
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.get("a") is None
+
+
+
+def test_waiter_takes_over_cancelled_computation():
+    cache = ResultCache(max_bytes=10000, ttl_secs=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return { "success": True, "computed_by": len(calls) }
+
+    async def run():
+        first   = asyncio.ensure_future(cache.get_or_compute("a", compute))
+        await asyncio.sleep(0.01)
+        waiters = [ asyncio.ensure_future(cache.get_or_compute("a", compute)) for _ in range(3) ]
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return first, await asyncio.gather(*waiters)
+
+    first, results = asyncio.run(run())
+
+    assert first.cancelled()
+    assert len(calls) == 2
+    assert all(result["computed_by"] == 2 for result in results)
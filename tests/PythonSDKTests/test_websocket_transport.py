@@ -0,0 +1,60 @@
+import asyncio
+import json
+
+import aiohttp
+from aiohttp.test_utils import TestServer
+
+from queue_server import QueueServer
+from request_data import RequestData
+from websocket_transport import WebSocketTransport
+
+
+def test_split_reply():
+    assert WebSocketTransport._split_reply('7\n{"reqid": "1"}') == (7, '{"reqid": "1"}')
+    assert WebSocketTransport._split_reply("8\n") == (8, "")
+
+    get_id, content = WebSocketTransport._split_reply((7).to_bytes(4, "little") + b"frame")
+    assert get_id == 7 and bytes(content) == b"frame"
+
+
+def test_late_reply_is_kept():
+    async def run():
+        transport = WebSocketTransport(None, "ws://localhost/")
+
+        # A reply to a get no one's waiting on. The request it holds is handed
+        # out by the next get_command, without asking the server again
+        transport._set_reply(3, '{"reqid": "1"}')
+        transport._set_reply(4, "")
+        return await transport.get_command(), await transport.get_command(timeout=0.1)
+
+    assert asyncio.run(run()) == ([ '{"reqid": "1"}' ], [])
+
+
+def test_round_trip():
+    async def run():
+        queue_server = QueueServer("objectdetection_queue", {}, dequeue_timeout=5, response_timeout=5)
+        async with TestServer(queue_server.build_app()) as server, aiohttp.ClientSession() as session:
+            url       = str(server.make_url("/v1/queue/objectdetection_queue/ws")) + "?binary=true"
+            transport = WebSocketTransport(session, url.replace("http", "ws", 1))
+            receiver  = asyncio.create_task(transport.receive_loop())
+
+            files    = [ ({ "name": "a.jpg", "contentType": "image/jpeg" }, b"jpeg bytes") ]
+            response = asyncio.create_task(queue_server.enqueue("objectdetection_queue", "detect", [], files))
+
+            while not transport.connected:
+                await asyncio.sleep(0.01)
+
+            # The request has a file, so arrives as a binary frame
+            command = await transport.get_command()
+            request = RequestData(command[0])
+            assert request.command == "detect"
+            assert bytes(request.get_file_bytes(0)) == b"jpeg bytes"
+
+            assert await transport.send_response(request.request_id, { "success": True, "count": 0 })
+
+            result = await response
+            await transport.close()
+            await receiver
+            return result
+
+    assert asyncio.run(run()) == { "success": True, "count": 0 }
@@ -1,12 +1,22 @@
 using System;
 using System.Collections.Generic;
+using System.IO;
+using System.Net;
+using System.Net.Sockets;
+using System.Net.WebSockets;
+using System.Text;
 using System.Text.Json;
+using System.Text.Json.Nodes;
 using System.Threading;
 using System.Threading.Tasks;
 
 using CodeProject.AI.SDK;
 using CodeProject.AI.Server.Backend;
+using CodeProject.AI.Server.Controllers;
 
+using Microsoft.AspNetCore.Http;
+using Microsoft.AspNetCore.Http.Features;
+using Microsoft.AspNetCore.Mvc;
 using Microsoft.Extensions.Logging.Abstractions;
 using Microsoft.Extensions.Options;
 
@@ -18,6 +28,15 @@ namespace QueueServiceTests
     {
         public class TestQueuedRequest : BackendRequestBase
         {
+            public TestQueuedRequest()
+            {
+            }
+
+            public TestQueuedRequest(string command)
+            {
+                reqtype = command;
+            }
+
             public string? image_name { get; set; }
         }
 
@@ -45,6 +64,82 @@ namespace QueueServiceTests
         private QueueServices _queueServices = new QueueServices(new TestOptions(queueOptions),
                                                                  new NullLogger<QueueServices>());
 
+        /// <summary>
+        /// Creates a QueueController for our queue. No module ID is ever given, so the controller
+        /// never needs the module process service.
+        /// </summary>
+        private QueueController CreateController(HttpContext context)
+        {
+            return new QueueController(_queueServices, null!, new NullLogger<QueueController>())
+            {
+                ControllerContext = new ControllerContext { HttpContext = context }
+            };
+        }
+
+        /// <summary>
+        /// Hands the server's end of a WebSocket to a controller, as ASP.NET would for a
+        /// WebSocket request.
+        /// </summary>
+        private class TestWebSocketFeature : IHttpWebSocketFeature
+        {
+            private readonly WebSocket _socket;
+
+            public TestWebSocketFeature(WebSocket socket)
+            {
+                _socket = socket;
+            }
+
+            public bool IsWebSocketRequest => true;
+
+            public Task<WebSocket> AcceptAsync(WebSocketAcceptContext context) => Task.FromResult(_socket);
+        }
+
+        /// <summary>
+        /// Creates the two ends of a WebSocket, connected over a loopback TCP connection.
+        /// </summary>
+        private static async Task<(WebSocket server, WebSocket client)> CreateWebSocketPair()
+        {
+            var listener = new TcpListener(IPAddress.Loopback, 0);
+            listener.Start();
+            try
+            {
+                var client       = new TcpClient();
+                var connectTask  = client.ConnectAsync(IPAddress.Loopback, ((IPEndPoint)listener.LocalEndpoint).Port);
+                TcpClient server = await listener.AcceptTcpClientAsync().ConfigureAwait(false);
+                await connectTask.ConfigureAwait(false);
+
+                return (WebSocket.CreateFromStream(server.GetStream(), new WebSocketCreationOptions { IsServer = true }),
+                        WebSocket.CreateFromStream(client.GetStream(), new WebSocketCreationOptions { IsServer = false }));
+            }
+            finally
+            {
+                listener.Stop();
+            }
+        }
+
+        private static async Task<string> ReceiveTextAsync(WebSocket socket)
+        {
+            var buffer  = new byte[16 * 1024];
+            var message = new MemoryStream();
+            WebSocketReceiveResult result;
+            do
+            {
+                result = await socket.ReceiveAsync(new ArraySegment<byte>(buffer), CancellationToken.None)
+                                     .ConfigureAwait(false);
+                message.Write(buffer, 0, result.Count);
+            }
+            while (!result.EndOfMessage);
+
+            Assert.Equal(WebSocketMessageType.Text, result.MessageType);
+            return Encoding.UTF8.GetString(message.ToArray());
+        }
+
+        private static Task SendTextAsync(WebSocket socket, string text)
+        {
+            return socket.SendAsync(new ArraySegment<byte>(Encoding.UTF8.GetBytes(text)),
+                                    WebSocketMessageType.Text, true, CancellationToken.None);
+        }
+
         [Fact]
         public async Task RequestTimesOutIfNotHandled()
         {
@@ -304,5 +399,285 @@ namespace QueueServiceTests
             Assert.NotNull(errorResponse);
             Assert.Equal("the request was canceled by caller.", errorResponse!.error);
         }
+
+        [Fact]
+        public async Task CanSetResponsesInOneCall()
+        {
+            var request1     = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var request2     = new TestQueuedRequest { image_name = "Alf.jpg" };
+            var request1Task = _queueServices.SendRequestAsync(QueueName, request1);
+            var request2Task = _queueServices.SendRequestAsync(QueueName, request2);
+            Assert.NotNull(_queueServices.DequeueRequest(QueueName));
+            Assert.NotNull(_queueServices.DequeueRequest(QueueName));
+
+            var responses = new JsonArray(
+                new JsonObject { ["reqid"] = request1.reqid, ["response"] = new JsonObject { ["label"] = "Bob" } },
+                new JsonObject { ["reqid"] = request2.reqid, ["response"] = new JsonObject { ["label"] = "Alf" } },
+                new JsonObject { ["reqid"] = "unknown",      ["response"] = new JsonObject { ["label"] = "Zed" } });
+
+            var context = new DefaultHttpContext();
+            context.Request.Body = new MemoryStream(Encoding.UTF8.GetBytes(responses.ToJsonString()));
+
+            ObjectResult result = await CreateController(context).SetResponses().ConfigureAwait(false);
+            Assert.IsType<OkObjectResult>(result);
+            Assert.Equal("2 responses saved.", result.Value);
+
+            var response1 = JsonNode.Parse((string)await request1Task.ConfigureAwait(false));
+            var response2 = JsonNode.Parse((string)await request2Task.ConfigureAwait(false));
+            Assert.Equal("Bob", response1?["label"]?.ToString());
+            Assert.Equal("Alf", response2?["label"]?.ToString());
+        }
+
+        [Fact]
+        public async Task SetResponsesSkipsBadEntries()
+        {
+            var request1     = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var request2     = new TestQueuedRequest { image_name = "Alf.jpg" };
+            var request3     = new TestQueuedRequest { image_name = "Zed.jpg" };
+            var request1Task = _queueServices.SendRequestAsync(QueueName, request1);
+            var request2Task = _queueServices.SendRequestAsync(QueueName, request2);
+            var request3Task = _queueServices.SendRequestAsync(QueueName, request3);
+            Assert.NotNull(_queueServices.DequeueRequest(QueueName));
+            Assert.NotNull(_queueServices.DequeueRequest(QueueName));
+            Assert.NotNull(_queueServices.DequeueRequest(QueueName));
+
+            // The good responses either side of the bad ones are still saved
+            var responses = new JsonArray(
+                new JsonObject { ["reqid"] = request1.reqid, ["response"] = new JsonObject { ["label"] = "Bob" } },
+                new JsonObject { ["reqid"] = request2.reqid },
+                new JsonObject { ["reqid"] = request2.reqid, ["response"] = null },
+                new JsonObject { ["reqid"] = request2.reqid, ["response"] = "not an object" },
+                JsonValue.Create(42),
+                new JsonObject { ["reqid"] = request3.reqid, ["response"] = new JsonObject { ["label"] = "Zed" } });
+
+            var context = new DefaultHttpContext();
+            context.Request.Body = new MemoryStream(Encoding.UTF8.GetBytes(responses.ToJsonString()));
+
+            ObjectResult result = await CreateController(context).SetResponses().ConfigureAwait(false);
+            Assert.IsType<OkObjectResult>(result);
+            Assert.Equal("2 responses saved.", result.Value);
+
+            var response1 = JsonNode.Parse((string)await request1Task.ConfigureAwait(false));
+            var response3 = JsonNode.Parse((string)await request3Task.ConfigureAwait(false));
+            Assert.Equal("Bob", response1?["label"]?.ToString());
+            Assert.Equal("Zed", response3?["label"]?.ToString());
+        }
+
+        [Fact]
+        public async Task SetResponsesRejectsNonArray()
+        {
+            var context = new DefaultHttpContext();
+            context.Request.Body = new MemoryStream(Encoding.UTF8.GetBytes("{ \"reqid\": \"1\" }"));
+
+            ObjectResult result = await CreateController(context).SetResponses().ConfigureAwait(false);
+            Assert.IsType<BadRequestObjectResult>(result);
+        }
+
+        [Fact]
+        public async Task RequestHasDeadline()
+        {
+            long before      = DateTimeOffset.UtcNow.Add(queueOptions.ResponseTimeout).ToUnixTimeMilliseconds();
+            var request      = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var requestTask  = _queueServices.SendRequestAsync(QueueName, request);
+            long after       = DateTimeOffset.UtcNow.Add(queueOptions.ResponseTimeout).ToUnixTimeMilliseconds();
+
+            BackendRequestBase? result = await _queueServices.DequeueRequestAsync(QueueName)
+                                                             .ConfigureAwait(false);
+            Assert.Same(request, result);
+            Assert.NotNull(result!.deadline);
+            Assert.InRange(result.deadline!.Value, before, after);
+        }
+
+        [Fact]
+        public async Task CanceledRequestIsShed()
+        {
+            using var cts    = new CancellationTokenSource();
+            var request1     = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var request2     = new TestQueuedRequest { image_name = "Alf.jpg" };
+            var request1Task = _queueServices.SendRequestAsync(QueueName, request1, cts.Token);
+            var request2Task = _queueServices.SendRequestAsync(QueueName, request2);
+            cts.Cancel();
+            await request1Task.ConfigureAwait(false);
+
+            // No one is waiting on the first request any more, so it's never handed to a module
+            BackendRequestBase? result = await _queueServices.DequeueRequestAsync(QueueName)
+                                                             .ConfigureAwait(false);
+            Assert.Same(request2, result);
+        }
+
+        [Fact]
+        public async Task ControlCommandsJumpTheQueue()
+        {
+            var request1      = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var request2      = new TestQueuedRequest { image_name = "Alf.jpg" };
+            var statusRequest = new TestQueuedRequest("status");
+            var request1Task  = _queueServices.SendRequestAsync(QueueName, request1);
+            var request2Task  = _queueServices.SendRequestAsync(QueueName, request2);
+            var statusTask    = _queueServices.SendRequestAsync(QueueName, statusRequest);
+
+            BackendRequestBase? result = await _queueServices.DequeueRequestAsync(QueueName)
+                                                             .ConfigureAwait(false);
+            Assert.Same(statusRequest, result);
+
+            result = await _queueServices.DequeueRequestAsync(QueueName).ConfigureAwait(false);
+            Assert.Same(request1, result);
+        }
+
+        [Fact]
+        public async Task ControlLaneOnlyReturnsControlCommands()
+        {
+            var request       = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var statusRequest = new TestQueuedRequest("status");
+            var requestTask   = _queueServices.SendRequestAsync(QueueName, request);
+            var statusTask    = _queueServices.SendRequestAsync(QueueName, statusRequest);
+
+            BackendRequestBase? result = await _queueServices.DequeueRequestAsync(QueueName, controlOnly: true)
+                                                             .ConfigureAwait(false);
+            Assert.Same(statusRequest, result);
+
+            // Nothing else in the control lane, so this waits out the dequeue timeout
+            using var cancellationSource = new CancellationTokenSource(TimeSpan.FromSeconds(1));
+            result = await _queueServices.DequeueRequestAsync(QueueName, cancellationSource.Token, controlOnly: true)
+                                         .ConfigureAwait(false);
+            Assert.Null(result);
+        }
+
+        [Fact]
+        public async Task RequeuedRequestCanBePulledAgain()
+        {
+            var request     = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var requestTask = _queueServices.SendRequestAsync(QueueName, request);
+
+            BackendRequestBase? result = await _queueServices.DequeueRequestAsync(QueueName)
+                                                             .ConfigureAwait(false);
+            Assert.Same(request, result);
+            Assert.True(_queueServices.RequeueRequest(QueueName, result!));
+
+            result = await _queueServices.DequeueRequestAsync(QueueName).ConfigureAwait(false);
+            Assert.Same(request, result);
+        }
+
+        [Fact]
+        public async Task OnlyFirstResponseIsSaved()
+        {
+            var request         = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var requestTask     = _queueServices.SendRequestAsync(QueueName, request);
+            var pulledRequest   = _queueServices.DequeueRequest(QueueName);
+            Assert.NotNull(pulledRequest);
+
+            string firstResponse  = JsonSerializer.Serialize(new TestQueuedResponse { success = true, label = "Bob" });
+            string secondResponse = JsonSerializer.Serialize(new TestQueuedResponse { success = true, label = "Alf" });
+            Assert.True(_queueServices.SetResult(request.reqid, firstResponse));
+            Assert.False(_queueServices.SetResult(request.reqid, secondResponse));
+
+            var result = await requestTask.ConfigureAwait(false);
+            Assert.Equal(firstResponse, result);
+        }
+
+        [Fact]
+        public async Task WebSocketGetIsAnsweredWithRequest()
+        {
+            var request     = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var requestTask = _queueServices.SendRequestAsync(QueueName, request);
+
+            (WebSocket server, WebSocket client) = await CreateWebSocketPair().ConfigureAwait(false);
+            var context = new DefaultHttpContext();
+            context.Features.Set<IHttpWebSocketFeature>(new TestWebSocketFeature(server));
+
+            Task socketTask = CreateController(context).OpenQueueWebSocket(QueueName, string.Empty, null,
+                                                                           null, null, CancellationToken.None);
+
+            // The reply starts with the id of the get it answers
+            await SendTextAsync(client, "{ \"type\": \"get\", \"id\": 7 }").ConfigureAwait(false);
+            string reply = await ReceiveTextAsync(client).ConfigureAwait(false);
+            Assert.StartsWith("7\n", reply);
+
+            var sentRequest = JsonNode.Parse(reply.Substring(2));
+            Assert.Equal(request.reqid, sentRequest?["reqid"]?.ToString());
+
+            // and the response goes back over the same socket
+            var response = new JsonObject
+            {
+                ["type"]     = "response",
+                ["reqid"]    = request.reqid,
+                ["response"] = new JsonObject { ["label"] = "Bob" }
+            };
+            await SendTextAsync(client, response.ToJsonString()).ConfigureAwait(false);
+
+            var result = JsonNode.Parse((string)await requestTask.ConfigureAwait(false));
+            Assert.Equal("Bob", result?["label"]?.ToString());
+
+            await client.CloseAsync(WebSocketCloseStatus.NormalClosure, null, CancellationToken.None)
+                        .ConfigureAwait(false);
+            await socketTask.ConfigureAwait(false);
+        }
+
+        [Fact]
+        public async Task WebSocketIgnoresBadMessages()
+        {
+            var request     = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var requestTask = _queueServices.SendRequestAsync(QueueName, request);
+
+            (WebSocket server, WebSocket client) = await CreateWebSocketPair().ConfigureAwait(false);
+            var context = new DefaultHttpContext();
+            context.Features.Set<IHttpWebSocketFeature>(new TestWebSocketFeature(server));
+
+            Task socketTask = CreateController(context).OpenQueueWebSocket(QueueName, string.Empty, null,
+                                                                           null, null, CancellationToken.None);
+
+            await SendTextAsync(client, "not JSON").ConfigureAwait(false);
+            await SendTextAsync(client, "[ 1, 2 ]").ConfigureAwait(false);
+            await SendTextAsync(client, $"{{ \"type\": \"response\", \"reqid\": \"{request.reqid}\" }}")
+                 .ConfigureAwait(false);
+
+            // The socket is still open, and the request is still waiting for its response
+            await SendTextAsync(client, "{ \"type\": \"get\", \"id\": 3 }").ConfigureAwait(false);
+            string reply = await ReceiveTextAsync(client).ConfigureAwait(false);
+            Assert.StartsWith("3\n", reply);
+            Assert.Equal(request.reqid, JsonNode.Parse(reply.Substring(2))?["reqid"]?.ToString());
+
+            var response = new JsonObject
+            {
+                ["type"]     = "response",
+                ["reqid"]    = request.reqid,
+                ["response"] = new JsonObject { ["label"] = "Bob" }
+            };
+            await SendTextAsync(client, response.ToJsonString()).ConfigureAwait(false);
+
+            var result = JsonNode.Parse((string)await requestTask.ConfigureAwait(false));
+            Assert.Equal("Bob", result?["label"]?.ToString());
+
+            await client.CloseAsync(WebSocketCloseStatus.NormalClosure, null, CancellationToken.None)
+                        .ConfigureAwait(false);
+            await socketTask.ConfigureAwait(false);
+        }
+
+        [Fact]
+        public async Task WebSocketCloseLeavesRequestQueued()
+        {
+            (WebSocket server, WebSocket client) = await CreateWebSocketPair().ConfigureAwait(false);
+            var context = new DefaultHttpContext();
+            context.Features.Set<IHttpWebSocketFeature>(new TestWebSocketFeature(server));
+
+            // Make sure the queue exists, then ask for a request and go away before one arrives
+            var firstRequest = new TestQueuedRequest { image_name = "Bob.jpg" };
+            var firstTask    = _queueServices.SendRequestAsync(QueueName, firstRequest);
+            Assert.NotNull(_queueServices.DequeueRequest(QueueName));
+
+            Task socketTask = CreateController(context).OpenQueueWebSocket(QueueName, string.Empty, null,
+                                                                           null, null, CancellationToken.None);
+            await SendTextAsync(client, "{ \"type\": \"get\", \"id\": 1 }").ConfigureAwait(false);
+            await client.CloseAsync(WebSocketCloseStatus.NormalClosure, null, CancellationToken.None)
+                        .ConfigureAwait(false);
+            await socketTask.ConfigureAwait(false);
+
+            // The request that arrives afterwards is still there for the next module
+            var request     = new TestQueuedRequest { image_name = "Alf.jpg" };
+            var requestTask = _queueServices.SendRequestAsync(QueueName, request);
+
+            BackendRequestBase? result = await _queueServices.DequeueRequestAsync(QueueName)
+                                                             .ConfigureAwait(false);
+            Assert.Same(request, result);
+        }
     }
 }
\ No newline at end of file